@@ -0,0 +1,196 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import time
+from copy import deepcopy
+
+import torch
+import yaml
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml, infer_model_dims, build_gan
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Autotunes the batch size, torch thread counts and DataLoader workers of the training step.')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file (model hyperparameters).')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset whose train split the trial steps run on.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 16, 32, 64, 128, 256], help='Batch sizes to try.')
+    parser.add_argument('--threads', type=int, nargs='+', default=None,
+                        help='torch intra-op thread counts to try (default: powers of two up to the number of cores).')
+    parser.add_argument('--interop_threads', type=int, nargs='+', default=[1, 2], help='torch inter-op thread counts to try.')
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 2, 4], help='DataLoader worker counts to try.')
+    parser.add_argument('--warmup_steps', type=int, default=2, help='Untimed train steps of every trial.')
+    parser.add_argument('--trial_steps', type=int, default=10, help='Timed train steps of every trial.')
+    parser.add_argument('--memory_limit_gb', type=float, default=None,
+                        help='Peak memory (RSS of the trial process plus its DataLoader workers, sampled every step) a setting may use. Defaults to 80%% of the physical memory.')
+    parser.add_argument('--trial_timeout', type=float, default=600, help='Seconds after which a trial is stopped and counted as failed.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the model initialization and the batch order.')
+    parser.add_argument('--output', type=str, default="results/autotune_overlay.yaml",
+                        help='Path of the config overlay with the best settings (use it with main.py --config_overlay).')
+    parser.add_argument('--report', type=str, default="results/autotune_report.json",
+                        help='Path of the measured throughput curve (json).')
+
+    args = parser.parse_args()
+    return args
+
+
+def process_tree_rss():
+    """
+    Return:
+        rss (int): resident memory (bytes) of this process plus the sum over its child processes (the DataLoader workers), read from /proc.
+            Pages shared by several processes (e.g. the shared dataset tensors) are counted by every process, so this is an upper bound.
+    """
+    pids = [os.getpid()]
+    for task in os.listdir(f"/proc/{os.getpid()}/task"):
+        with open(f"/proc/{os.getpid()}/task/{task}/children") as f:
+            pids.extend(int(pid) for pid in f.read().split())
+    rss = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except FileNotFoundError: # the process exited
+            pass
+    return rss
+
+
+def run_trial(config_dict, data_folder, dset, setting, warmup_steps, trial_steps, seed, results):
+    """
+    Runs warmup_steps + trial_steps GAN train steps with the given setting (batch_size, num_threads, num_interop_threads, num_workers)
+    in a fresh process (the inter-op thread count can only be set once per process) and puts the measured throughput into results.
+    """
+    torch.set_num_threads(setting["num_threads"])
+    torch.set_num_interop_threads(setting["num_interop_threads"])
+    torch.manual_seed(seed)
+    try:
+        dataset = Dataset(data_folder, dset, split="train", mmap_cache=config_dict.get('mmap_dataset', False))
+        if setting["num_workers"] > 0:
+            dataset.share_memory()
+        assert len(dataset) >= setting["batch_size"], f"the train split has fewer than {setting['batch_size']} users"
+        dataloader = DataLoader(dataset, batch_size=setting["batch_size"], shuffle=True, collate_fn=custom_collate_fn, drop_last=True, \
+            num_workers=setting["num_workers"], persistent_workers=setting["num_workers"] > 0, generator=torch.Generator().manual_seed(seed))
+        config_dict = deepcopy(config_dict)
+        config_dict["batch_size"] = setting["batch_size"]
+        infer_model_dims(config_dict, dataloader)
+        gan = build_gan(config_dict)
+        gan.init_optimizers()
+        gan.prepare_training(dataset)
+
+        # the data loading is timed too (it overlaps with the train steps when DataLoader workers are used)
+        batches = iter(dataloader)
+        num_users, num_time_steps, peak_rss = 0, 0, 0
+        for step in range(warmup_steps + trial_steps):
+            if step == warmup_steps:
+                start = time.perf_counter()
+            try:
+                real_click_history, display_set, clicked_items = next(batches)
+            except StopIteration:
+                batches = iter(dataloader)
+                real_click_history, display_set, clicked_items = next(batches)
+            gan.train_step(real_click_history, display_set, clicked_items)
+            if step >= warmup_steps:
+                num_users += setting["batch_size"]
+                num_time_steps += real_click_history.data.shape[0]
+            # RUSAGE_CHILDREN only gives the peak of the largest worker, the RSS of the workers is sampled and summed instead
+            peak_rss = max(peak_rss, process_tree_rss())
+        elapsed = time.perf_counter() - start
+
+        peak_rss = max(peak_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        results.put({"users_per_s": num_users / elapsed, "time_steps_per_s": num_time_steps / elapsed, "step_s": elapsed / trial_steps, "peak_rss_gb": peak_rss / 2**30})
+    except (RuntimeError, MemoryError, AssertionError) as error:
+        results.put({"error": str(error)})
+
+
+def measure(args, config_dict, setting, memory_limit_gb):
+    """
+    Return:
+        result (dict): setting and its measured throughput, "feasible" is False if the trial failed or exceeded the memory limit.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_trial, args=(config_dict, args.data_folder, args.dataset, setting, args.warmup_steps, args.trial_steps, args.seed, results))
+    process.start()
+    try:
+        result = results.get(timeout=args.trial_timeout)
+    except queue.Empty:
+        result = {"error": "trial timed out" if process.is_alive() else f"trial process exited with code {process.exitcode} (e.g. killed when out of memory)"}
+    process.join(timeout=10)
+    if process.is_alive():
+        process.kill()
+    result = {**setting, **result}
+    result["feasible"] = "error" not in result and result["peak_rss_gb"] <= memory_limit_gb
+    print(json.dumps(result))
+    return result
+
+
+def sweep(args, config_dict, base_setting, key, values, memory_limit_gb):
+    """
+    Measures the settings where base_setting[key] takes the given values (in order). For the batch size the sweep
+    stops at the first infeasible value, larger batches only need more memory.
+    Return:
+        curve (list): measured results.
+        best (dict): feasible result with the highest time_steps_per_s (None if no value is feasible).
+    """
+    curve = []
+    for value in values:
+        result = measure(args, config_dict, {**base_setting, key: value}, memory_limit_gb)
+        curve.append(result)
+        if key == "batch_size" and not result["feasible"]:
+            break
+    feasible = [result for result in curve if result["feasible"]]
+    return curve, max(feasible, key=lambda result: result["time_steps_per_s"]) if feasible else None
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+    num_cores = os.cpu_count()
+    threads = args.threads or sorted({2**i for i in range(num_cores.bit_length()) if 2**i <= num_cores} | {num_cores})
+    memory_limit_gb = args.memory_limit_gb or 0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30
+    start = time.perf_counter()
+
+    # Coordinate search: batch size (all cores, no workers), then the thread counts, then the DataLoader workers
+    setting = {"batch_size": config_dict["batch_size"], "num_threads": num_cores, "num_interop_threads": 1, "num_workers": 0}
+    curves = {}
+    best = None
+    curves["batch_size"], best = sweep(args, config_dict, setting, "batch_size", sorted(args.batch_sizes), memory_limit_gb)
+    assert best is not None, f"no batch size fits into {memory_limit_gb:.1f} GB"
+
+    curves["threads"] = []
+    for num_threads, num_interop_threads in itertools.product(threads, args.interop_threads):
+        result = measure(args, config_dict, {**{key: best[key] for key in setting}, "num_threads": num_threads, "num_interop_threads": num_interop_threads}, memory_limit_gb)
+        curves["threads"].append(result)
+        if result["feasible"] and result["time_steps_per_s"] > best["time_steps_per_s"]:
+            best = result
+
+    curves["num_workers"], best_workers = sweep(args, config_dict, {key: best[key] for key in setting}, "num_workers", args.num_workers, memory_limit_gb)
+    if best_workers is not None and best_workers["time_steps_per_s"] > best["time_steps_per_s"]:
+        best = best_workers
+
+    overlay = {"batch_size": best["batch_size"], "torch_num_threads": best["num_threads"], "torch_interop_threads": best["num_interop_threads"], \
+        "num_workers": best["num_workers"]}
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        f.write(f"# autotune.py --dataset {args.dataset}: {best['time_steps_per_s']:.1f} time steps/s, peak memory {best['peak_rss_gb']:.2f} GB\n")
+        yaml.dump(overlay, f)
+    report = {"dataset": args.dataset, "num_cores": num_cores, "memory_limit_gb": memory_limit_gb, "trial_steps": args.trial_steps, \
+        "best": best, "overlay": overlay, "curves": curves, "elapsed_s": time.perf_counter() - start}
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
+
+    print("*" * 30)
+    print(f"best setting: {overlay} ({best['time_steps_per_s']:.1f} time steps/s, {best['users_per_s']:.1f} users/s)")
+    print(f"Wrote the config overlay to {args.output} (python main.py --config_overlay {args.output}) and the throughput curves to {args.report}")
+    print("*" * 30)
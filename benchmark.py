@@ -0,0 +1,390 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn
+from main import parse_config_yaml, infer_model_dims, build_gan
+from dropbox.generate_synthetic_data import generate_session_log
+from dropbox.ingest_logs import ingest_log
+from model.checkpointing import SavedActivationMemory
+from model.inference import StaticUserModel, to_static_inputs, compile_static_model
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+PROCESS_DATA_SCRIPT = os.path.join(REPO_DIR, "dropbox", "process_data.py")
+SYNTHETIC_DSET = "synthetic"
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Benchmarks the data, model and training hot paths on a synthetic session log.')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file (model hyperparameters).')
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Folder to write the synthetic dataset into. Defaults to a temporary folder.')
+    parser.add_argument('--num_users', type=int, default=300, help='Number of synthetic users (sessions).')
+    parser.add_argument('--num_items', type=int, default=500, help='Number of synthetic items.')
+    parser.add_argument('--display_size', type=int, default=10, help='(Maximum) number of items in a display set.')
+    parser.add_argument('--min_display_size', type=int, default=None, help='Minimum number of items in a display set.')
+    parser.add_argument('--session_length', type=int, default=10, help='(Maximum) number of time steps of a session.')
+    parser.add_argument('--min_session_length', type=int, default=None, help='Minimum number of time steps of a session.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data generator.')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of timed repetitions per stage.')
+    parser.add_argument('--warmup', type=int, default=1, help='Number of untimed warmup repetitions per stage.')
+    parser.add_argument('--stages', type=str, nargs='*', default=None,
+                        help='Subset of the stages to run (default: all). See STAGES.')
+    parser.add_argument('--output', type=str, default="results/benchmark_results.json",
+                        help='Path of the machine-readable (json) results.')
+    parser.add_argument('--baseline', type=str, default="results/benchmark_baseline.json",
+                        help='Path of the stored baseline results to compare against.')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='Store the results of this run as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slowdown of the median time w.r.t. the baseline before a stage is reported as a regression.')
+    parser.add_argument('--activation_memory', action='store_true',
+                        help='Report the activation memory saved by activation checkpointing (the *_checkpoint_segments keys of the config, '
+                             'every layer is a segment if they are not set).')
+
+    args = parser.parse_args()
+    return args
+
+
+def time_stage(fn, repeats, warmup):
+    """
+    Input:
+        fn (callable): function to time (called without arguments).
+        repeats (int): number of timed calls.
+        warmup (int): number of untimed calls before timing.
+    Return:
+        timings (dict): min/median/mean/max wall time in seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "repeats": repeats,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "max_s": max(times),
+    }
+
+
+class BenchmarkContext():
+    """
+    Lazily builds (and caches) the objects shared by the benchmark stages, so that every stage only times its own hot path.
+    """
+    def __init__(self, args, config_dict):
+        self.args = args
+        self.config_dict = config_dict
+        self._datasets = {}
+        self._batch = None
+        self._gan = None
+        self._static_model = None
+
+    def process_data(self):
+        subprocess.run([sys.executable, PROCESS_DATA_SCRIPT, '-dataset', SYNTHETIC_DSET], cwd=self.args.work_dir, check=True, stdout=subprocess.DEVNULL)
+
+    def ingest_logs(self):
+        # written to a subfolder, Dataset(work_dir) keeps reading the pickle files of process_data
+        ingest_log(os.path.join(self.args.work_dir, SYNTHETIC_DSET+'.txt'), os.path.join(self.args.work_dir, 'ingest', SYNTHETIC_DSET+'-columns'))
+
+    def dataset(self, split):
+        if split not in self._datasets:
+            self._datasets[split] = Dataset(self.args.work_dir, SYNTHETIC_DSET, split=split)
+        return self._datasets[split]
+
+    def dataloader(self, split, shuffle=False):
+        return DataLoader(self.dataset(split), batch_size=self.config_dict['batch_size'], shuffle=shuffle, collate_fn=custom_collate_fn, drop_last=True)
+
+    def samples(self):
+        dataset = self.dataset("train")
+        return [dataset[i] for i in range(min(self.config_dict['batch_size'], len(dataset)))]
+
+    def batch(self):
+        if self._batch is None:
+            self._batch = custom_collate_fn(self.samples())
+        return self._batch
+
+    def gan(self):
+        if self._gan is None:
+            infer_model_dims(self.config_dict, self.dataloader("train"))
+            self._gan = build_gan(self.config_dict)
+            self._gan.init_optimizers()
+            self._gan.prepare_training(self.dataset("train"))
+        return self._gan
+
+    def static_model(self):
+        if self._static_model is None:
+            gan = self.gan()
+            self._static_model = StaticUserModel(gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel, \
+                self.config_dict["generator_output_size"] - 1, self.config_dict["history_input_size"]).to(gan.device).eval()
+        return self._static_model
+
+    def static_batch(self):
+        real_click_history, display_set, clicked_items = self.batch()
+        click_history, display_set, lengths = to_static_inputs(real_click_history, display_set, self.args.session_length)
+        return click_history.to(self.gan().device), display_set.to(self.gan().device)
+
+
+# ========== Stages. Every stage returns a function which runs the timed hot path once.
+def stage_process_data(ctx):
+    return ctx.process_data
+
+def stage_ingest_logs(ctx):
+    return ctx.ingest_logs
+
+def stage_dataset_construction(ctx):
+    return lambda: Dataset(ctx.args.work_dir, SYNTHETIC_DSET, split="train")
+
+def stage_collate(ctx):
+    samples = ctx.samples()
+    return lambda: custom_collate_fn(samples)
+
+def stage_history_lstm_forward(ctx):
+    gan = ctx.gan()
+    real_click_history, display_set, clicked_items = ctx.batch()
+    real_click_history = real_click_history.to(gan.device)
+    def run():
+        with torch.no_grad():
+            gan.history_LSTM(real_click_history)
+    return run
+
+def stage_generator_forward(ctx):
+    gan = ctx.gan()
+    real_click_history, display_set, clicked_items = ctx.batch()
+    display_set = display_set.to(gan.device)
+    with torch.no_grad():
+        real_states = gan.history_LSTM(real_click_history.to(gan.device))
+    def run():
+        with torch.no_grad():
+            gan.generator_UserModel(real_states, display_set)
+    return run
+
+def stage_discriminator_forward(ctx):
+    gan = ctx.gan()
+    real_click_history, display_set, clicked_items = ctx.batch()
+    display_set = display_set.to(gan.device)
+    with torch.no_grad():
+        real_states = gan.history_LSTM(real_click_history.to(gan.device))
+    def run():
+        with torch.no_grad():
+            gan.discriminator_RewardModel(real_states, display_set)
+    return run
+
+def stage_user_model_eager(ctx):
+    # scoring path of the training models (PackedSequence inputs), the reference of the static_model_* stages
+    gan = ctx.gan()
+    real_click_history, display_set, clicked_items = ctx.batch()
+    real_click_history, display_set = real_click_history.to(gan.device), display_set.to(gan.device)
+    def run():
+        with torch.no_grad():
+            real_states = gan.history_LSTM(real_click_history)
+            gan.generator_UserModel(real_states, display_set)
+            gan.discriminator_RewardModel(real_states, display_set)
+    return run
+
+def static_model_stage(ctx, model):
+    inputs = ctx.static_batch()
+    def run():
+        with torch.no_grad():
+            model(*inputs)
+    return run
+
+def stage_static_model_eager(ctx):
+    return static_model_stage(ctx, ctx.static_model())
+
+def stage_static_model_compiled(ctx):
+    # compilation happens in the (untimed) warmup call
+    return static_model_stage(ctx, compile_static_model(ctx.static_model()))
+
+def stage_static_model_torchscript(ctx):
+    with torch.no_grad():
+        traced = torch.jit.trace(ctx.static_model(), ctx.static_batch())
+    return static_model_stage(ctx, traced)
+
+def stage_gan_train_step(ctx):
+    gan = ctx.gan()
+    batch = ctx.batch()
+    return lambda: gan.train_step(*batch)
+
+def stage_gan_test(ctx):
+    gan = ctx.gan()
+    test_dataloader = ctx.dataloader("test")
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            gan.test(test_dataloader)
+    return run
+
+
+def activation_memory_report(ctx):
+    """
+    Return:
+        report (dict): bytes of the activations kept for backward by a forward pass of the History_LSTM, Discriminator_RewardModel 
+            and Generator_UserModel on a batch, without and with activation checkpointing.
+    """
+    gan = ctx.gan()
+    real_click_history, display_set, clicked_items = [x.to(gan.device) for x in ctx.batch()]
+    models = [gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel]
+    configured_segments = [model.checkpoint_segments for model in models]
+    checkpoint_segments = [
+        ctx.config_dict.get("history_checkpoint_segments") or gan.history_LSTM.num_layers,
+        ctx.config_dict.get("generator_checkpoint_segments") or len(gan.generator_UserModel.model) // 2,
+        ctx.config_dict.get("discriminator_checkpoint_segments") or len(gan.discriminator_RewardModel.model) // 2,
+    ]
+
+    def saved_activation_bytes(segments):
+        gan.history_LSTM.set_checkpoint_segments(segments[0])
+        gan.generator_UserModel.checkpoint_segments = segments[1]
+        gan.discriminator_RewardModel.checkpoint_segments = segments[2]
+        for model in models:
+            for param in model.parameters():
+                param.requires_grad = True
+        with SavedActivationMemory() as memory:
+            real_states = gan.history_LSTM(real_click_history)
+            loss = gan.discriminator_RewardModel(real_states, display_set).sum() + gan.generator_UserModel(real_states, display_set).sum()
+        loss.backward()
+        for model in models:
+            model.zero_grad()
+        return memory.nbytes
+
+    baseline_bytes = saved_activation_bytes([0, 0, 0])
+    checkpointed_bytes = saved_activation_bytes(checkpoint_segments)
+    saved_activation_bytes(configured_segments) # restore the configured segments
+    return {
+        "checkpoint_segments": {"history_lstm": checkpoint_segments[0], "generator": checkpoint_segments[1], "discriminator": checkpoint_segments[2]},
+        "baseline_bytes": baseline_bytes,
+        "checkpointed_bytes": checkpointed_bytes,
+        "saved_bytes": baseline_bytes - checkpointed_bytes,
+        "reduction": baseline_bytes / max(checkpointed_bytes, 1),
+    }
+
+
+STAGES = {
+    "process_data": stage_process_data,
+    "ingest_logs": stage_ingest_logs,
+    "dataset_construction": stage_dataset_construction,
+    "collate": stage_collate,
+    "history_lstm_forward": stage_history_lstm_forward,
+    "generator_forward": stage_generator_forward,
+    "discriminator_forward": stage_discriminator_forward,
+    "user_model_eager": stage_user_model_eager,
+    "static_model_eager": stage_static_model_eager,
+    "static_model_compiled": stage_static_model_compiled,
+    "static_model_torchscript": stage_static_model_torchscript,
+    "gan_train_step": stage_gan_train_step,
+    "gan_test": stage_gan_test,
+}
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Input:
+        results (dict): results of the current run.
+        baseline (dict): stored baseline results.
+        tolerance (float): allowed relative slowdown of the median time.
+    Return:
+        comparison (dict): per stage median ratio (current/baseline) and regression flag.
+    """
+    comparison = {}
+    for stage, timings in results["stages"].items():
+        if stage not in baseline.get("stages", {}):
+            continue
+        ratio = timings["median_s"] / max(baseline["stages"][stage]["median_s"], 1e-12)
+        comparison[stage] = {"median_ratio": ratio, "regression": ratio > 1 + tolerance}
+    return comparison
+
+
+def run_benchmarks(args, config_dict):
+    """
+    Input:
+        args (argparse.Namespace): parsed command line arguments.
+        config_dict (dict): dictionary containing the model hyperparameters.
+    Return:
+        results (dict): machine-readable benchmark results.
+    """
+    stages = list(STAGES) if not args.stages else args.stages
+    for stage in stages:
+        assert stage in STAGES, f"unknown stage: {stage}, available stages: {list(STAGES)}"
+
+    num_rows = generate_session_log(os.path.join(args.work_dir, SYNTHETIC_DSET + '.txt'), args.num_users, args.num_items, \
+        args.display_size, args.session_length, min_display_size=args.min_display_size, \
+            min_session_length=args.min_session_length, seed=args.seed)
+
+    ctx = BenchmarkContext(args, config_dict)
+    # The remaining stages read the processed dataset
+    ctx.process_data()
+
+    results = {
+        "synthetic_data": {
+            "num_users": args.num_users, "num_items": args.num_items, "num_rows": num_rows,
+            "display_size": args.display_size, "min_display_size": args.min_display_size,
+            "session_length": args.session_length, "min_session_length": args.min_session_length, "seed": args.seed,
+        },
+        "config": {k: config_dict[k] for k in ["history_hidden_size", "history_num_layers", "generator_n_hidden", "generator_hidden_dim", \
+            "discriminator_n_hidden", "discriminator_hidden_dim", "batch_size"]},
+        "environment": {
+            "python": platform.python_version(), "torch": torch.__version__,
+            "num_threads": torch.get_num_threads(), "device": "cuda" if torch.cuda.is_available() else "cpu",
+        },
+        "stages": {},
+    }
+    for stage in stages:
+        fn = STAGES[stage](ctx)
+        results["stages"][stage] = time_stage(fn, args.repeats, args.warmup)
+        print(f"{stage}: median {results['stages'][stage]['median_s']:.6f}s")
+
+    if args.activation_memory:
+        results["activation_memory"] = activation_memory_report(ctx)
+        print(f"activation memory: {results['activation_memory']['baseline_bytes']} bytes without, {results['activation_memory']['checkpointed_bytes']} bytes with activation checkpointing " \
+            f"({results['activation_memory']['reduction']:.2f}x less)")
+
+    return results
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    # Benchmarks never load pretrained checkpoints
+    config_dict["load_pretrained"] = False
+
+    with contextlib.ExitStack() as stack:
+        if args.work_dir is None:
+            args.work_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run_benchmarks(args, config_dict)
+
+    regression = False
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results["baseline_comparison"] = compare_to_baseline(results, baseline, args.tolerance)
+        for stage, comparison in results["baseline_comparison"].items():
+            status = "REGRESSION" if comparison["regression"] else "ok"
+            print(f"{stage}: {comparison['median_ratio']:.3f}x baseline [{status}]")
+            regression = regression or comparison["regression"]
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+
+    sys.exit(1 if regression else 0)
@@ -5,20 +5,187 @@ import numpy as np
 import pickle
 import datetime
 import itertools
+import json
 import os
-from copy import deepcopy
+
+SPLITS = ["train", "validation", "test"] # index = tr_val_tst tag of the raw logs
+
+
+class OneHotItemFeatures():
+    """
+    One hot item features in the layout of Dataset.item_features ([num_items+1, num_items], the last row is the all ones padding
+    placeholder) without the [num_items, num_items] matrix: only the indexed rows are materialized. Used for the one hot items of
+    the segment store and the column files, whose catalogs can be too large for a dense identity matrix.
+    """
+    def __init__(self, num_items):
+        """
+        num_items (int): number of items (= feature_dim).
+        """
+        self.num_items = num_items
+        self.shape = torch.Size((num_items + 1, num_items))
+        self.dtype = torch.float32
+
+    def __getitem__(self, item_ids):
+        """
+        Input:
+            item_ids (torch.Tensor): [*] item ids (num_items = padding placeholder), or an int/slice of rows.
+        Return:
+            features (torch.Tensor): [*, num_items] one hot rows (on the device of item_ids).
+        """
+        if not isinstance(item_ids, torch.Tensor):
+            item_ids = torch.arange(self.shape[0])[item_ids]
+        item_ids = item_ids.long()
+        features = torch.zeros(item_ids.shape + (self.num_items,), device=item_ids.device)
+        features.scatter_(-1, item_ids.clamp(max=self.num_items - 1).unsqueeze(-1), 1.0)
+        features[item_ids == self.num_items] = 1.0 # padding placeholder
+        return features
+
+    def __len__(self):
+        return self.shape[0]
+
+    def to(self, *args, **kwargs):
+        # the rows are built on the device of the indexing ids
+        return self
+
+    def float(self):
+        return self
+
+    def to_sparse(self):
+        """
+        Return:
+            features (torch.Tensor): [num_items+1, num_items] sparse COO tensor of the rows (see model/sparse_inputs.ItemTable).
+        """
+        rows = torch.cat((torch.arange(self.num_items), torch.full((self.num_items,), self.num_items)))
+        columns = torch.cat((torch.arange(self.num_items), torch.arange(self.num_items)))
+        return torch.sparse_coo_tensor(torch.stack((rows, columns)), torch.ones(2 * self.num_items), self.shape, check_invariants=True).coalesce()
+
+    def numpy(self):
+        return self[:].numpy()
+
+
+def dataset_metadata(data_folder, dset):
+    """
+    Reads the metadata header of the processed dataset that Dataset loads from (<dset>-store, <dset>-columns or <dset>.pkl, in this order)
+    without loading the data.
+    Return:
+        metadata (dict): {"num_items": int, "feature_dim": int, "splits": {split: {"num_users": int, "num_steps": int, "max_display_size": int}}}
+            where max_display_size is the display set size the Dataset of the split is padded to. None if the processed data has no
+            (up to date) metadata, e.g. it was written by an older version of the dropbox scripts.
+    """
+    store_index_file = os.path.join(data_folder, dset+'-store', 'index.json')
+    columns_index_file = os.path.join(data_folder, dset+'-columns', 'index.json')
+    if os.path.exists(store_index_file):
+        with open(store_index_file) as f:
+            index = json.load(f)
+        if "split_users" not in index or any("split_steps" not in segment for segment in index["segments"]):
+            return None
+        splits = {}
+        for tag, split in enumerate(SPLITS):
+            # the segments are padded to their own display size (see SegmentStore.read_split)
+            segments = [segment for segment in index["segments"] if segment["split_steps"][tag] > 0]
+            splits[split] = {"num_users": index["split_users"][tag], "num_steps": sum(segment["split_steps"][tag] for segment in segments), \
+                "max_display_size": max([segment["display_size"] for segment in segments], default=1)}
+        return {"num_items": index["num_items"], "feature_dim": index.get("feature_dim", index["num_items"]), "splits": splits}
+
+    if os.path.exists(columns_index_file):
+        with open(columns_index_file) as f:
+            index = json.load(f)
+        if "splits" not in index:
+            return None
+        return {"num_items": index["num_items"], "feature_dim": index["num_items"], "splits": {split: index["splits"][str(tag)] for tag, split in enumerate(SPLITS)}}
+
+    # <dset>-meta.json is written by dropbox/process_data.py after the .pkl files
+    meta_file = os.path.join(data_folder, dset+'-meta.json')
+    pkl_files = [os.path.join(data_folder, dset+'.pkl'), os.path.join(data_folder, dset+'-split.pkl')]
+    if not os.path.exists(meta_file) or any(os.path.getmtime(meta_file) < os.path.getmtime(f) for f in pkl_files if os.path.exists(f)):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def dataset_exists(data_folder, dset):
+    """
+    Return:
+        exists (bool): True if data_folder holds a processed dataset dset that Dataset can load (<dset>-store, <dset>-columns or <dset>.pkl),
+            e.g. "yelp", "rsc", "tb" or an update dataset "<dataset>-<tag>" written by incremental.py.
+    """
+    return os.path.exists(os.path.join(data_folder, dset+'-store', 'index.json')) or os.path.exists(os.path.join(data_folder, dset+'-columns', 'index.json')) \
+        or os.path.exists(os.path.join(data_folder, dset+'.pkl'))
+
 
 class Dataset(nn.Module):
-    def __init__(self, data_folder, dset, split="train"):
+    def __init__(self, data_folder, dset, split="train", mmap_cache=False, display_set_size=None, sparse_inputs=False):
         """
         Inputs:
             data_folder (str): location of the datasset folder.
             dset (str): type of the dataset to be used. Can be "yelp", "rsc", "tb"
             split (str): can be "train", "validation", or "test". Determines the returned dataset split. 
+            mmap_cache (bool): if True, the dataset tensors are cached as .npy files in data_folder (<dset>-<split>-tensors/) 
+                and memory mapped. Processes which construct the same Dataset attach to the cached files without copying them.
+            display_set_size (int): if given, the display sets are padded to this size (e.g. the display set size the models were trained with)
+                instead of the largest display set of the split.
+            sparse_inputs (bool): if True, the items are returned as ids instead of their feature vectors, the models look up the
+                features themselves (see GAN.set_item_features). Id i+1 is row i of item_features, id 0 is the zero vector (so that
+                the padding of pad_packed_sequence is the zero vector as for the feature vectors).
+
+        Note that the dataset is stored as a few flat tensors (registered as buffers) instead of nested python lists.
+        Call share_memory() before handing the Dataset to DataLoader workers or other processes so that every process 
+        attaches to the same memory instead of holding its own copy.
+        """
+        super().__init__()
+        assert split in SPLITS
+        self.sparse_inputs = sparse_inputs
+
+        cache_folder = os.path.join(data_folder, dset+'-'+split+'-tensors' + ('' if display_set_size is None else '-d'+str(display_set_size)))
+        if mmap_cache and self._is_cache_valid(cache_folder, [os.path.join(data_folder, dset+'.pkl'), os.path.join(data_folder, dset+'-split.pkl'), \
+            os.path.join(data_folder, dset+'-store', 'index.json'), os.path.join(data_folder, dset+'-columns', 'index.json')]):
+            self._attach_cache(cache_folder)
+            return
+
+        store_folder = os.path.join(data_folder, dset+'-store')
+        columns_folder = os.path.join(data_folder, dset+'-columns')
+        if os.path.exists(os.path.join(store_folder, "index.json")):
+            item_features, lengths, display_item_ids, picked_item_ids, clicked_items_index = self._load_store(store_folder, split)
+        elif os.path.exists(os.path.join(columns_folder, "index.json")):
+            item_features, lengths, display_item_ids, picked_item_ids, clicked_items_index = self._load_columns(columns_folder, split)
+        else:
+            item_features, lengths, display_item_ids, picked_item_ids, clicked_items_index = self._load_pkl(data_folder, dset, split)
+
+        max_display_set_features_length = display_item_ids.shape[1] # will be used to pad display_set_features length to this value to have a tensor
+        if display_set_size is not None:
+            assert max_display_set_features_length <= display_set_size, f"display sets of up to {max_display_set_features_length} items do not fit display_set_size={display_set_size}"
+            display_item_ids = np.pad(display_item_ids, ((0, 0), (0, display_set_size - max_display_set_features_length)), constant_values=-1)
+
+        # Note that we use ones vector as a placeholder for non_displayed items (padded). It is stored as the last row of the item_features.
+        if isinstance(item_features, OneHotItemFeatures):
+            padding_item_id = item_features.num_items # the placeholder row is part of OneHotItemFeatures
+            self.item_features = item_features # --> [num_items+1, num_items], rows are materialized when indexed
+            self.register_buffer("one_hot_num_items", torch.tensor(item_features.num_items)) # restores item_features from the mmap cache
+        else:
+            non_clickable_placeholder_vec = torch.ones(1, item_features.shape[-1])
+            padding_item_id = item_features.shape[0]
+            self.register_buffer("item_features", torch.cat((item_features, non_clickable_placeholder_vec), dim=0)) # --> [num_items+1, feature_dim]
+        display_item_ids[display_item_ids < 0] = padding_item_id
+
+        self.register_buffer("user_offsets", torch.as_tensor(np.concatenate(([0], np.cumsum(lengths))), dtype=torch.int64)) # --> [user+1]
+        self.register_buffer("display_item_ids", torch.from_numpy(display_item_ids)) # --> [num_steps, num_displayed_items]
+        self.register_buffer("picked_item_ids", torch.from_numpy(picked_item_ids)) # --> [num_steps]
+        self.register_buffer("clicked_items_index", torch.from_numpy(clicked_items_index)) # --> [num_steps]
+
+        if mmap_cache:
+            self._write_cache(cache_folder)
+            self._attach_cache(cache_folder)
+
+
+    @staticmethod
+    def _load_pkl(data_folder, dset, split):
+        """
+        Loads the split from <dset>.pkl and <dset>-split.pkl (written by dropbox/process_data.py).
+        Return:
+            item_features (torch.Tensor): [num_items, feature_dim]
+            lengths (list): [user] num_time_steps of every user.
+            display_item_ids (np.ndarray): [num_steps, num_displayed_items] (-1 padded), picked_item_ids (np.ndarray): [num_steps], clicked_items_index (np.ndarray): [num_steps]
         """
-        assert split in ["train", "test", "validation"]
-        data_folder = "./dropbox"
-
         data_filename = os.path.join(data_folder, dset+'.pkl')
         f = open(data_filename, 'rb')
         data_behavior = pickle.load(f)
@@ -37,12 +204,6 @@ class Dataset(nn.Module):
         # data_behavior[user][1][t] is displayed list at time t
         # data_behavior[user][2][t] is picked id at time t
 
-        num_items = len(item_features[0])
-
-        self.clicked_items_index_per_user = [] # --> [user, num_time_steps]
-        self.picked_item_features_per_user = [] # --> [user, num_time_steps, feature_dim]
-        self.display_set_features_per_user = [] # --> [user, num_time_steps, num_displayed_items, feature_dim]
-        
         users = []
         if split == "train":
             users = train_users
@@ -52,58 +213,87 @@ class Dataset(nn.Module):
         else: # test split
             users = test_users
 
-        max_display_set_features_length = 0 # will be used to pad display_set_features length to this value to have a tensor
+        lengths = [len(data_behavior[u][2]) for u in users] # --> [user] num_time_steps of every user
+        max_display_set_features_length = max(len(displayed_item_ids) for u in users for displayed_item_ids in data_behavior[u][1])
+
+        # Flatten (user, time step) into a single dimension
+        num_steps = sum(lengths)
+        display_item_ids = np.full((num_steps, max_display_set_features_length), -1, dtype=np.int64) # --> [num_steps, num_displayed_items]
+        picked_item_ids = np.empty(num_steps, dtype=np.int64) # --> [num_steps]
+        clicked_items_index = np.empty(num_steps, dtype=np.int64) # --> [num_steps] display set index of the clicked item
+        step = 0
         for u in users:
+            for t, displayed_item_ids in enumerate(data_behavior[u][1]): # index on time
+                display_item_ids[step, :len(displayed_item_ids)] = displayed_item_ids
+                picked_item_ids[step] = data_behavior[u][2][t]
+                # create clicked item history in terms of its index in the display_set
+                clicked_items_index[step] = list(displayed_item_ids).index(data_behavior[u][2][t])
+                step += 1
 
-            # create clicked item (real user click) history in terms of its feature representation (dim = feature_dim)
-            picked_item_features = [] # --> [num_time_steps, features]
-            for picked_item_id in data_behavior[u][2]:
-                picked_item_features.append(item_features[picked_item_id])
-            self.picked_item_features_per_user.append(picked_item_features)
+        item_features = torch.as_tensor(np.asarray(item_features), dtype=torch.float32) # --> [num_items, feature_dim]
+        return item_features, lengths, display_item_ids, picked_item_ids, clicked_items_index
 
-            # create display_set history
-            # convert displayed item indices to corresponding item features
-            displayed_item_features_per_time = [] # --> [num_time_steps, num_displayed_items, feature_dim]
-            clicked_items_per_time = [] # --> [num_time_steps]
-            for t, displayed_item_ids in enumerate(data_behavior[u][1]): # index on time
-                # displayed_item_ids = [num_displayed_item]
-                cur_disp_features_list = [] # --> [num_displayed_items, feature_dim]
-                for index, id in enumerate(displayed_item_ids): # index on ids in the given displayed_items
-                    # create clicked item history in terms of its index in the display_set
-                    if id == data_behavior[u][2][t]:
-                        clicked_items_per_time.append(index)
-
-                    # id = int
-                    feature_vec = item_features[id]
-                    cur_disp_features_list.append(feature_vec)
-                displayed_item_features_per_time.append(cur_disp_features_list)
-                if len(cur_disp_features_list) > max_display_set_features_length:
-                    max_display_set_features_length = len(cur_disp_features_list)
-            
-            self.clicked_items_index_per_user.append(clicked_items_per_time)
-            self.display_set_features_per_user.append(displayed_item_features_per_time)
-            
-        # Pad the display_set
-        display_set_feature_dim = len(self.display_set_features_per_user[0][0][0]) # --> [user, num_time_steps, num_displayed_items, feature_dim]
-        temp_display_set_features_per_user = deepcopy(self.display_set_features_per_user)
-        for u_index, u in enumerate(temp_display_set_features_per_user):  # index on user
-            for t_index, t in enumerate(u): #index on num_time_steps (time)
-                if len(t) < max_display_set_features_length:
-                    diff = max_display_set_features_length - len(t)
-                    non_clickable_placeholder_vec = np.ones(display_set_feature_dim) # Note that we use ones vector as a placeholder for non_displayed items (padded)
-                    for i in range(diff):
-                        self.display_set_features_per_user[u_index][t_index].append(non_clickable_placeholder_vec)
-            
-            
-        # print(len(self.clicked_items_index_per_user) , "\t", len(self.picked_item_features_per_user), "\t", len(self.display_set_features_per_user))
-        
-        
+    @staticmethod
+    def _load_store(store_folder, split):
+        """
+        Loads the split from the append-only segment store (see model/segment_store.py), reading across all of its segments.
+        Return: same as _load_pkl (one hot item features are returned as OneHotItemFeatures).
+        """
+        from model.segment_store import SegmentStore # imports pandas, only needed by this source
+        store = SegmentStore(store_folder)
+        lengths, display_item_ids, picked_item_ids, clicked_items_index = store.read_split(SPLITS.index(split))
+        item_features = store.item_features()
+        if item_features is None:
+            item_features = OneHotItemFeatures(store.index["num_items"]) # one hot item features --> [num_items+1, num_items]
+        else:
+            item_features = torch.from_numpy(item_features).float() # dense item features (see SegmentStore.set_item_features) --> [num_items, feature_dim]
+        return item_features, lengths, display_item_ids, picked_item_ids, clicked_items_index
+
+    @staticmethod
+    def _load_columns(columns_folder, split):
+        """
+        Loads the split from the column files of the raw log (see dropbox/ingest_logs.py), only the rows of the split are read.
+        Return: same as _load_pkl (the one hot item features are returned as OneHotItemFeatures).
+        """
+        from model.segment_store import build_time_steps # imports pandas, only needed by this source
+        from model.columnar_log import ColumnarLog
+        log = ColumnarLog(columns_folder)
+        columns = log.read(['session_new_index', 'Time', 'item_new_index', 'is_click'], tr_val_tst=[SPLITS.index(split)])
+        step_user_ids, display_item_ids, picked_item_ids, clicked_items_index = build_time_steps(columns['session_new_index'], columns['Time'], \
+            columns['item_new_index'].astype(np.int64), columns['is_click'] == 1)
+        lengths = np.unique(step_user_ids, return_counts=True)[1]
+        # the one hot dims are the item_new_index values (column files of older versions counted the distinct items instead)
+        assert display_item_ids.max(initial=-1) < log.index["num_items"], f"item_new_index exceeds num_items of {columns_folder}, rerun dropbox/ingest_logs.py"
+        item_features = OneHotItemFeatures(log.index["num_items"]) # one hot item features --> [num_items+1, num_items]
+        return item_features, lengths, display_item_ids, picked_item_ids, clicked_items_index
+
+    @staticmethod
+    def _is_cache_valid(cache_folder, source_files):
+        # the cache has to be newer than the processed dataset files it was built from
+        done_file = os.path.join(cache_folder, "done")
+        if not os.path.exists(done_file):
+            return False
+        return all(os.path.getmtime(done_file) >= os.path.getmtime(f) for f in source_files if os.path.exists(f))
+
+    def _write_cache(self, cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+        for name, buffer in self.named_buffers():
+            np.save(os.path.join(cache_folder, name+'.npy'), buffer.numpy())
+        open(os.path.join(cache_folder, "done"), 'w').close()
+
+    def _attach_cache(self, cache_folder):
+        for name in ["item_features", "one_hot_num_items", "user_offsets", "display_item_ids", "picked_item_ids", "clicked_items_index"]:
+            if not os.path.exists(os.path.join(cache_folder, name+'.npy')): # item_features of dense, one_hot_num_items of one hot items
+                continue
+            # copy-on-write memory map: pages are shared by every process which maps the file
+            self.register_buffer(name, torch.from_numpy(np.load(os.path.join(cache_folder, name+'.npy'), mmap_mode='c')))
+        if hasattr(self, "one_hot_num_items"):
+            self.item_features = OneHotItemFeatures(int(self.one_hot_num_items))
 
-        
 
     def __getitem__(self, index):
         """
-        Returns: tuple of lists (i.e. (list, list, list, list))
+        Returns: tuple of tensors (i.e. (torch.Tensor, torch.Tensor, int, torch.Tensor))
             # clicked_items --> [num_time_steps] display set index of the clicked items by the real user (gt user actions)
             # real_click_history --> [num_time_steps, feature_dim]
             # real_click_history_length --> [num_time_steps]
@@ -111,19 +301,24 @@ class Dataset(nn.Module):
          
         """
         # Note that we index on users
-        clicked_items = self.clicked_items_index_per_user[index]
+        start, end = self.user_offsets[index].item(), self.user_offsets[index+1].item()
+        clicked_items = self.clicked_items_index[start:end]
+
+        real_click_history_length = end - start
+        if self.sparse_inputs:
+            # item ids, the feature vectors are never materialized
+            return clicked_items, self.picked_item_ids[start:end].long() + 1, real_click_history_length, self.display_item_ids[start:end].long() + 1
 
-        real_click_history = self.picked_item_features_per_user[index] # --> [num_time_steps, picked_item_features]
-        real_click_history_length = len(real_click_history) 
+        real_click_history = self.item_features[self.picked_item_ids[start:end]] # --> [num_time_steps, picked_item_features]
         
-        display_set = self.display_set_features_per_user[index]
+        display_set = self.item_features[self.display_item_ids[start:end]] # --> [num_time_steps, num_displayed_item, feature_dim]
 
 
         return clicked_items, real_click_history, real_click_history_length, display_set  
 
 
     def __len__(self):
-        return len(self.picked_item_features_per_user) # = user
+        return len(self.user_offsets) - 1 # = user
 
 
 
@@ -131,7 +326,7 @@ def custom_collate_fn(data):
     """
         Used to create batches with variable sequence lengths. Output will be compatible with LSTMs.
         --
-        Inputs: tuple of lists (i.e. (list, list, list, list))
+        Inputs: tuple of tensors (i.e. (torch.Tensor, torch.Tensor, int, torch.Tensor))
             # clicked_items --> [num_time_steps] display set index of the clicked items by the real user (gt user actions)
             # real_click_history --> [num_time_steps, feature_dim]
             # real_click_history_length --> [num_time_steps]
@@ -153,13 +348,14 @@ def custom_collate_fn(data):
     
     # Create the padded vectors
     batch_size = len(data)
-    feature_dim = len(data[0][1][0])
-    num_displayed_item = len(data[0][3][0])
+    # the items are feature vectors, or item ids (Dataset(sparse_inputs=True)) which are batched as [batch_size, max(num_time_steps)(, num_displayed_item)]
+    item_shape = tuple(data[0][1].shape[1:]) # --> (feature_dim,) or ()
+    display_shape = tuple(data[0][3].shape[1:]) # --> (num_displayed_item, feature_dim) or (num_displayed_item,)
 
     # Create a batch from the inputted data
     padded_clicked_items = torch.zeros(batch_size, max_length) # --> [batch_size, max(num_time_steps)]
-    padded_real_click_history = torch.zeros(batch_size, max_length, feature_dim) # --> [batch_size, max(num_time_steps), feature_dim]
-    padded_display_set = torch.zeros(batch_size, max_length, num_displayed_item, feature_dim) # --> [batch_size, max(num_time_steps), num_displayed_item, feature_dim]
+    padded_real_click_history = torch.zeros((batch_size, max_length) + item_shape, dtype=data[0][1].dtype) # --> [batch_size, max(num_time_steps), feature_dim]
+    padded_display_set = torch.zeros((batch_size, max_length) + display_shape, dtype=data[0][3].dtype) # --> [batch_size, max(num_time_steps), num_displayed_item, feature_dim]
     for i, (clicked_items, real_click_history, real_click_history_length, display_set) in enumerate(data): # index on the batch
         # ************************ Reminder
         # clicked_items --> [num_time_steps] display set index of the clicked items by the real user (gt user actions)
@@ -167,18 +363,18 @@ def custom_collate_fn(data):
         # real_click_history_length --> [num_time_steps]
         # display_set --> [num_time_steps, num_displayed_item, feature_dim] 
         # ************************
-        cur_clicked_items = torch.tensor(clicked_items) # --> [num_time_steps]
+        cur_clicked_items = torch.as_tensor(clicked_items) # --> [num_time_steps]
         # print(real_click_history_length, "\t ", cur_clicked_items.shape)
         padded_clicked_items[i, :real_click_history_length] = cur_clicked_items
         
-        cur_real_click_history = torch.tensor(real_click_history) # --> [num_time_steps, feature_dim]
+        cur_real_click_history = torch.as_tensor(real_click_history) # --> [num_time_steps, feature_dim]
         # print(real_click_history_length, "\t ", cur_real_click_history.shape)
-        padded_real_click_history[i, :real_click_history_length, :] = cur_real_click_history
+        padded_real_click_history[i, :real_click_history_length] = cur_real_click_history
 
-        cur_display_set = torch.tensor(display_set) # --> [num_time_steps, num_displayed_item, feature_dim]
+        cur_display_set = torch.as_tensor(display_set) # --> [num_time_steps, num_displayed_item, feature_dim]
         # print(real_click_history_length, "\t ", cur_display_set.shape)
         # print("True num_displayed_item = ",len(data[0][3][0]), " cur_display_set.shape = ", cur_display_set.shape)
-        padded_display_set[i, :real_click_history_length, :, :] = cur_display_set
+        padded_display_set[i, :real_click_history_length] = cur_display_set
 
 
     # Make padded tensors compatible with LSTMs
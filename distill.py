@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+from copy import deepcopy
+
+import torch
+import yaml
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml, infer_model_dims, build_gan
+from quantize import scoring_latency, evaluate
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Distills the trained user model (teacher) into a compact student (shallow History_GRU and narrow Generator/Discriminator MLPs).')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file of the teacher. The teacher is loaded from the checkpoints given there.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset to distill on.')
+    parser.add_argument('--student_hidden_size', type=int, default=64, help='state_dim of the student History_GRU.')
+    parser.add_argument('--student_num_layers', type=int, default=1, help='Number of recurrent layers of the student History_GRU.')
+    parser.add_argument('--student_n_hidden', type=int, default=1, help='Number of hidden layers of the student Generator/Discriminator MLPs.')
+    parser.add_argument('--student_hidden_dim', type=int, default=64, help='Hidden dimension of the student Generator/Discriminator MLPs.')
+    parser.add_argument('--epochs', type=int, default=10, help='Number of distillation epochs.')
+    parser.add_argument('--lr', type=float, default=0.001, help='Learning rate of the student.')
+    parser.add_argument('--temperature', type=float, default=1.0,
+                        help='Softmax temperature of the click distributions (the scores are tanh outputs in [-1, 1]).')
+    parser.add_argument('--reward_weight', type=float, default=1.0,
+                        help='Weight of the discriminator reward (MSE) term w.r.t. the click distribution (KL) term.')
+    parser.add_argument('--output_dir', type=str, default="checkpoints/student",
+                        help='Folder of the student checkpoints and its config yaml (student_config.yaml).')
+    parser.add_argument('--report', type=str, default="results/distillation_report.json",
+                        help='Path of the teacher vs student fidelity/latency report (json).')
+
+    args = parser.parse_args()
+    return args
+
+
+def student_config(teacher_config_dict, args):
+    """
+    Input:
+        teacher_config_dict (dict): config of the teacher (including the model dims, see infer_model_dims).
+        args (argparse.Namespace): parsed command line arguments.
+    Return:
+        config_dict (dict): config of the student. It can be used with main.py like any other config (e.g. --mode test).
+    """
+    config_dict = deepcopy(teacher_config_dict)
+    config_dict.update({
+        "history_model": "gru",
+        "history_hidden_size": args.student_hidden_size,
+        "history_num_layers": args.student_num_layers,
+        "generator_n_hidden": args.student_n_hidden,
+        "generator_hidden_dim": args.student_hidden_dim,
+        "discriminator_n_hidden": args.student_n_hidden,
+        "discriminator_hidden_dim": args.student_hidden_dim,
+        "history_checkpoint_segments": 0,
+        "generator_checkpoint_segments": 0,
+        "discriminator_checkpoint_segments": 0,
+        "tbptt_window": None,
+        "lr": args.lr,
+        "load_pretrained": False,
+        "ckpt_path": args.output_dir,
+    })
+    config_dict["generator_input_size"] = config_dict["history_hidden_size"] + (config_dict["generator_output_size"] * config_dict["history_input_size"])
+    config_dict["discriminator_input_size"] = config_dict["history_hidden_size"] + (config_dict["discriminator_output_size"] * config_dict["history_input_size"])
+    return config_dict
+
+
+def user_model_outputs(gan, real_click_history, display_set):
+    """
+    Return:
+        action_scores (torch.Tensor): [batch_size (#users), max(num_time_steps), (num_displayed_items+1)] Generator_UserModel scores.
+        rewards (torch.Tensor): [batch_size (#users), max(num_time_steps), (num_displayed_items+1)] Discriminator_RewardModel rewards.
+    """
+    states = gan.history_LSTM(real_click_history)
+    return gan.generator_UserModel(states, display_set), gan.discriminator_RewardModel(states, display_set)
+
+
+def distillation_losses(teacher, student, real_click_history, display_set, temperature):
+    """
+    Input:
+        teacher (GAN), student (GAN): teacher and student models.
+        real_click_history (rnn.PackedSequence), display_set (rnn.PackedSequence): batch as returned by custom_collate_fn.
+        temperature (float): softmax temperature of the click distributions.
+    Return:
+        click_kl (torch.Tensor): KL(teacher || student) of the click distributions, averaged over the valid time steps.
+        reward_mse (torch.Tensor): MSE of the student discriminator rewards w.r.t. the teacher rewards, averaged over the valid time steps.
+        click_agreement (torch.Tensor): fraction of the valid time steps where the student clicks (argmax) the same item as the teacher.
+    """
+    real_click_history = real_click_history.to(teacher.device)
+    display_set = display_set.to(teacher.device)
+    with torch.no_grad():
+        teacher_scores, teacher_rewards = user_model_outputs(teacher, real_click_history, display_set)
+    student_scores, student_rewards = user_model_outputs(student, real_click_history, display_set)
+
+    # only the valid (unpadded) time steps are distilled
+    _, lengths = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
+    mask = (torch.arange(teacher_scores.shape[1])[None, :] < lengths[:, None]).to(teacher.device) # --> [batch_size (#users), max(num_time_steps)]
+
+    teacher_log_probs = torch.nn.functional.log_softmax(teacher_scores[mask] / temperature, dim=-1) # --> [num_valid_steps, (num_displayed_items+1)]
+    student_log_probs = torch.nn.functional.log_softmax(student_scores[mask] / temperature, dim=-1) # --> [num_valid_steps, (num_displayed_items+1)]
+    click_kl = torch.nn.functional.kl_div(student_log_probs, teacher_log_probs, reduction="batchmean", log_target=True) * temperature**2
+    reward_mse = torch.nn.functional.mse_loss(student_rewards[mask], teacher_rewards[mask])
+    click_agreement = (student_log_probs.argmax(-1) == teacher_log_probs.argmax(-1)).float().mean()
+    return click_kl, reward_mse, click_agreement
+
+
+def fidelity(teacher, student, dataloader, temperature):
+    """
+    Return:
+        fidelity (dict): click_kl, reward_mse and click_agreement of the student averaged over the batches of the dataloader.
+    """
+    totals = {"click_kl": 0, "reward_mse": 0, "click_agreement": 0}
+    num_batches = 0
+    with torch.no_grad():
+        for real_click_history, display_set, clicked_items in dataloader:
+            for key, value in zip(totals, distillation_losses(teacher, student, real_click_history, display_set, temperature)):
+                totals[key] += value.item()
+            num_batches += 1
+    return {key: value / num_batches for key, value in totals.items()}
+
+
+def num_parameters(gan):
+    return sum(p.numel() for model in [gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel] for p in model.parameters())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+    assert args.epochs >= 1, f"--epochs has to be >= 1: {args.epochs}"
+
+    train_dataloader = DataLoader(Dataset(args.data_folder, args.dataset, split="train"), batch_size=config_dict['batch_size'], shuffle=True, collate_fn=custom_collate_fn, drop_last=True)
+    val_dataloader = DataLoader(Dataset(args.data_folder, args.dataset, split="validation"), batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True)
+    test_dataloader = DataLoader(Dataset(args.data_folder, args.dataset, split="test"), batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True)
+
+    # Teacher
+    infer_model_dims(config_dict, train_dataloader)
+    teacher = build_gan(config_dict)
+    teacher.load_checkpoints(load_optimizers=False)
+    teacher.config_dict["load_pretrained"] = False # teacher is already loaded, GAN.test must not reload it
+    for model in [teacher.history_LSTM, teacher.generator_UserModel, teacher.discriminator_RewardModel]:
+        model.eval()
+        model.requires_grad_(False)
+
+    # Student
+    student = build_gan(student_config(config_dict, args))
+    student.init_optimizers()
+    optimizers = [student.history_LSTM_optimizer, student.generator_optimizer, student.discriminator_optimizer]
+
+    # the untrained student (epoch 0) is exported if no epoch improves the validation loss (e.g. nan losses)
+    best_val_loss, best_epoch = float("inf"), -1
+    best_state_dicts = [deepcopy(model.state_dict()) for model in [student.history_LSTM, student.generator_UserModel, student.discriminator_RewardModel]]
+    for epoch in range(args.epochs):
+        train_loss = 0
+        for real_click_history, display_set, clicked_items in train_dataloader:
+            click_kl, reward_mse, _ = distillation_losses(teacher, student, real_click_history, display_set, args.temperature)
+            loss = click_kl + args.reward_weight * reward_mse
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            loss.backward()
+            for optimizer in optimizers:
+                optimizer.step()
+            train_loss += loss.item()
+
+        val_fidelity = fidelity(teacher, student, val_dataloader, args.temperature)
+        val_loss = val_fidelity["click_kl"] + args.reward_weight * val_fidelity["reward_mse"]
+        print(f"epoch: [{epoch+1}/{args.epochs}], train_distillation_loss: {train_loss / len(train_dataloader)}, val_distillation_loss: {val_loss}, \
+            val_click_agreement: {val_fidelity['click_agreement']}")
+        if val_loss < best_val_loss:
+            best_val_loss, best_epoch = val_loss, epoch
+            best_state_dicts = [deepcopy(model.state_dict()) for model in [student.history_LSTM, student.generator_UserModel, student.discriminator_RewardModel]]
+
+    # Export the best student as a drop-in replacement of the teacher (same checkpoint format, loadable with its config yaml)
+    for model, state_dict in zip([student.history_LSTM, student.generator_UserModel, student.discriminator_RewardModel], best_state_dicts):
+        model.load_state_dict(state_dict)
+    val_dreal_loss, val_dfake_loss = student.validate(val_dataloader)
+    student.save_checkpoints(max(best_epoch, 0), val_dfake_loss, val_dreal_loss)
+    with open(os.path.join(args.output_dir, "student_config.yaml"), "w") as f:
+        yaml.safe_dump(dict(student.config_dict, load_pretrained=True), f, sort_keys=False)
+    print(f"Saved the student (epoch {best_epoch+1}) to {args.output_dir}")
+
+    # ========== Report: fidelity/latency trade-off of the student
+    report = {"dataset": args.dataset, "best_epoch": best_epoch + 1, "test_fidelity": fidelity(teacher, student, test_dataloader, args.temperature)}
+    for name, gan in [("teacher", teacher), ("student", student)]:
+        report[name] = {
+            "num_parameters": num_parameters(gan),
+            "latency": scoring_latency(gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel, test_dataloader, gan.device),
+            "metrics": evaluate(gan, test_dataloader),
+        }
+    report["speedup"] = report["teacher"]["latency"]["median_s_per_batch"] / report["student"]["latency"]["median_s_per_batch"]
+    report["compression"] = report["teacher"]["num_parameters"] / report["student"]["num_parameters"]
+    report["metric_deltas"] = {key: report["student"]["metrics"][key] - report["teacher"]["metrics"][key] for key in report["teacher"]["metrics"]}
+
+    print("*" * 30)
+    print(f"student vs teacher: {report['speedup']:.2f}x faster, {report['compression']:.2f}x fewer parameters, " \
+        f"test click agreement: {report['test_fidelity']['click_agreement']}")
+    for key, delta in report["metric_deltas"].items():
+        print(f"{key}: teacher = {report['teacher']['metrics'][key]}, student = {report['student']['metrics'][key]} (delta = {delta})")
+    print("*" * 30)
+
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
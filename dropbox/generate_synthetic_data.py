@@ -0,0 +1,75 @@
+import numpy as np
+import argparse
+
+#======================================================================================================
+### Generates a synthetic session log in the same format as the original .txt files (e.g. yelp.txt).
+# Every user (session) sees a display set at every time step and clicks exactly one of the displayed items.
+# The generated file can be processed with process_data.py like the original datasets.
+#======================================================================================================
+
+COLUMNS = ['SessionId', 'Time', 'ItemId', 'is_click', 'raw_index', 'session_new_index', 'item_new_index', 'tr_val_tst']
+
+
+def generate_session_log(filename, num_users, num_items, display_size, session_length, \
+    min_display_size=None, min_session_length=None, split_ratios=(0.6, 0.2, 0.2), seed=0):
+    """
+    Inputs:
+        filename (str): path of the .txt file to write.
+        num_users (int): number of users (sessions).
+        num_items (int): number of unique items in the catalog.
+        display_size (int): (maximum) number of items in a display set.
+        session_length (int): (maximum) number of time steps of a session.
+        min_display_size (int): minimum number of items in a display set. Defaults to display_size (fixed size).
+        min_session_length (int): minimum number of time steps of a session. Defaults to session_length (fixed length).
+        split_ratios (tuple): ratios of the (train, validation, test) users.
+        seed (int): seed of the random number generator.
+    Return:
+        num_rows (int): number of written log rows.
+    """
+    assert num_items >= display_size, "num_items must be at least display_size"
+    assert (min_session_length is None or min_session_length >= 1) and session_length >= 1, "every session needs at least one time step"
+    min_display_size = display_size if min_display_size is None else min_display_size
+    min_session_length = session_length if min_session_length is None else min_session_length
+    rng = np.random.default_rng(seed)
+
+    # assign users to train (0), validation (1), test (2) splits
+    split_tags = rng.choice(3, size=num_users, p=np.asarray(split_ratios) / np.sum(split_ratios))
+
+    # items are indexed by the order of their first appearance (as in the original .txt files)
+    item_new_index = {}
+
+    raw_index = 0
+    time = 0
+    with open(filename, 'w') as f:
+        f.write('\t'.join(COLUMNS) + '\n')
+        for user in range(num_users):
+            session_id = f"session{user}"
+            for _ in range(rng.integers(min_session_length, session_length + 1)):
+                cur_display_size = rng.integers(min_display_size, display_size + 1)
+                displayed_items = rng.choice(num_items, size=cur_display_size, replace=False)
+                clicked_index = rng.integers(cur_display_size)
+                for index, item in enumerate(displayed_items):
+                    if item not in item_new_index:
+                        item_new_index[item] = len(item_new_index)
+                    f.write(f"{session_id}\t{time}\t{'item' + str(item)}\t{int(index == clicked_index)}\t{raw_index}\t{user}\t{item_new_index[item]}\t{split_tags[user]}\n")
+                    raw_index += 1
+                time += 1
+
+    return raw_index
+
+
+if __name__ == "__main__":
+    cmd_opt = argparse.ArgumentParser(description='Argparser for synthetic session log generation')
+    cmd_opt.add_argument('-dataset', type=str, default='synthetic', help='name of the generated dataset (<dataset>.txt is written)')
+    cmd_opt.add_argument('-num_users', type=int, default=1000, help='number of users (sessions)')
+    cmd_opt.add_argument('-num_items', type=int, default=1000, help='number of unique items')
+    cmd_opt.add_argument('-display_size', type=int, default=10, help='maximum number of items in a display set')
+    cmd_opt.add_argument('-min_display_size', type=int, default=None, help='minimum number of items in a display set')
+    cmd_opt.add_argument('-session_length', type=int, default=10, help='maximum number of time steps of a session')
+    cmd_opt.add_argument('-min_session_length', type=int, default=None, help='minimum number of time steps of a session')
+    cmd_opt.add_argument('-seed', type=int, default=0, help='random seed')
+    cmd_args = cmd_opt.parse_args()
+    print(cmd_args)
+
+    generate_session_log('./'+cmd_args.dataset+'.txt', cmd_args.num_users, cmd_args.num_items, cmd_args.display_size, cmd_args.session_length, \
+        min_display_size=cmd_args.min_display_size, min_session_length=cmd_args.min_session_length, seed=cmd_args.seed)
@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+#======================================================================================================
+### Converts a raw session log (.txt, same format as yelp.txt) to typed NumPy column files.
+# The log is split into line aligned byte ranges which are parsed by a pool of threads, the string
+# SessionId/ItemId hashes are dictionary encoded (int32 codes, first appearance order) and the rows are
+# de-duplicated with sorts over the integer columns instead of pandas drop_duplicates/sort_values.
+#
+# <dset>-columns/
+#     index.json       number of rows/sessions, number of items (max item_new_index + 1, the one hot dims), column dtypes, the row range of every tr_val_tst value and its number of
+#                      sessions, time steps and largest display set
+#     <column>.npy     one file per column, rows sorted by (tr_val_tst, session_new_index, Time, is_click)
+#     SessionId.txt    dictionary of the SessionId column, line i is the raw id of code i
+#     ItemId.txt       dictionary of the ItemId column, line i is the raw id of code i
+#
+# The rows of a tr_val_tst value are contiguous, so reading one split (predicate pushdown) only touches
+# its row range of the memory mapped column files (see model/columnar_log.py, which data.py reads them with).
+#======================================================================================================
+
+STRING_COLUMNS = ['SessionId', 'ItemId']
+INT_COLUMNS = {'Time': np.int64, 'is_click': np.int8, 'session_new_index': np.int32, 'item_new_index': np.int32, 'tr_val_tst': np.int8}
+
+
+def _line_aligned_ranges(filename, num_chunks):
+    """
+    Return:
+        header (list): column names of the log.
+        ranges (list): [(start, end)] byte ranges of the data rows, every range starts and ends at a line boundary.
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        header = f.readline().decode().rstrip('\r\n').split('\t')
+        boundaries = [f.tell()]
+        for i in range(1, num_chunks):
+            f.seek(max(boundaries[-1], size * i // num_chunks))
+            f.readline() # move to the start of the next line
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    return header, [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def _read_chunk(filename, header, start, end):
+    """
+    Parses the byte range [start, end) of the log and dictionary encodes its string columns.
+    Return:
+        columns (dict): column name --> np.ndarray (the string columns hold the codes of the chunk dictionary).
+        dictionaries (dict): string column name --> np.ndarray chunk dictionary (unique raw ids).
+    """
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    usecols = STRING_COLUMNS + list(INT_COLUMNS)
+    data = pd.read_csv(io.BytesIO(chunk), sep='\t', header=None, names=header, usecols=usecols, \
+        dtype={**{name: str for name in STRING_COLUMNS}, **INT_COLUMNS}, engine='c')
+    columns = {name: data[name].to_numpy() for name in INT_COLUMNS}
+    dictionaries = {}
+    for name in STRING_COLUMNS:
+        columns[name], dictionaries[name] = pd.factorize(data[name])
+    return columns, dictionaries
+
+
+def read_log(filename, num_threads=os.cpu_count()):
+    """
+    Input:
+        filename (str): raw session log (.txt).
+        num_threads (int): number of reader threads (and byte ranges) the log is parsed with.
+    Return:
+        columns (dict): column name --> np.ndarray [rows] in log order (SessionId and ItemId as int32 codes).
+        dictionaries (dict): SessionId/ItemId --> np.ndarray raw id of every code (first appearance order).
+    """
+    header, ranges = _line_aligned_ranges(filename, max(1, num_threads))
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+        chunks = list(pool.map(lambda byte_range: _read_chunk(filename, header, *byte_range), ranges))
+
+    columns = {name: np.concatenate([c[name] for c, _ in chunks]).astype(dtype) for name, dtype in INT_COLUMNS.items()}
+    dictionaries = {}
+    for name in STRING_COLUMNS:
+        # merge the chunk dictionaries: re-encode the chunk uniques and map every chunk code to its global code
+        global_codes, dictionaries[name] = pd.factorize(np.concatenate([d[name] for _, d in chunks]))
+        offsets = np.cumsum([0] + [len(d[name]) for _, d in chunks])
+        columns[name] = np.concatenate([global_codes[offset:][c[name]] for (c, _), offset in zip(chunks, offsets)]).astype(np.int32)
+    return columns, dictionaries
+
+
+def sort_rows(keys):
+    """
+    Input:
+        keys (list): integer np.ndarray [rows] sort keys, the first key is the most significant.
+    Return:
+        order (np.ndarray): stable sort order of the rows.
+    The keys are packed into a single int64 key when their value ranges fit, one stable sort of it is much faster than np.lexsort.
+    """
+    lows = [int(key.min()) if len(key) else 0 for key in keys]
+    ranges = [int(key.max()) - low + 1 if len(key) else 1 for key, low in zip(keys, lows)]
+    if np.prod([float(r) for r in ranges]) >= 2**62:
+        return np.lexsort(keys[::-1])
+    packed = np.zeros(len(keys[0]), dtype=np.int64)
+    for key, low, r in zip(keys, lows, ranges):
+        packed = packed * r + (key.astype(np.int64) - low)
+    return np.argsort(packed, kind='stable')
+
+
+def deduplicate(columns):
+    """
+    Input:
+        columns (dict): log columns (see read_log) in log order.
+    Return:
+        rows (np.ndarray): indices of the kept rows sorted by (tr_val_tst, session_new_index, Time, is_click, log order).
+        split (np.ndarray): [len(rows)] split (tr_val_tst) of the session of every kept row.
+    Same de-duplication as process_data.py: one row per (session_new_index, Time, item_new_index), the clicked row wins
+    (otherwise the last row of the log). The clicked item is the last item of its display set.
+    """
+    sessions, times, items, is_click = columns['session_new_index'], columns['Time'], columns['item_new_index'], columns['is_click']
+    order = sort_rows([sessions, times, items, is_click]) # stable: log order among equal keys
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (sessions[order[1:]] != sessions[order[:-1]]) | (times[order[1:]] != times[order[:-1]]) | (items[order[1:]] != items[order[:-1]])
+    rows = np.sort(order[last])
+
+    # the split of a session is the tr_val_tst of its first row
+    unique_sessions, first_row = np.unique(sessions, return_index=True)
+    split = columns['tr_val_tst'][first_row][np.searchsorted(unique_sessions, sessions[rows])]
+    order = sort_rows([split, sessions[rows], times[rows], is_click[rows]])
+    return rows[order], split[order]
+
+
+def ingest_log(filename, folder, num_threads=os.cpu_count()):
+    """
+    Input:
+        filename (str): raw session log (.txt).
+        folder (str): output folder of the column files (<dset>-columns).
+        num_threads (int): number of reader/writer threads.
+    Return:
+        index (dict): contents of the written index.json.
+    """
+    columns, dictionaries = read_log(filename, num_threads)
+    num_raw_rows = len(columns['Time'])
+    rows, split = deduplicate(columns)
+    columns = {name: values[rows] for name, values in columns.items()}
+    columns['tr_val_tst'] = split
+    split_bounds = np.searchsorted(columns['tr_val_tst'], [0, 1, 2, 3])
+
+    # metadata of every split (display sets are the runs of equal (session_new_index, Time))
+    sessions, times = columns['session_new_index'], columns['Time']
+    new_session = np.ones(len(rows), dtype=bool)
+    new_session[1:] = sessions[1:] != sessions[:-1]
+    new_step = new_session.copy()
+    new_step[1:] |= times[1:] != times[:-1]
+    step_starts = np.flatnonzero(new_step)
+    display_sizes = np.diff(np.append(step_starts, len(rows))) # --> [num_steps]
+    step_splits = columns['tr_val_tst'][step_starts]
+    split_metadata = {str(tag): {"num_users": int(np.count_nonzero(new_session[split_bounds[tag]:split_bounds[tag+1]])),
+        "num_steps": int(np.count_nonzero(step_splits == tag)), "max_display_size": int(display_sizes[step_splits == tag].max(initial=1))} for tag in range(3)}
+
+    index = {"source": os.path.basename(filename), "num_raw_rows": int(num_raw_rows), "num_rows": int(len(rows)),
+        "num_sessions": int(len(np.unique(columns['session_new_index']))), "num_items": int(columns['item_new_index'].max(initial=-1)) + 1,
+        "columns": {name: str(values.dtype) for name, values in columns.items()},
+        "sorted_by": ['tr_val_tst', 'session_new_index', 'Time', 'is_click'],
+        "tr_val_tst_ranges": {str(tag): [int(split_bounds[tag]), int(split_bounds[tag+1])] for tag in range(3)}, "splits": split_metadata}
+
+    os.makedirs(folder, exist_ok=True)
+    if os.path.exists(os.path.join(folder, "index.json")):
+        os.remove(os.path.join(folder, "index.json"))
+    def write(name):
+        np.save(os.path.join(folder, name + '.npy'), columns[name])
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+        list(pool.map(write, columns))
+    for name in STRING_COLUMNS:
+        with open(os.path.join(folder, name + '.txt'), 'w') as f:
+            f.writelines(raw_id + '\n' for raw_id in dictionaries[name])
+    # index.json is written last, a folder without it is an incomplete ingestion
+    with open(os.path.join(folder, "index.json"), 'w') as f:
+        json.dump(index, f, indent=4)
+    return index
+
+
+if __name__ == "__main__":
+    cmd_opt = argparse.ArgumentParser(description='Converts a raw session log to typed NumPy column files')
+    cmd_opt.add_argument('-dataset', type=str, default=None, help='choose rsc, tb, or yelp (reads ./<dataset>.txt, writes ./<dataset>-columns)')
+    cmd_opt.add_argument('-threads', type=int, default=os.cpu_count(), help='number of reader/writer threads')
+    cmd_args = cmd_opt.parse_args()
+    print(cmd_args)
+
+    index = ingest_log('./'+cmd_args.dataset+'.txt', './'+cmd_args.dataset+'-columns', cmd_args.threads)
+    print(f"{cmd_args.dataset}-columns: {index['num_rows']} rows ({index['num_raw_rows']} raw), {index['num_sessions']} sessions, {index['num_items']} items")
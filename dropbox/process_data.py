@@ -1,5 +1,6 @@
 import numpy as np
 import pickle
+import json
 import pandas as pd
 import argparse
 
@@ -41,6 +42,7 @@ test_user = []
 
 sum_length = 0
 event_cnt = 0
+split_metadata = [{"num_users": 0, "num_steps": 0, "max_display_size": 1} for _ in range(3)] # per tr_val_tst value
 
 for user in range(size_user):
     data_behavior[user] = [[], [], []]
@@ -58,11 +60,15 @@ for user in range(size_user):
     time_set = np.array(list(set(data_u['Time'])))
     time_set.sort()
 
+    split_metadata[split_tag]["num_users"] += 1
+    split_metadata[split_tag]["num_steps"] += len(time_set)
+
     true_t = 0
     for t in range(len(time_set)):
         display_set = data_u_time.get_group(time_set[t])
         event_cnt += 1
         sum_length += len(display_set)
+        split_metadata[split_tag]["max_display_size"] = max(split_metadata[split_tag]["max_display_size"], len(display_set))
 
         data_behavior[user][1].append(list(display_set['item_new_index']))
         data_behavior[user][2].append(int(display_set[display_set.is_click==1]['item_new_index']))
@@ -81,3 +87,11 @@ pickle.dump(train_user, file, protocol=pickle.HIGHEST_PROTOCOL)
 pickle.dump(vali_user, file, protocol=pickle.HIGHEST_PROTOCOL)
 pickle.dump(test_user, file, protocol=pickle.HIGHEST_PROTOCOL)
 file.close()
+
+# Metadata header (read by data.dataset_metadata, e.g. to infer the model dims without loading the data). Written last,
+# it is only used if it is newer than the .pkl files.
+filename = './'+cmd_args.dataset+'-meta.json'
+file = open(filename, 'w')
+json.dump({"num_items": int(size_item), "feature_dim": int(new_features.shape[1]),
+    "splits": {split: {key: int(value) for key, value in split_metadata[tag].items()} for tag, split in enumerate(["train", "validation", "test"])}}, file, indent=4)
+file.close()
@@ -0,0 +1,21 @@
+import argparse
+import os
+import sys
+
+# the store is implemented in model/segment_store.py (it is read by data.py), this script only ingests logs into it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from model.segment_store import SegmentStore
+
+
+if __name__ == "__main__":
+    cmd_opt = argparse.ArgumentParser(description='Appends raw session logs to the processed segment store of a dataset')
+    cmd_opt.add_argument('-dataset', type=str, default=None, help='choose rsc, tb, or yelp (the store is written to ./<dataset>-store)')
+    cmd_opt.add_argument('-logs', type=str, nargs='+', default=None, help='raw session logs to ingest (default: ./<dataset>.txt)')
+    cmd_args = cmd_opt.parse_args()
+    print(cmd_args)
+
+    store = SegmentStore('./'+cmd_args.dataset+'-store')
+    for filename in (cmd_args.logs or ['./'+cmd_args.dataset+'.txt']):
+        segment = store.append_log(filename)
+        print(f"{filename} --> {segment['name']}: {segment['num_users']} users, {segment['num_steps']} time steps")
+    print(f"{cmd_args.dataset}-store: {store.index['num_users']} users, {store.index['num_items']} items, {len(store.index['segments'])} segments")
@@ -0,0 +1,212 @@
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import deepcopy
+
+import torch
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml, infer_model_dims_from_checkpoints, build_gan
+
+# Collated test batches shared by the worker processes (set by init_worker): (dataset, display_set_size) --> (item_features, batches)
+_TEST_SETS = None
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Evaluates a set of checkpoints on the test split of a set of datasets in parallel.')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file. The checkpoint file names (pretrained_*_path), k and batch_size are taken from here.')
+    parser.add_argument('--checkpoints', type=str, nargs='+', required=True,
+                        help='Checkpoint folders (or glob patterns of folders, e.g. "checkpoints/run_*") that hold the three checkpoint files.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset files.')
+    parser.add_argument('--datasets', type=str, nargs='+', default=["yelp"],
+                        help='Datasets (["yelp", "rsc", "tb"] or update datasets "<dataset>-<tag>" of incremental.py) whose test split every checkpoint is evaluated on.')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of checkpoints evaluated concurrently (worker processes).')
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='Number of torch threads used by every worker.')
+    parser.add_argument('--output', type=str, default="results/checkpoint_sweep.csv",
+                        help='Path of the comparison table (csv, one row per checkpoint and dataset).')
+
+    args = parser.parse_args()
+    return args
+
+
+def expand_checkpoints(patterns, config_dict):
+    """
+    Return:
+        ckpt_paths (list): checkpoint folders matching the patterns that hold the generator checkpoint (in the given order, without duplicates).
+    """
+    ckpt_paths = []
+    for pattern in patterns:
+        for ckpt_path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.exists(os.path.join(ckpt_path, config_dict["pretrained_generator_path"])) and ckpt_path not in ckpt_paths:
+                ckpt_paths.append(ckpt_path)
+    return ckpt_paths
+
+
+def load_test_set(data_folder, dset, display_set_size, config_dict):
+    """
+    Loads the test split once and collates its batches (as main.py does in the test mode), the tensors are moved to shared memory.
+    Return:
+        item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features.
+        batches (list): [(real_click_history, display_set, clicked_items)] collated test batches.
+    """
+    dataset = Dataset(data_folder, dset, split="test", mmap_cache=config_dict.get('mmap_dataset', False), display_set_size=display_set_size, \
+        sparse_inputs=config_dict.get('sparse_inputs', False))
+    dataset.share_memory()
+    batches = list(DataLoader(dataset, batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True))
+    for batch in batches:
+        for packed in batch:
+            for tensor in packed:
+                if tensor is not None:
+                    tensor.share_memory_()
+    return dataset.item_features, batches
+
+
+def init_worker(test_sets, threads_per_worker):
+    """
+    Initializes a worker process. Note that the test batches live in shared memory, so every worker attaches to
+    the same copy (with the "fork" start method they are inherited, otherwise only their shared memory handles are pickled).
+    """
+    global _TEST_SETS
+    _TEST_SETS = test_sets
+    torch.set_num_threads(threads_per_worker)
+
+
+def evaluate_checkpoint(config_dict, dset, display_set_size):
+    """
+    Input:
+        config_dict (dict): configuration whose ckpt_path points to the checkpoint folder, with the model dims of the checkpoints.
+        dset (str), display_set_size (int): key of the shared test set.
+    Return:
+        result (dict): test losses and Prec@k of the checkpoint.
+    """
+    start_time = time.perf_counter()
+    item_features, batches = _TEST_SETS[(dset, display_set_size)]
+    gan = build_gan(config_dict)
+    loaded_epoch, _, dfake_loaded_loss = gan.load_checkpoints(load_optimizers=False)
+    if config_dict.get('sparse_inputs', False):
+        gan.set_item_features(item_features)
+    test_dreal_loss, test_dfake_loss, metrics = gan.test_metrics(batches)
+    return {
+        "epoch": loaded_epoch,
+        "val_dfake_loss": None if dfake_loaded_loss is None else float(dfake_loaded_loss),
+        "test_dreal_loss": float(test_dreal_loss),
+        "test_dfake_loss": float(test_dfake_loss),
+        **metrics,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+def write_results(rows, k_values, filename):
+    """
+    Writes the comparison table (one row per checkpoint and dataset, ranked by the test fake loss within every dataset) as csv.
+    """
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    fieldnames = ["dataset", "rank", "checkpoint", "epoch", "test_dfake_loss", "test_dreal_loss"] + [f"discriminator_prec@{k}" for k in k_values] + \
+        ["generator_prec@1", "val_dfake_loss", "seconds", "error"]
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def rank_results(rows):
+    """
+    Return:
+        rows (list): rows sorted by dataset and test fake loss (the loss the best checkpoints are selected by during training), failed evaluations last.
+    """
+    rows = sorted(rows, key=lambda r: (r["dataset"], "error" in r, r.get("test_dfake_loss", 0)))
+    for dset in set(r["dataset"] for r in rows):
+        for rank, row in enumerate(r for r in rows if r["dataset"] == dset and "error" not in r):
+            row["rank"] = rank + 1
+    return rows
+
+
+def checkpoint_sweep(args, config_dict):
+    """
+    Input:
+        args (argparse.Namespace): parsed command line arguments.
+        config_dict (dict): dictionary containing the information in the config yaml file.
+    Return:
+        rows (list): results of every (checkpoint, dataset), see rank_results.
+    """
+    # Model dims of every checkpoint, the test split is padded to the display set size of the checkpoint
+    jobs = [] # (config_dict, dataset, display_set_size)
+    rows = []
+    for ckpt_path in expand_checkpoints(args.checkpoints, config_dict):
+        ckpt_config_dict = deepcopy(config_dict)
+        ckpt_config_dict["ckpt_path"] = ckpt_path
+        infer_model_dims_from_checkpoints(ckpt_config_dict)
+        for dset in args.datasets:
+            jobs.append((ckpt_config_dict, dset, ckpt_config_dict["generator_output_size"] - 1))
+    assert jobs, f"no checkpoints found in {args.checkpoints}"
+
+    # Load every test split only once (per display set size), it is shared by all of the checkpoints
+    test_sets = {}
+    for ckpt_config_dict, dset, display_set_size in jobs:
+        key = (dset, display_set_size)
+        if key not in test_sets:
+            try:
+                test_sets[key] = load_test_set(args.data_folder, dset, display_set_size, config_dict)
+            except AssertionError as error: # display sets of the split do not fit the checkpoint
+                test_sets[key] = error
+    pending = []
+    for ckpt_config_dict, dset, display_set_size in jobs:
+        row = {"checkpoint": ckpt_config_dict["ckpt_path"], "dataset": dset}
+        test_set = test_sets[(dset, display_set_size)]
+        if isinstance(test_set, AssertionError):
+            row["error"] = str(test_set)
+        elif test_set[0].shape[-1] != ckpt_config_dict["history_input_size"]:
+            row["error"] = f"feature_dim of the checkpoint ({ckpt_config_dict['history_input_size']}) does not match the {dset} dataset ({test_set[0].shape[-1]})"
+        else:
+            pending.append((ckpt_config_dict, dset, display_set_size))
+        rows.append(row)
+    test_sets = {key: test_set for key, test_set in test_sets.items() if not isinstance(test_set, AssertionError)}
+    mp_context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+
+    with ProcessPoolExecutor(max_workers=min(args.num_workers, max(len(pending), 1)), mp_context=mp_context, initializer=init_worker, \
+        initargs=(test_sets, args.threads_per_worker)) as executor:
+        futures = {executor.submit(evaluate_checkpoint, *job): job for job in pending}
+        for future in as_completed(futures):
+            ckpt_config_dict, dset, _ = futures[future]
+            row = next(r for r in rows if r["checkpoint"] == ckpt_config_dict["ckpt_path"] and r["dataset"] == dset)
+            try:
+                row.update(future.result())
+                print(f"checkpoint: {row['checkpoint']}, dataset: {dset}, test_dfake_loss: {row['test_dfake_loss']}, " \
+                    f"generator_prec@1: {row['generator_prec@1']}, seconds: {row['seconds']:.1f}")
+            except Exception as error:
+                row["error"] = repr(error)
+                print(f"checkpoint: {row['checkpoint']}, dataset: {dset}, failed: {row['error']}")
+
+    rows = rank_results(rows)
+    write_results(rows, config_dict["k"], args.output)
+    return rows
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    for dset in args.datasets:
+        assert dataset_exists(args.data_folder, dset), f"no processed dataset {dset} in {args.data_folder}"
+
+    start_time = time.perf_counter()
+    rows = checkpoint_sweep(args, config_dict)
+
+    columns = ["rank", "test_dfake_loss", "test_dreal_loss"] + [f"discriminator_prec@{k}" for k in config_dict["k"]] + ["generator_prec@1"]
+    print("*" * 30)
+    for dset in args.datasets:
+        print(f"Dataset: {dset}")
+        print("\t".join(columns + ["checkpoint"]))
+        for row in rows:
+            if row["dataset"] == dset:
+                values = ["-" if column not in row else (f"{row[column]:.4f}" if isinstance(row[column], float) else str(row[column])) for column in columns]
+                print("\t".join(values + [row["checkpoint"] + (f" ({row['error']})" if "error" in row else "")]))
+    print(f"Evaluated {len(rows)} (checkpoint, dataset) pairs in {time.perf_counter() - start_time:.1f}s, results: {args.output}")
+    print("*" * 30)
@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml, infer_model_dims, build_gan
+from model.ope import logged_steps, inclusion_propensities, causal_states, single_item_click_probs, policy_probs, step_estimates, \
+    per_user, bootstrap, simulate_returns
+
+
+POLICIES = ["uniform", "popularity", "logging", "user_model"]
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Offline evaluation of recommendation policies on the logged display sets (IPS, SNIPS, DR, simulator).')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file. The models are loaded from the checkpoints given there.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset to use.')
+    parser.add_argument('--split', type=str, default="test", help='Logged split the policies are evaluated on.')
+    parser.add_argument('--policies', type=str, nargs='+', default=POLICIES,
+                        help=f'Policies to evaluate, any of {POLICIES}: uniform over the catalog, train click popularity, the logged display '
+                             'frequencies, and the click probabilities of the user model (Generator_UserModel).')
+    parser.add_argument('--temperature', type=float, default=1.0, help='Softmax temperature of the policy scores.')
+    parser.add_argument('--max_weight', type=float, default=None, help='Clip the importance weights to this value.')
+    parser.add_argument('--bootstrap_samples', type=int, default=1000, help='Number of bootstrap resamples (of the users).')
+    parser.add_argument('--alpha', type=float, default=0.05, help='The confidence intervals cover 1-alpha.')
+    parser.add_argument('--num_simulations', type=int, default=4, help='Number of simulated sessions per user (0 disables the simulator).')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the bootstrap and the simulator.')
+    parser.add_argument('--report', type=str, default="results/ope_report.json", help='Path of the report (json).')
+
+    args = parser.parse_args()
+    return args
+
+
+def cache_last_call(fn):
+    """
+    Return:
+        fn that returns the cached result if it is called again with the same (identical) states tensor.
+    """
+    cache = {}
+    def cached(states):
+        if cache.get("states") is not states:
+            cache["states"], cache["result"] = states, fn(states)
+        return cache["result"]
+    return cached
+
+
+def build_policies(names, train_dataset, propensities, user_model_scores):
+    """
+    Return:
+        policies (dict): name --> policy (callable: states [num_states, state_dim] --> scores [num_states, num_items]).
+    """
+    num_items = propensities.shape[0]
+    popularity = torch.log1p(torch.bincount(train_dataset.picked_item_ids.long(), minlength=num_items).double())
+    policies = {
+        "uniform": lambda states: torch.zeros(states.shape[0], num_items, dtype=torch.float64),
+        "popularity": lambda states: popularity.expand(states.shape[0], -1),
+        "logging": lambda states: torch.log(propensities).expand(states.shape[0], -1),
+        "user_model": lambda states: torch.logit(user_model_scores(states).double(), eps=1e-6),
+    }
+    return {name: policies[name] for name in names}
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+
+    train_dataset = Dataset(args.data_folder, args.dataset, split="train")
+    dataset = Dataset(args.data_folder, args.dataset, split=args.split)
+    infer_model_dims(config_dict, DataLoader(dataset, batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn))
+    gan = build_gan(config_dict)
+    gan.load_checkpoints(load_optimizers=False)
+    for model in [gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel]:
+        model.eval()
+    num_displayed_items = config_dict["generator_output_size"] - 1
+
+    # ========== Logged time steps, propensities, states before every click and the user model's click probabilities
+    start = time.perf_counter()
+    steps = logged_steps(dataset)
+    num_users = len(dataset)
+    propensities = inclusion_propensities(steps["display_item_ids"], steps["num_items"])
+    states = causal_states(gan.history_LSTM, dataset, config_dict['batch_size'], gan.device)
+    # the catalog wide click probabilities are the reward model of DM/DR and the scores of the user_model policy (computed once)
+    user_model_scores = cache_last_call(lambda states: single_item_click_probs(gan.generator_UserModel, states, dataset.item_features, num_displayed_items))
+    reward_model = user_model_scores(states) # --> [num_steps, num_items]
+    policies = build_policies(args.policies, train_dataset, propensities, user_model_scores)
+    report = {"dataset": args.dataset, "split": args.split, "num_users": num_users, "num_steps": int(steps["picked_item_ids"].shape[0]),
+        "num_items": steps["num_items"], "temperature": args.temperature, "max_weight": args.max_weight, "alpha": args.alpha,
+        "setup_s": time.perf_counter() - start, "policies": {}}
+
+    lengths = dataset.user_offsets[1:] - dataset.user_offsets[:-1]
+    for name, policy in policies.items():
+        start = time.perf_counter()
+        probs = policy_probs(policy(states), args.temperature)
+        estimates = step_estimates(probs, steps, propensities, reward_model, args.max_weight)
+        result = {estimator: bootstrap(per_user(numerator, steps["step_users"], num_users), per_user(denominator, steps["step_users"], num_users), \
+            args.bootstrap_samples, args.alpha, args.seed) for estimator, (numerator, denominator) in estimates.items()}
+        if args.num_simulations > 0:
+            clicks = simulate_returns(gan.history_LSTM, gan.generator_UserModel, policy, dataset.item_features, lengths, num_displayed_items, \
+                args.temperature, args.num_simulations, args.seed)
+            result["simulator"] = bootstrap(clicks, lengths.double(), args.bootstrap_samples, args.alpha, args.seed)
+        result["elapsed_s"] = time.perf_counter() - start
+        report["policies"][name] = result
+        print(f"{name}: " + ", ".join(f"{estimator} {r['estimate']:.4f} [{r['ci_low']:.4f}, {r['ci_high']:.4f}]" \
+            for estimator, r in result.items() if estimator != "elapsed_s"))
+
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+
+import torch
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml, infer_model_dims, build_gan
+from model.inference import StaticUserModel, to_static_inputs, export_torchscript, export_onnx
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Exports the trained user model (History_LSTM, Generator_UserModel, Discriminator_RewardModel) as a static shape inference model.')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file. The models are loaded from the checkpoints given there.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset the models were trained on.')
+    parser.add_argument('--formats', type=str, nargs='+', default=["torchscript", "onnx"],
+                        help='Export formats, any of ["torchscript", "onnx"]. ONNX export requires the onnx package.')
+    parser.add_argument('--time_steps', type=int, default=None,
+                        help='Number of time steps of the static input shape. Defaults to the longest session of the test split.')
+    parser.add_argument('--output_dir', type=str, default="exported",
+                        help='Folder to write the exported models and their metadata (<dataset>-inference.json) into.')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+    for export_format in args.formats:
+        assert export_format in ["torchscript", "onnx"], f"unknown export format: {export_format}"
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    test_dataset = Dataset(args.data_folder, args.dataset, split="test")
+    test_dataloader = DataLoader(test_dataset, batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True)
+    infer_model_dims(config_dict, test_dataloader)
+    gan = build_gan(config_dict)
+    gan.load_checkpoints(load_optimizers=False)
+
+    # exported models run on the CPU
+    num_displayed_items = config_dict["generator_output_size"] - 1
+    feature_dim = config_dict["history_input_size"]
+    model = StaticUserModel(gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel, num_displayed_items, feature_dim).cpu().eval()
+
+    time_steps = args.time_steps or int((test_dataset.user_offsets[1:] - test_dataset.user_offsets[:-1]).max())
+    real_click_history, display_set, clicked_items = next(iter(test_dataloader))
+    click_history, display_set_padded, lengths = to_static_inputs(real_click_history, display_set, time_steps)
+    example_inputs = (click_history, display_set_padded)
+
+    # sanity check: the static model reproduces the eager models on the valid time steps
+    with torch.no_grad():
+        action_scores, rewards = model(*example_inputs)
+        real_states = gan.history_LSTM(real_click_history.to(gan.device))
+        eager_action_scores = gan.generator_UserModel(real_states, display_set.to(gan.device)).cpu()
+        eager_rewards = gan.discriminator_RewardModel(real_states, display_set.to(gan.device)).cpu()
+    batch_time_steps = eager_rewards.shape[1]
+    mask = torch.arange(batch_time_steps)[None, :] < lengths[:, None] # --> [batch_size (#users), max(num_time_steps)]
+    max_abs_diff = max((action_scores[:, :batch_time_steps] - eager_action_scores)[mask].abs().max().item(),
+        (rewards[:, :batch_time_steps] - eager_rewards)[mask].abs().max().item())
+    print(f"max abs difference of the static model to the eager models: {max_abs_diff}")
+
+    metadata = {
+        "dataset": args.dataset,
+        "batch_size": config_dict["batch_size"],
+        "time_steps": time_steps,
+        "num_displayed_items": num_displayed_items,
+        "feature_dim": feature_dim,
+        "state_dim": config_dict["history_hidden_size"],
+        "inputs": {"click_history": ["batch_size", "time_steps", "feature_dim"], "display_set": ["batch_size", "time_steps", "num_displayed_items", "feature_dim"]},
+        "outputs": {"action_scores": ["batch_size", "time_steps", "num_displayed_items+1"], "rewards": ["batch_size", "time_steps", "num_displayed_items+1"]},
+        "max_abs_diff_to_eager": max_abs_diff,
+        "files": {},
+    }
+    if "torchscript" in args.formats:
+        filename = os.path.join(args.output_dir, f"{args.dataset}-user_model.pt")
+        traced = export_torchscript(model, example_inputs, filename)
+        metadata["files"]["torchscript"] = os.path.basename(filename)
+        print(f"Saved TorchScript model to {filename}")
+    if "onnx" in args.formats:
+        filename = os.path.join(args.output_dir, f"{args.dataset}-user_model.onnx")
+        try:
+            export_onnx(model, example_inputs, filename)
+            metadata["files"]["onnx"] = os.path.basename(filename)
+            print(f"Saved ONNX model to {filename}")
+        except ImportError as e:
+            print(f"Skipping the ONNX export: {e}")
+
+    with open(os.path.join(args.output_dir, f"{args.dataset}-inference.json"), "w") as f:
+        json.dump(metadata, f, indent=4)
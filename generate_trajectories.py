@@ -0,0 +1,295 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import torch
+
+from data import Dataset, SPLITS, dataset_exists
+from main import parse_config_yaml, infer_model_dims_from_checkpoints, build_gan
+from model.segment_store import SegmentStore, write_segment
+
+#======================================================================================================
+### Bulk generation of synthetic click logs with the trained user model (History_LSTM + Generator_UserModel), e.g. for
+# offline RL or data augmentation. Sessions are rolled out in batches: at every time step a display set is drawn (replayed
+# from the logged display sets of the source dataset, or uniform over the catalog), the Generator_UserModel scores it given the
+# state of the clicks so far and the click is sampled from the softmax of the scores of the displayed items (the processed
+# format needs a clicked item at every time step, so the "not clicking" slot is not sampled). The sampled click updates the state.
+#
+# Note that the rollout is causal: the display set of time step t is scored with the state of the clicks before t (a zero state at
+# t=0), while training (GAN.adversarial_step) scores it with the History_LSTM output of the click history up to and including the
+# click of t. That state is not available before the click is sampled, so the generated sessions come from a shifted input
+# distribution of the Generator_UserModel, most of all at t=0, where the zero state is never seen in training.
+#
+# The sessions are split into shards that worker processes generate independently. Every shard is seeded by (seed, shard), so the
+# output only depends on the seed, the shard and batch sizes (not on the number of workers), and written as one segment of a
+# segment store (see model/segment_store.py) <output_folder>/<dataset>-store, which data.Dataset reads like any processed dataset:
+#   $ python main.py --data_folder <output_folder> --dataset <dataset>
+# Only the shards in flight are held in memory.
+#======================================================================================================
+
+# Rollout state shared by the worker processes (set by init_worker)
+_ROLLOUT = None
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Generates a sharded synthetic click log with the trained user model.')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file. The models are loaded from the checkpoints given there.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the source dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Source dataset (item features, logged display sets and session lengths).')
+    parser.add_argument('--source_split', type=str, default="train", help='Split whose display sets and session lengths are replayed.')
+    parser.add_argument('--output_folder', type=str, default="./synthetic",
+                        help='The synthetic log is written as the segment store <output_folder>/<dataset>-store.')
+    parser.add_argument('--num_sessions', type=int, default=1000000, help='Number of generated sessions (users).')
+    parser.add_argument('--sessions_per_shard', type=int, default=50000, help='Number of sessions of every shard (segment).')
+    parser.add_argument('--batch_size', type=int, default=1024, help='Number of sessions rolled out together.')
+    parser.add_argument('--display_sets', type=str, default="replay",
+                        help='either ["replay", "uniform"]: display sets sampled from the logged ones, or uniform random items.')
+    parser.add_argument('--session_length', type=int, default=None,
+                        help='Number of time steps of every session. Sampled from the logged session lengths if not given.')
+    parser.add_argument('--temperature', type=float, default=1.0, help='Softmax temperature of the click sampling.')
+    parser.add_argument('--split_ratios', type=float, nargs=3, default=[0.8, 0.1, 0.1], help='Ratios of the (train, validation, test) users.')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of worker processes (shards generated concurrently).')
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='Number of torch threads used by every worker.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generation.')
+    parser.add_argument('--report', type=str, default="results/trajectory_report.json", help='Path of the throughput report (json).')
+
+    args = parser.parse_args()
+    return args
+
+
+def shard_generator(seed, shard):
+    """
+    Return:
+        rng (torch.Generator): random number generator of the shard, seeded by (seed, shard).
+    """
+    state = np.random.SeedSequence([seed, shard]).generate_state(2, dtype=np.uint32)
+    return torch.Generator().manual_seed((int(state[0]) << 31) ^ int(state[1]))
+
+
+def uniform_display_sets(num_sets, display_size, num_items, rng):
+    """
+    Return:
+        display_item_ids (torch.Tensor): [num_sets, display_size] distinct random items per display set.
+    """
+    display_item_ids = torch.randint(num_items, (num_sets, display_size), generator=rng)
+    while True:
+        sorted_ids, _ = display_item_ids.sort(dim=1)
+        duplicates = (sorted_ids[:, 1:] == sorted_ids[:, :-1]).any(1)
+        if not duplicates.any():
+            return display_item_ids
+        display_item_ids[duplicates] = torch.randint(num_items, (int(duplicates.sum()), display_size), generator=rng)
+
+
+def rollout(history_model, generator, encode, display_pool, display_size, lengths, padding_id, temperature, rng):
+    """
+    Input:
+        history_model (History_LSTM/History_GRU), generator (Generator_UserModel): trained user model.
+        encode (callable): item ids [*] --> model inputs (feature vectors [*, feature_dim], or the shifted ids for sparse inputs).
+        display_pool (torch.Tensor): [num_display_sets, num_displayed_items] logged display sets to replay (padded with padding_id),
+            None for uniform display sets.
+        display_size (int): num_displayed_items of the user model (generator_output_size - 1).
+        lengths (torch.Tensor): [batch_size] number of time steps of every session.
+        padding_id (int): item id of the padding (= number of items).
+    Return:
+        display_item_ids (torch.Tensor): [batch_size, max(lengths), num_displayed_items] display set of every time step (padding_id padded).
+        clicked_items_index (torch.Tensor): [batch_size, max(lengths)] display set index of the sampled clicks.
+    The time steps after the length of a session are rolled out too (the batch runs to the longest session) and dropped by the caller.
+    """
+    batch_size = lengths.shape[0]
+    state = torch.zeros(batch_size, history_model.state_dim, device=generator.device) # zero state at the first time step (no click yet, see the note above)
+    hidden = None
+    display_item_ids, clicked_items_index = [], []
+    with torch.no_grad():
+        for t in range(int(lengths.max())):
+            if display_pool is None:
+                display = uniform_display_sets(batch_size, display_size, padding_id, rng)
+            else:
+                display = display_pool[torch.randint(display_pool.shape[0], (batch_size,), generator=rng)] # --> [batch_size, num_displayed_items]
+            scores = generator.mlp(state, encode(display))[:, :-1] # --> [batch_size, num_displayed_items] (without the "not clicking" slot)
+            scores = (scores.cpu() / temperature).masked_fill(display == padding_id, float("-inf"))
+            clicked = torch.multinomial(torch.softmax(scores, dim=-1), 1, generator=rng) # --> [batch_size, 1]
+            picked = display.gather(1, clicked) # --> [batch_size, 1]
+            out, hidden = history_model(encode(picked), hidden, return_hidden=True) # --> [batch_size, 1, state_dim]
+            state = out[:, -1]
+            display_item_ids.append(display)
+            clicked_items_index.append(clicked.squeeze(1))
+    return torch.stack(display_item_ids, dim=1), torch.stack(clicked_items_index, dim=1)
+
+
+def init_worker(rollout_state, threads_per_worker):
+    """
+    Initializes a worker process. Note that the models and the source tensors are inherited with the "fork" start method,
+    otherwise they are pickled once per worker.
+    """
+    global _ROLLOUT
+    _ROLLOUT = rollout_state
+    torch.set_num_threads(threads_per_worker)
+
+
+def generate_shard(shard, first_user, num_sessions, options):
+    """
+    Input:
+        shard (int): index of the shard (its segment is seg-<shard>).
+        first_user (int): user index of the first session of the shard.
+        num_sessions (int): number of sessions of the shard.
+        options (dict): store_folder, seed, batch_size, session_length, temperature, split_ratios and source of the generation.
+    Return:
+        segment (dict): index entry of the written segment (see model/segment_store.write_segment).
+        new_users (list): [(SessionId, split)] of the users of the shard.
+        seconds (float): generation time of the shard.
+    """
+    start_time = time.perf_counter()
+    history_model, generator, encode, display_pool, display_size, source_lengths, padding_id = _ROLLOUT
+    rng = shard_generator(options["seed"], shard)
+    if options["session_length"] is None:
+        lengths = source_lengths[torch.randint(source_lengths.shape[0], (num_sessions,), generator=rng)] # --> [num_sessions]
+    else:
+        lengths = torch.full((num_sessions,), options["session_length"], dtype=torch.int64)
+    user_splits = torch.multinomial(torch.tensor(options["split_ratios"], dtype=torch.float64), num_sessions, replacement=True, generator=rng) # --> [num_sessions]
+
+    arrays = {"step_user_ids": [], "display_item_ids": [], "picked_item_ids": [], "clicked_items_index": []}
+    for start in range(0, num_sessions, options["batch_size"]):
+        batch_lengths = lengths[start:start + options["batch_size"]]
+        display_item_ids, clicked_items_index = rollout(history_model, generator, encode, display_pool, display_size, batch_lengths, padding_id, options["temperature"], rng)
+        valid = torch.arange(display_item_ids.shape[1])[None, :] < batch_lengths[:, None] # --> [batch_size, max(lengths)], user major order
+        users = torch.arange(first_user + start, first_user + start + batch_lengths.shape[0])[:, None].expand_as(valid)
+        arrays["step_user_ids"].append(users[valid])
+        arrays["display_item_ids"].append(display_item_ids[valid])
+        arrays["picked_item_ids"].append(display_item_ids.gather(2, clicked_items_index.unsqueeze(-1)).squeeze(-1)[valid])
+        arrays["clicked_items_index"].append(clicked_items_index[valid])
+    arrays = {name: torch.cat(values).numpy() for name, values in arrays.items()}
+    arrays["display_item_ids"][arrays["display_item_ids"] == padding_id] = -1 # the store pads the display sets with -1
+
+    segment = write_segment(options["store_folder"], f"seg-{shard:05d}", options["source"], arrays["step_user_ids"], arrays["display_item_ids"], \
+        arrays["picked_item_ids"], arrays["clicked_items_index"], user_splits.numpy()[arrays["step_user_ids"] - first_user])
+    new_users = [(f"synthetic{first_user + u}", split) for u, split in enumerate(user_splits.tolist())]
+    return segment, new_users, time.perf_counter() - start_time
+
+
+def load_rollout_state(config_dict, dataset, display_sets, session_length):
+    """
+    Return:
+        rollout_state (tuple): (history_model, generator, encode, display_pool, display_size, source_lengths, padding_id) used by generate_shard.
+    """
+    infer_model_dims_from_checkpoints(config_dict)
+    gan = build_gan(config_dict)
+    gan.load_checkpoints(load_optimizers=False)
+    history_model, generator = gan.history_LSTM.eval(), gan.generator_UserModel.eval()
+    item_features = dataset.item_features # --> [num_items+1, feature_dim], the last row is the padding placeholder
+    padding_id = item_features.shape[0] - 1
+    assert item_features.shape[-1] == config_dict["history_input_size"], \
+        f"feature_dim of the checkpoints ({config_dict['history_input_size']}) does not match the dataset ({item_features.shape[-1]})"
+
+    if config_dict.get("sparse_inputs", False):
+        gan.set_item_features(item_features)
+        encode = lambda ids: ids + 1 # see Dataset(sparse_inputs=True)
+    else:
+        encode = lambda ids: item_features[ids].to(generator.device)
+
+    display_size = config_dict["generator_output_size"] - 1
+    display_pool = None
+    if display_sets == "replay":
+        display_pool = dataset.display_item_ids.long()
+        assert display_pool.shape[1] <= display_size, f"display sets of up to {display_pool.shape[1]} items do not fit the user model ({display_size})"
+        display_pool = torch.nn.functional.pad(display_pool, (0, display_size - display_pool.shape[1]), value=padding_id)
+    source_lengths = dataset.user_offsets[1:] - dataset.user_offsets[:-1] # --> [num_users]
+    return history_model, generator, encode, display_pool, display_size, source_lengths, padding_id
+
+
+def source_items(data_folder, dset, num_items):
+    """
+    Return:
+        item_names (list): raw ItemId of every item if the source is a segment store, otherwise the item indices.
+        one_hot (bool): True if the Dataset of the source uses one hot item features (segment store or column files, see data.Dataset).
+    """
+    store_folder = os.path.join(data_folder, dset+'-store')
+    if os.path.exists(os.path.join(store_folder, "index.json")):
+        store = SegmentStore(store_folder)
+        return list(store.item_ids()), store.item_features() is None
+    return [str(i) for i in range(num_items)], os.path.exists(os.path.join(data_folder, dset+'-columns', 'index.json'))
+
+
+def generate_trajectories(args, config_dict):
+    """
+    Input:
+        args (argparse.Namespace): parsed command line arguments.
+        config_dict (dict): dictionary containing the information in the config yaml file.
+    Return:
+        report (dict): number of generated sessions/time steps, wall time and throughput of the generation.
+    """
+    start_time = time.perf_counter()
+    store_folder = os.path.join(args.output_folder, args.dataset+'-store')
+    store = SegmentStore(store_folder)
+    assert not store.index["segments"], f"{store_folder} already holds a dataset, remove it or choose another --output_folder"
+
+    dataset = Dataset(args.data_folder, args.dataset, split=args.source_split)
+    dataset.share_memory()
+    rollout_state = load_rollout_state(config_dict, dataset, args.display_sets, args.session_length)
+    num_items = dataset.item_features.shape[0] - 1
+    item_names, one_hot = source_items(args.data_folder, args.dataset, num_items)
+    new_items = item_names # one hot features: the items are added with the first segment
+    if not one_hot:
+        store.set_item_features(dataset.item_features[:-1].numpy(), item_names)
+        new_items = []
+
+    options = {"store_folder": store_folder, "seed": args.seed, "batch_size": args.batch_size, "session_length": args.session_length, \
+        "temperature": args.temperature, "split_ratios": args.split_ratios, \
+            "source": f"{args.dataset} user model ({config_dict['ckpt_path']}), {args.display_sets} display sets, seed {args.seed}"}
+    shards = [(shard, first_user, min(args.sessions_per_shard, args.num_sessions - first_user)) \
+        for shard, first_user in enumerate(range(0, args.num_sessions, args.sessions_per_shard))]
+    mp_context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+
+    # The segments are committed in shard order, at most 2*num_workers shards are in flight (bounded memory)
+    finished = {} # shard --> (segment, new_users, seconds)
+    next_commit, num_steps, shard_seconds = 0, 0, []
+    pending = {} # future --> shard
+    with ProcessPoolExecutor(max_workers=args.num_workers, mp_context=mp_context, initializer=init_worker, \
+        initargs=(rollout_state, args.threads_per_worker)) as executor:
+        queued = iter(shards)
+        while True:
+            for shard, first_user, num_sessions in queued:
+                pending[executor.submit(generate_shard, shard, first_user, num_sessions, options)] = shard
+                if len(pending) >= 2 * args.num_workers:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished[pending.pop(future)] = future.result()
+            while next_commit in finished:
+                segment, new_users, seconds = finished.pop(next_commit)
+                store.commit_segment(segment, new_items=new_items if next_commit == 0 else [], new_users=new_users)
+                next_commit += 1
+                num_steps += segment["num_steps"]
+                shard_seconds.append(seconds)
+                elapsed = time.perf_counter() - start_time
+                print(f"{segment['name']}: {segment['num_users']} sessions, {segment['num_steps']} time steps in {seconds:.1f}s " \
+                    f"(total: {store.index['num_users']}/{args.num_sessions} sessions, {store.index['num_users'] / elapsed:.0f} sessions/s, {num_steps / elapsed:.0f} time steps/s)")
+
+    seconds = time.perf_counter() - start_time
+    return {"store": store_folder, "num_sessions": store.index["num_users"], "num_steps": num_steps, "num_shards": len(shards), \
+        "split_users": dict(zip(SPLITS, store.index["split_users"])), "num_workers": args.num_workers, "threads_per_worker": args.threads_per_worker, \
+            "batch_size": args.batch_size, "seconds": seconds, "sessions_per_second": store.index["num_users"] / seconds, "steps_per_second": num_steps / seconds, \
+                "shard_seconds": shard_seconds}
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+    assert args.display_sets in ["replay", "uniform"]
+    assert args.source_split in SPLITS
+
+    report = generate_trajectories(args, config_dict)
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Generated {report['num_sessions']} sessions ({report['num_steps']} time steps) in {report['seconds']:.1f}s: " \
+        f"{report['sessions_per_second']:.0f} sessions/s, {report['steps_per_second']:.0f} time steps/s. Report: {args.report}")
@@ -0,0 +1,296 @@
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from copy import deepcopy
+
+import torch
+import yaml
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml, infer_model_dims, build_gan
+
+
+# Search space over the existing config.yaml keys.
+# Every entry is either {"choice": [values]}, {"uniform": [low, high]} or {"loguniform": [low, high]}.
+DEFAULT_SEARCH_SPACE = {
+    "history_hidden_size": {"choice": [64, 128, 256, 512]},
+    "history_num_layers": {"choice": [1, 2, 4, 8]},
+    "generator_n_hidden": {"choice": [1, 2, 4, 8]},
+    "generator_hidden_dim": {"choice": [64, 128, 256, 512]},
+    "discriminator_n_hidden": {"choice": [1, 2, 4, 8]},
+    "discriminator_hidden_dim": {"choice": [64, 128, 256, 512]},
+    "lr": {"loguniform": [0.0001, 0.003]},
+    "betas": {"choice": [[0.3, 0.999], [0.5, 0.999], [0.9, 0.999]]},
+    "batch_size": {"choice": [8, 16, 32, 64]},
+}
+
+# Datasets shared by the worker processes (set by init_worker)
+_DATASETS = None
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter search with asynchronous successive halving (ASHA).')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file. Keys which are not searched are taken from here.')
+    parser.add_argument('--search_space', type=str, default=None,
+                        help='Path of a yaml file defining the search space (see DEFAULT_SEARCH_SPACE for the format).')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset to use for initializing the DataLoaders.')
+    parser.add_argument('--num_trials', type=int, default=32, help='Number of sampled hyperparameter configurations.')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of trials trained concurrently (worker processes).')
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='Number of torch threads used by every worker.')
+    parser.add_argument('--min_epochs', type=int, default=1, help='Epochs trained by every trial before the first halving.')
+    parser.add_argument('--max_epochs', type=int, default=27, help='Maximum number of epochs a trial is trained for.')
+    parser.add_argument('--reduction_factor', type=int, default=3,
+                        help='Only the best 1/reduction_factor trials of a rung are promoted to the next rung.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed used for sampling the configurations and initializing the trials.')
+    parser.add_argument('--work_dir', type=str, default="checkpoints/hparam_search",
+                        help='Folder in which the trial checkpoints are stored between rungs.')
+    parser.add_argument('--output', type=str, default="results/hparam_search_results.csv",
+                        help='Path of the results table (csv, one row per trial and rung).')
+
+    args = parser.parse_args()
+    return args
+
+
+def sample_config(base_config_dict, search_space, rng):
+    """
+    Input:
+        base_config_dict (dict): dictionary containing the information in the config yaml file.
+        search_space (dict): search space (see DEFAULT_SEARCH_SPACE).
+        rng (random.Random): random number generator.
+    Return:
+        config_dict (dict): copy of the base_config_dict with the searched keys sampled from the search space.
+    """
+    config_dict = deepcopy(base_config_dict)
+    for key, space in search_space.items():
+        if "choice" in space:
+            config_dict[key] = deepcopy(rng.choice(space["choice"]))
+        elif "uniform" in space:
+            config_dict[key] = rng.uniform(*space["uniform"])
+        elif "loguniform" in space:
+            low, high = space["loguniform"]
+            config_dict[key] = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            raise ValueError(f"unknown search space for {key}: {space}")
+    return config_dict
+
+
+class ASHAScheduler():
+    def __init__(self, min_epochs, max_epochs, reduction_factor):
+        """
+        Inputs:
+            min_epochs (int): epochs of the first rung.
+            max_epochs (int): epochs of the last rung.
+            reduction_factor (int): only the best 1/reduction_factor trials of a rung get promoted.
+        """
+        assert min_epochs >= 1 and max_epochs >= min_epochs and reduction_factor >= 2
+        self.reduction_factor = reduction_factor
+        self.rung_epochs = [] # --> [num_rungs] number of epochs a trial has trained for when it completes a rung
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rung_epochs.append(epochs)
+            epochs *= reduction_factor
+        self.rung_epochs.append(max_epochs)
+
+        self.rung_results = [dict() for _ in self.rung_epochs] # rung_results[rung][trial_id] = objective
+        self.promoted = [set() for _ in self.rung_epochs] # trials promoted out of every rung
+
+    def report(self, trial_id, rung, objective):
+        if objective is None or math.isnan(objective):
+            objective = math.inf
+        self.rung_results[rung][trial_id] = objective
+
+    def next_promotion(self):
+        """
+        Return:
+            (trial_id, rung) of a trial which can be promoted to the given rung, None if no trial can be promoted.
+        Note that the top rungs are checked first so that the most promising trials are continued as soon as possible.
+        """
+        for rung in reversed(range(len(self.rung_epochs) - 1)):
+            completed = sorted(self.rung_results[rung].items(), key=lambda x: x[1])
+            num_promotable = len(completed) // self.reduction_factor
+            for trial_id, objective in completed[:num_promotable]:
+                if trial_id not in self.promoted[rung]:
+                    self.promoted[rung].add(trial_id)
+                    return trial_id, rung + 1
+        return None
+
+
+def init_worker(datasets, threads_per_worker):
+    """
+    Initializes a worker process. Note that the dataset tensors live in shared memory, so every worker attaches to
+    the same copy (with the "fork" start method they are inherited, otherwise only their shared memory handles are pickled).
+    """
+    global _DATASETS
+    _DATASETS = datasets
+    torch.set_num_threads(threads_per_worker)
+
+
+def run_trial(trial_id, config_dict, start_epoch, end_epoch, ckpt_file, seed):
+    """
+    Input:
+        trial_id (int): id of the trial.
+        config_dict (dict): sampled configuration of the trial.
+        start_epoch (int): number of epochs the trial was already trained for (its state is loaded from ckpt_file if > 0).
+        end_epoch (int): number of epochs the trial is trained for after this call.
+        ckpt_file (str): file used to store the trial state between rungs.
+        seed (int): seed of the trial.
+    Return:
+        result (dict): training and validation losses of the trial after end_epoch epochs.
+    """
+    start_time = time.perf_counter()
+    torch.manual_seed(seed + trial_id)
+    train_dataset, val_dataset = _DATASETS
+    train_dataloader = DataLoader(train_dataset, batch_size=config_dict['batch_size'], shuffle=True, collate_fn=custom_collate_fn, drop_last=True)
+    val_dataloader = DataLoader(val_dataset, batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True)
+
+    infer_model_dims(config_dict, train_dataloader)
+    gan = build_gan(config_dict)
+    gan.init_optimizers()
+    gan.prepare_training(train_dataset)
+    if start_epoch > 0:
+        state = torch.load(ckpt_file, map_location=gan.device)
+        for model, optimizer, key in [(gan.history_LSTM, gan.history_LSTM_optimizer, "history_LSTM"), \
+            (gan.generator_UserModel, gan.generator_optimizer, "generator_UserModel"), \
+                (gan.discriminator_RewardModel, gan.discriminator_optimizer, "discriminator_RewardModel")]:
+            model.load_state_dict(state[key]["state_dict"])
+            optimizer.load_state_dict(state[key]["optimizer_state_dict"])
+        gan.optimizer_steps.update(state["optimizer_steps"]) # the lr warmup continues across the rungs
+
+    for epoch in range(start_epoch, end_epoch):
+        cur_dreal_loss = 0 # total loss for cur epoch
+        cur_dfake_loss = 0 # total loss for cur epoch
+        for real_click_history, display_set, clicked_items in train_dataloader:
+            dreal_loss, dfake_loss = gan.train_step(real_click_history, display_set, clicked_items)
+            if dfake_loss is not None:
+                cur_dreal_loss += dreal_loss
+                cur_dfake_loss += dfake_loss
+        gan.flush_accumulated_gradients() # step on the remaining micro-batches of the epoch
+    val_dreal_loss, val_dfake_loss = gan.validate(val_dataloader)
+
+    state = {key: {"state_dict": model.state_dict(), "optimizer_state_dict": optimizer.state_dict()} \
+        for model, optimizer, key in [(gan.history_LSTM, gan.history_LSTM_optimizer, "history_LSTM"), \
+            (gan.generator_UserModel, gan.generator_optimizer, "generator_UserModel"), \
+                (gan.discriminator_RewardModel, gan.discriminator_optimizer, "discriminator_RewardModel")]}
+    state["optimizer_steps"] = dict(gan.optimizer_steps)
+    torch.save(state, ckpt_file)
+
+    # Validation losses are summed over the batches, normalize by the number of validated users to compare batch sizes
+    num_val_users = max(len(val_dataloader) * config_dict['batch_size'], 1)
+    return {
+        "trial_id": trial_id,
+        "epochs": end_epoch,
+        "objective": float(val_dfake_loss) / num_val_users,
+        "val_dreal_loss": float(val_dreal_loss),
+        "val_dfake_loss": float(val_dfake_loss),
+        "train_dreal_loss": float(cur_dreal_loss),
+        "train_dfake_loss": float(cur_dfake_loss),
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+def write_results(rows, search_space, scheduler, filename):
+    """
+    Writes the results table (one row per trial and rung) as csv.
+    """
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    fieldnames = ["trial_id", "rung", "epochs", "status", "objective", "val_dreal_loss", "val_dfake_loss", \
+        "train_dreal_loss", "train_dfake_loss", "seconds"] + list(search_space)
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        for row in sorted(rows, key=lambda r: (r["trial_id"], r["rung"])):
+            row = dict(row)
+            if row["rung"] == len(scheduler.rung_epochs) - 1:
+                row["status"] = "completed"
+            elif row["trial_id"] in scheduler.promoted[row["rung"]]:
+                row["status"] = "promoted"
+            else:
+                row["status"] = "stopped"
+            writer.writerow(row)
+
+
+def hparam_search(args, base_config_dict, search_space):
+    """
+    Input:
+        args (argparse.Namespace): parsed command line arguments.
+        base_config_dict (dict): dictionary containing the information in the config yaml file.
+        search_space (dict): search space (see DEFAULT_SEARCH_SPACE).
+    Return:
+        rows (list): results of every (trial, rung).
+    """
+    rng = random.Random(args.seed)
+    scheduler = ASHAScheduler(args.min_epochs, args.max_epochs, args.reduction_factor)
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    # Load the datasets only once, they are shared by all of the trials
+    datasets = (Dataset(args.data_folder, args.dataset, split="train", mmap_cache=base_config_dict.get('mmap_dataset', False)), \
+        Dataset(args.data_folder, args.dataset, split="validation", mmap_cache=base_config_dict.get('mmap_dataset', False)))
+    for dataset in datasets:
+        dataset.share_memory()
+    mp_context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+
+    trial_configs = {}
+    rows = []
+    pending = {} # future --> (trial_id, rung)
+    with ProcessPoolExecutor(max_workers=args.num_workers, mp_context=mp_context, initializer=init_worker, \
+        initargs=(datasets, args.threads_per_worker)) as executor:
+        while True:
+            # Fill the free workers, promotions are preferred over starting new trials
+            while len(pending) < args.num_workers:
+                job = scheduler.next_promotion()
+                if job is None and len(trial_configs) < args.num_trials:
+                    job = (len(trial_configs), 0)
+                    trial_configs[job[0]] = sample_config(base_config_dict, search_space, rng)
+                if job is None:
+                    break
+                trial_id, rung = job
+                start_epoch = 0 if rung == 0 else scheduler.rung_epochs[rung - 1]
+                future = executor.submit(run_trial, trial_id, deepcopy(trial_configs[trial_id]), start_epoch, scheduler.rung_epochs[rung], \
+                    os.path.join(args.work_dir, f"trial_{trial_id}.pth.tar"), args.seed)
+                pending[future] = (trial_id, rung)
+
+            if len(pending) == 0:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial_id, rung = pending.pop(future)
+                result = future.result()
+                scheduler.report(trial_id, rung, result["objective"])
+                result["rung"] = rung
+                result.update({key: trial_configs[trial_id][key] for key in search_space})
+                rows.append(result)
+                print(f"trial: {trial_id}, rung: {rung}, epochs: {result['epochs']}, objective: {result['objective']}, seconds: {result['seconds']:.1f}")
+                write_results(rows, search_space, scheduler, args.output)
+
+    write_results(rows, search_space, scheduler, args.output)
+    return rows
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    base_config_dict = parse_config_yaml(args.config_path)
+    base_config_dict["load_pretrained"] = False
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+
+    search_space = DEFAULT_SEARCH_SPACE
+    if args.search_space is not None:
+        search_space = parse_config_yaml(args.search_space)
+
+    rows = hparam_search(args, base_config_dict, search_space)
+
+    best = min(rows, key=lambda r: (-r["epochs"], r["objective"]))
+    print("*" * 30)
+    print(f"Best trial: {best['trial_id']}, epochs: {best['epochs']}, objective: {best['objective']}")
+    print(yaml.dump({key: best[key] for key in search_space}, default_flow_style=None))
+    print("*" * 30)
@@ -0,0 +1,227 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from torch.utils.data import DataLoader
+
+from data import Dataset, OneHotItemFeatures, custom_collate_fn
+from main import parse_config_yaml, infer_model_dims_from_checkpoints, build_gan
+from model.segment_store import SegmentStore, build_time_steps, write_segment
+
+STEP_ARRAYS = ["step_user_ids", "display_item_ids", "picked_item_ids", "clicked_items_index"]
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Incremental fine-tuning of the trained models on new session logs.')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file. Training starts from the checkpoints given there.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset files.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='Name of the latest processed dataset (e.g. "yelp", or the output of a previous update "yelp-update1"). Its item features are extended.')
+    parser.add_argument('--new_log', type=str, required=True,
+                        help='Session log (.txt, same format as yelp.txt) with the new sessions. item_new_index continues the item index of the dataset, '
+                             'larger indices are unseen items.')
+    parser.add_argument('--tag', type=str, default="update",
+                        help='The update is written as the segment store of the dataset <dataset>-<tag> (new sessions + replay sessions, extended item features).')
+    parser.add_argument('--replay_datasets', type=str, nargs='*', default=None,
+                        help='Datasets whose train users are sampled for replay. Defaults to --dataset.')
+    parser.add_argument('--replay_ratio', type=float, default=1.0, help='Number of replayed old train users per new train user.')
+    parser.add_argument('--max_replay', type=int, default=1000, help='Maximum number of replayed old train users.')
+    parser.add_argument('--epochs', type=int, default=1, help='Number of epochs over the new (and replayed) sessions.')
+    parser.add_argument('--output_ckpt_path', type=str, default=None,
+                        help='Folder to save the updated checkpoints into. Defaults to the ckpt_path of the config (the latest checkpoints are replaced).')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the replay sample.')
+
+    args = parser.parse_args()
+    return args
+
+
+def process_session_log(filename):
+    """
+    Input:
+        filename (str): session log (.txt) in the format of the original datasets (see dropbox/process_data.py).
+    Return:
+        steps (dict): per time step arrays of the sessions, the users are renumbered from 0 (see model/segment_store.build_time_steps):
+            step_user_ids [num_steps], display_item_ids [num_steps, max_display_size] (-1 padded), picked_item_ids [num_steps], clicked_items_index [num_steps].
+        user_splits (np.ndarray): [num_users] split of every user (0: train, 1: validation, 2: test).
+        num_items (int): number of items referenced by the log (max item_new_index + 1).
+    Same processing as dropbox/process_data.py, restricted to the given log.
+    """
+    raw_data = pd.read_csv(filename, sep='\t', usecols=[1, 3, 5, 7, 6], dtype={1: int, 3: int, 7: int, 5:int, 6:int})
+    raw_data.drop_duplicates(subset=['session_new_index','Time','item_new_index','is_click'], inplace=True)
+    raw_data.sort_values(by='is_click', inplace=True, kind='stable')
+    raw_data.drop_duplicates(keep='last', subset=['session_new_index','Time','item_new_index'], inplace=True)
+
+    sessions, user_ids = np.unique(raw_data['session_new_index'].to_numpy(), return_inverse=True)
+    user_splits = np.zeros(len(sessions), dtype=np.int64)
+    user_splits[user_ids] = raw_data['tr_val_tst'].to_numpy()
+    steps = build_time_steps(user_ids, raw_data['Time'].to_numpy(), raw_data['item_new_index'].to_numpy(), raw_data['is_click'].to_numpy() == 1)
+    return dict(zip(STEP_ARRAYS, steps)), user_splits, int(raw_data['item_new_index'].max()) + 1
+
+
+def concat_steps(parts):
+    """
+    Input:
+        parts (list): per time step arrays (see process_session_log) whose users are numbered from 0.
+    Return:
+        steps (dict): the concatenated arrays, the users of every part continue the user ids of the previous parts and the display sets are -1 padded to the largest one.
+    """
+    num_users = np.cumsum([0] + [len(np.unique(part["step_user_ids"])) for part in parts])
+    max_display_size = max(part["display_item_ids"].shape[1] for part in parts)
+    return {"step_user_ids": np.concatenate([part["step_user_ids"] + offset for part, offset in zip(parts, num_users)]),
+        "display_item_ids": np.concatenate([np.pad(part["display_item_ids"], ((0, 0), (0, max_display_size - part["display_item_ids"].shape[1])), \
+            constant_values=-1) for part in parts]),
+        "picked_item_ids": np.concatenate([part["picked_item_ids"] for part in parts]),
+        "clicked_items_index": np.concatenate([part["clicked_items_index"] for part in parts])}
+
+
+def sample_replay_steps(datasets, num_users, rng):
+    """
+    Input:
+        datasets (list): train split Datasets (memory mapped, see Dataset(mmap_cache=True)) whose users are sampled uniformly.
+        num_users (int): number of sampled users (at most all of them).
+    Return:
+        steps (dict): per time step arrays of the sampled users (see process_session_log).
+    Only the time steps of the sampled users are read (located by Dataset.user_offsets), the splits are never loaded as a whole.
+    """
+    dataset_offsets = np.cumsum([0] + [len(dataset) for dataset in datasets])
+    sample = np.sort(rng.choice(dataset_offsets[-1], size=min(num_users, dataset_offsets[-1]), replace=False))
+    parts = []
+    for dataset, first_user, end_user in zip(datasets, dataset_offsets[:-1], dataset_offsets[1:]):
+        users = sample[(sample >= first_user) & (sample < end_user)] - first_user
+        user_offsets = dataset.user_offsets.numpy()
+        lengths = user_offsets[users + 1] - user_offsets[users]
+        # rows of the time steps of the sampled users
+        steps = np.repeat(user_offsets[users], lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        display_item_ids = dataset.display_item_ids.numpy()[steps]
+        display_item_ids[display_item_ids == dataset.item_features.shape[0] - 1] = -1 # padding placeholder
+        parts.append({"step_user_ids": np.repeat(np.arange(len(users)), lengths), "display_item_ids": display_item_ids, \
+            "picked_item_ids": dataset.picked_item_ids.numpy()[steps], "clicked_items_index": dataset.clicked_items_index.numpy()[steps]})
+    return concat_steps(parts)
+
+
+def extend_item_features(item_features, num_items):
+    """
+    Input:
+        item_features (torch.Tensor or OneHotItemFeatures): [old_num_items+1, old_feature_dim] Dataset.item_features (the last row is the padding placeholder).
+        num_items (int): new number of items.
+    Return:
+        item_features (np.ndarray): [num_items, old_feature_dim + (num_items - old_num_items)] the features of the old items are zero padded,
+            every new item gets its own new (one hot) feature dim. None if the features stay one hot (one hot items are not stored, see
+            model/segment_store.py), which includes dense identity features (e.g. the np.eye features of dropbox/process_data.py).
+    """
+    old_num_items, old_feature_dim = item_features.shape[0] - 1, item_features.shape[1]
+    if isinstance(item_features, OneHotItemFeatures):
+        return None
+    item_features = item_features[:-1].numpy()
+    rows, columns = np.nonzero(item_features)
+    if old_feature_dim == old_num_items and len(rows) == old_num_items and np.array_equal(rows, columns) and np.all(item_features[rows, columns] == 1):
+        return None
+
+    num_new_items = max(num_items - old_num_items, 0)
+    extended_features = np.zeros((old_num_items + num_new_items, old_feature_dim + num_new_items), dtype=np.float32)
+    extended_features[:old_num_items, :old_feature_dim] = item_features
+    extended_features[old_num_items + np.arange(num_new_items), old_feature_dim + np.arange(num_new_items)] = 1
+    return extended_features
+
+
+def write_update_store(store_folder, source, steps, user_splits, num_items, item_features):
+    """
+    Input:
+        store_folder (str): folder of the segment store of the update dataset (has to be empty).
+        source (str): what the update was built from.
+        steps (dict), user_splits (np.ndarray): per time step arrays and split of every user of the update (see process_session_log).
+        num_items (int): number of items of the update.
+        item_features (np.ndarray): [num_items, feature_dim] dense item features, None for one hot items (see extend_item_features).
+    """
+    store = SegmentStore(store_folder)
+    assert not store.index["segments"], f"{store_folder} already holds a dataset, remove it or choose another --tag"
+    new_items = [str(i) for i in range(num_items)]
+    if item_features is not None:
+        store.set_item_features(item_features, new_items)
+        new_items = []
+    segment = write_segment(store_folder, "seg-00000", source, *(steps[name] for name in STEP_ARRAYS), user_splits[steps["step_user_ids"]])
+    store.commit_segment(segment, new_items=new_items, new_users=[(str(u), int(split)) for u, split in enumerate(user_splits)])
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    start = time.perf_counter()
+
+    # ========== Preprocess the new sessions only
+    new_steps, new_user_splits, num_log_items = process_session_log(args.new_log)
+    # the train splits are memory mapped (the .npy cache is written on first use), so that replay does not load them
+    dataset = Dataset(args.data_folder, args.dataset, split="train", mmap_cache=True)
+    replay_datasets = [dataset if dset == args.dataset else Dataset(args.data_folder, dset, split="train", mmap_cache=True) \
+        for dset in (args.replay_datasets or [args.dataset])]
+    num_items = max(num_log_items, dataset.item_features.shape[0] - 1)
+    item_features = extend_item_features(dataset.item_features, num_items)
+    feature_dim = num_items if item_features is None else item_features.shape[1]
+
+    # ========== Bounded replay sample of old train users
+    num_new_train_users = int((new_user_splits == 0).sum())
+    num_replay = min(args.max_replay, int(np.ceil(args.replay_ratio * num_new_train_users)))
+    replay_steps = sample_replay_steps(replay_datasets, num_replay, np.random.default_rng(args.seed))
+    num_replay = len(np.unique(replay_steps["step_user_ids"]))
+
+    # the update dataset: new sessions (with their splits) + replayed sessions (train)
+    update_dset = f"{args.dataset}-{args.tag}"
+    write_update_store(os.path.join(args.data_folder, update_dset+'-store'), f"{os.path.basename(args.new_log)} + {num_replay} replayed users", \
+        concat_steps([new_steps, replay_steps]), np.concatenate((new_user_splits, np.zeros(num_replay, dtype=np.int64))), num_items, item_features)
+    preprocess_s = time.perf_counter() - start
+
+    # ========== Start from the latest checkpoints and grow the input weights by the unseen items
+    infer_model_dims_from_checkpoints(config_dict)
+    old_feature_dim = config_dict["history_input_size"]
+    gan = build_gan(config_dict)
+    gan.init_optimizers()
+    loaded_epoch, _, _ = gan.load_checkpoints()
+    gan.expand_feature_dim(feature_dim)
+
+    display_set_size = config_dict["generator_output_size"] - 1
+    train_dataloader = DataLoader(Dataset(args.data_folder, update_dset, split="train", display_set_size=display_set_size), \
+        batch_size=config_dict['batch_size'], shuffle=True, collate_fn=custom_collate_fn, drop_last=True)
+    val_dataloader = DataLoader(Dataset(args.data_folder, update_dset, split="validation", display_set_size=display_set_size), \
+        batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True) if (new_user_splits == 1).any() else []
+    gan.prepare_training(train_dataloader.dataset)
+
+    # ========== Fine-tune on the new + replayed sessions
+    start = time.perf_counter()
+    best = None # (val_dfake_loss, val_dreal_loss, epoch, snapshot) of the best validated epoch
+    for epoch in range(args.epochs):
+        cur_dreal_loss, cur_dfake_loss = 0, 0
+        for real_click_history, display_set, clicked_items in train_dataloader:
+            dreal_loss, dfake_loss = gan.train_step(real_click_history, display_set, clicked_items)
+            if dfake_loss is not None:
+                cur_dreal_loss += dreal_loss
+                cur_dfake_loss += dfake_loss
+        gan.flush_accumulated_gradients() # step on the remaining micro-batches of the epoch
+        if len(val_dataloader) == 0:
+            print(f"epoch: [{epoch+1}/{args.epochs}], train_dreal_loss: {cur_dreal_loss}, train_dfake_loss: {cur_dfake_loss} (no validation batches)")
+            continue
+        val_dreal_loss, val_dfake_loss = gan.validate(val_dataloader)
+        print(f"epoch: [{epoch+1}/{args.epochs}], train_dreal_loss: {cur_dreal_loss}, train_dfake_loss: {cur_dfake_loss} \
+            val_dreal_loss: {val_dreal_loss}, val_dfake_loss: {val_dfake_loss}")
+        if best is None or best[0] >= val_dfake_loss:
+            best = (val_dfake_loss, val_dreal_loss, epoch, gan.snapshot())
+    train_s = time.perf_counter() - start
+
+    gan.config_dict["ckpt_path"] = args.output_ckpt_path or config_dict["ckpt_path"]
+    if best is None:
+        # without validation batches there is no best epoch: the last models are saved with an unknown (inf) validation loss, so that
+        # the first validated epoch of a later training run replaces them
+        gan.save_checkpoints(loaded_epoch + args.epochs, float("inf"), float("inf"))
+    else:
+        gan.save_checkpoints(loaded_epoch + best[2] + 1, best[0], best[1], snapshot=best[3])
+
+    print("*" * 30)
+    print(f"new sessions: {len(new_user_splits)} (train: {num_new_train_users}), replayed sessions: {num_replay}, " \
+        f"unseen items: {feature_dim - old_feature_dim} (feature_dim {old_feature_dim} --> {feature_dim})")
+    print(f"preprocessing: {preprocess_s:.2f}s, training: {train_s:.2f}s")
+    print(f"Saved the updated checkpoints to {gan.config_dict['ckpt_path']}" + ("" if best is None else f" (epoch {best[2]+1})") + \
+        f", the update dataset is {update_dset}")
+    print("*" * 30)
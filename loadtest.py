@@ -0,0 +1,292 @@
+import argparse
+import http.client
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from copy import deepcopy
+from urllib.parse import urlparse
+
+import numpy as np
+import torch
+
+from data import Dataset, dataset_exists
+from main import parse_config_yaml, set_model_dims, build_gan
+from model.registry import ModelRegistry, ModelBundle
+from serve_registry import load_served_models, score_last_step
+
+#======================================================================================================
+### Load test of the scoring path (History_LSTM + Generator_UserModel/Discriminator_RewardModel). The sessions of the
+# test split are replayed as request streams: every request scores the last time step of a session prefix, the steps
+# of a session are sent in order. Closed loop: `concurrency` clients send their next request when the previous one
+# returned. Open loop: requests arrive as a Poisson process of the given rate and are served by `concurrency` workers,
+# latencies are measured from the scheduled arrival (queueing included).
+#======================================================================================================
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Load test of the user model scoring path with replayed test sessions.')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file (in-process target: the models are loaded from the checkpoints given there).')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset whose test sessions are replayed.')
+    parser.add_argument('--endpoint', type=str, default=None,
+                        help='URL of a serve_registry.py endpoint (e.g. http://127.0.0.1:8000). The models are scored in-process if not given.')
+    parser.add_argument('--display_set_sizes', type=int, nargs='*', default=[],
+                        help='Display set sizes to test (the display sets are truncated/padded). In-process, sizes other than the trained one use '
+                        'randomly initialized models (as "<dataset>-d<size>"), an endpoint only serves the trained size. Defaults to the trained size.')
+    parser.add_argument('--mode', type=str, default="closed", help='either ["closed", "open"] loop load generation.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Closed loop: numbers of concurrent clients to sweep. Open loop: number of workers (the first value).')
+    parser.add_argument('--rates', type=float, nargs='+', default=[10, 20, 50, 100, 200],
+                        help='Open loop: arrival rates (requests/s) to sweep.')
+    parser.add_argument('--duration', type=float, default=10, help='Measured seconds of every trial.')
+    parser.add_argument('--warmup', type=float, default=2, help='Unmeasured seconds at the start of every trial.')
+    parser.add_argument('--max_sessions', type=int, default=None, help='Number of test sessions to replay (all if not given).')
+    parser.add_argument('--slo_ms', type=float, default=100, help='p99 latency above which an open loop rate counts as saturated.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the arrival times.')
+    parser.add_argument('--report', type=str, default="results/loadtest_report.json",
+                        help='Path of the report (json).')
+
+    args = parser.parse_args()
+    return args
+
+
+def model_key(dset, display_set_size=None):
+    """
+    Return:
+        key (str): registry key of the trained models of the dataset, or of the randomly initialized models of the display_set_size.
+    """
+    return dset if display_set_size is None else f"{dset}-d{display_set_size}"
+
+
+def build_registry(config_dict, data_folder, dset, display_set_sizes=()):
+    """
+    Input:
+        config_dict (dict): configuration whose checkpoints are served as model_key(dset) (if they exist).
+        display_set_sizes (iterable): display set sizes of additional randomly initialized models (same hyperparameters), served as model_key(dset, size).
+    Return:
+        registry (ModelRegistry): in-process registry with the active models.
+        item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features that resolve the item ids of the requests (last row = padding).
+        display_set_sizes (dict): model key --> display set size of the model.
+    """
+    registry = ModelRegistry()
+    sizes = {}
+    if os.path.exists(os.path.join(config_dict["ckpt_path"], config_dict["pretrained_generator_path"])):
+        _, item_features = load_served_models(registry, data_folder, {model_key(dset): config_dict})[model_key(dset)]
+        with registry.acquire(model_key(dset)) as bundle:
+            sizes[model_key(dset)] = bundle.config_dict["generator_output_size"] - 1
+    else:
+        item_features = Dataset(data_folder, dset, split="test").item_features
+    sparse_inputs = config_dict.get("sparse_inputs", False)
+    for display_set_size in display_set_sizes:
+        if display_set_size in sizes.values():
+            continue
+        random_config_dict = set_model_dims(deepcopy(config_dict), item_features.shape[-1], display_set_size)
+        gan = build_gan(random_config_dict)
+        if sparse_inputs:
+            gan.set_item_features(item_features)
+        registry.add(ModelBundle(model_key(dset, display_set_size), "random", random_config_dict, gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel))
+        sizes[model_key(dset, display_set_size)] = display_set_size
+    return registry, item_features, sizes
+
+
+def session_streams(dataset, display_set_size, max_sessions=None):
+    """
+    Input:
+        dataset (Dataset): test split.
+        display_set_size (int): the display sets are truncated to / padded (padding item) up to this size.
+        max_sessions (int): number of sessions (all if None).
+    Return:
+        streams (list): per session the list of its requests [(history item ids [t+1], display item ids [t+1, display_set_size])] in time order.
+    """
+    padding_id = dataset.item_features.shape[0] - 1
+    display_item_ids = dataset.display_item_ids[:, :display_set_size]
+    if display_item_ids.shape[1] < display_set_size:
+        padding = torch.full((display_item_ids.shape[0], display_set_size - display_item_ids.shape[1]), padding_id, dtype=display_item_ids.dtype)
+        display_item_ids = torch.cat((display_item_ids, padding), dim=1)
+    streams = []
+    for user in range(len(dataset) if max_sessions is None else min(max_sessions, len(dataset))):
+        start, end = dataset.user_offsets[user].item(), dataset.user_offsets[user+1].item()
+        history, display = dataset.picked_item_ids[start:end].tolist(), display_item_ids[start:end].tolist()
+        streams.append([(history[:t+1], display[:t+1]) for t in range(end - start)])
+    return streams
+
+
+def make_scorer(args, config_dict, registry, item_features):
+    """
+    Return:
+        new_client (callable): new_client() --> score(key, history_ids, display_ids), one client per load generating thread
+            (in-process calls of the registry, or a keep-alive connection to the endpoint).
+    """
+    if args.endpoint is None:
+        sparse_inputs = config_dict.get("sparse_inputs", False)
+        def new_client():
+            return lambda key, history_ids, display_ids: score_last_step(registry, key, item_features, history_ids, display_ids, sparse_inputs)
+        return new_client
+
+    url = urlparse(args.endpoint)
+    def new_client():
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        def score(key, history_ids, display_ids):
+            connection.request("POST", "/score", json.dumps({"model": key, "history": history_ids, "display": display_ids}), {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}: {body.decode()}")
+            return json.loads(body)
+        return score
+    return new_client
+
+
+def run_trial(new_client, key, streams, mode, concurrency, rate, duration, warmup, seed):
+    """
+    Return:
+        result (dict): completed requests, throughput, latency percentiles (ms) and errors of the measured window.
+    """
+    records = [] # (completion time, latency s) of every completed request
+    errors = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    end = start + warmup + duration
+
+    def record(issued_at, finished_at, error=None):
+        with lock:
+            if error is not None:
+                errors.append(str(error))
+            elif finished_at <= end:
+                records.append((finished_at, finished_at - issued_at))
+
+    if mode == "closed":
+        def client(index):
+            score = new_client()
+            for stream in itertools.cycle(streams[index::concurrency]): # cycles through the sessions of the client until the end
+                for history_ids, display_ids in stream:
+                    if time.perf_counter() >= end:
+                        return
+                    issued_at = time.perf_counter()
+                    try:
+                        score(key, history_ids, display_ids)
+                        record(issued_at, time.perf_counter())
+                    except Exception as error:
+                        record(issued_at, time.perf_counter(), error)
+        threads = [threading.Thread(target=client, args=(index,), daemon=True) for index in range(concurrency)]
+        arrived, backlog = None, 0
+    else:
+        arrivals = queue.Queue()
+        scheduled = [] # arrival times of the Poisson process
+        def dispatcher():
+            rng = np.random.default_rng(seed)
+            requests = itertools.cycle([request for stream in streams for request in stream])
+            scheduled_at = start
+            while True:
+                scheduled_at += rng.exponential(1 / rate)
+                if scheduled_at >= end:
+                    break
+                time.sleep(max(0, scheduled_at - time.perf_counter()))
+                scheduled.append(scheduled_at)
+                arrivals.put((scheduled_at, next(requests)))
+            for _ in range(concurrency):
+                arrivals.put(None)
+        def worker():
+            score = new_client()
+            while True:
+                arrival = arrivals.get()
+                if arrival is None or time.perf_counter() >= end:
+                    return
+                scheduled_at, (history_ids, display_ids) = arrival
+                try:
+                    score(key, history_ids, display_ids)
+                    record(scheduled_at, time.perf_counter())
+                except Exception as error:
+                    record(scheduled_at, time.perf_counter(), error)
+        threads = [threading.Thread(target=dispatcher, daemon=True)] + [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=max(0, end - time.perf_counter()) + 60)
+    if mode == "open":
+        arrived = sum(scheduled_at >= start + warmup for scheduled_at in scheduled) # arrivals of the measured window (the offered load that was drawn)
+        backlog = sum(arrival is not None for arrival in list(arrivals.queue)) # arrived but not served within the trial
+
+    latencies = np.array([latency for finished_at, latency in records if finished_at >= start + warmup]) * 1000
+    result = {"mode": mode, "concurrency": concurrency, "offered_rps": rate, "completed": int(len(latencies)), "errors": len(errors), \
+        "arrived": arrived, "throughput_rps": len(latencies) / duration, "backlog": backlog}
+    if len(latencies) > 0:
+        result.update({f"p{q}_ms": float(np.percentile(latencies, q)) for q in [50, 90, 95, 99]})
+        result.update({"mean_ms": float(latencies.mean()), "max_ms": float(latencies.max())})
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def saturation_point(curve, mode, slo_ms):
+    """
+    Return:
+        saturation (dict): closed loop: the smallest concurrency that reaches 95% of the best throughput (more clients only add latency).
+            Open loop: the highest arrival rate that is served (>= 95% of the arrived requests completed, p99 <= slo_ms) and the first one that is not.
+    """
+    if mode == "closed":
+        best = max(result["throughput_rps"] for result in curve)
+        knee = next(result for result in curve if result["throughput_rps"] >= 0.95 * best)
+        return {"concurrency": knee["concurrency"], "throughput_rps": knee["throughput_rps"], "p99_ms": knee.get("p99_ms"), "max_throughput_rps": best}
+    sustained, saturated = None, None
+    for result in curve:
+        if result["completed"] >= 0.95 * result["arrived"] and result.get("p99_ms", float("inf")) <= slo_ms and not result["errors"]:
+            sustained = result
+        else:
+            saturated = result
+            break
+    return {"max_sustained_rps": None if sustained is None else sustained["offered_rps"], \
+        "first_saturated_rps": None if saturated is None else saturated["offered_rps"], \
+            "max_throughput_rps": max(result["throughput_rps"] for result in curve)}
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+    assert args.mode in ["closed", "open"]
+    test_dataset = Dataset(args.data_folder, args.dataset, split="test")
+
+    # models: in-process registry, or the display set sizes served by the endpoint
+    registry, item_features = None, None
+    if args.endpoint is None:
+        registry, item_features, display_set_sizes = build_registry(config_dict, args.data_folder, args.dataset, args.display_set_sizes)
+    else:
+        url = urlparse(args.endpoint)
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        connection.request("GET", "/models")
+        served = json.loads(connection.getresponse().read())
+        # the endpoint serves the trained models of its datasets only
+        display_set_sizes = {model_key(args.dataset): test_dataset.display_item_ids.shape[1]} if model_key(args.dataset) in served else {}
+    if args.display_set_sizes:
+        display_set_sizes = {key: size for key, size in display_set_sizes.items() if size in args.display_set_sizes}
+    assert display_set_sizes, "no models to test (no checkpoints and no --display_set_sizes, or not served by the endpoint)"
+    new_client = make_scorer(args, config_dict, registry, item_features)
+
+    report = {"dataset": args.dataset, "target": args.endpoint or "in-process", "mode": args.mode, "duration_s": args.duration, "warmup_s": args.warmup, \
+        "num_threads": torch.get_num_threads(), "slo_ms": args.slo_ms, "results": []}
+    for key, display_set_size in sorted(display_set_sizes.items(), key=lambda item: item[1]):
+        streams = session_streams(test_dataset, display_set_size, args.max_sessions)
+        trials = [(concurrency, None) for concurrency in args.concurrency] if args.mode == "closed" else [(args.concurrency[0], rate) for rate in args.rates]
+        curve = []
+        for concurrency, rate in trials:
+            result = run_trial(new_client, key, streams, args.mode, concurrency, rate, args.duration, args.warmup, args.seed)
+            print(json.dumps({"model": key, "display_set_size": display_set_size, **result}))
+            curve.append(result)
+        saturation = saturation_point(curve, args.mode, args.slo_ms)
+        print(f"{key} (display set size {display_set_size}) saturation: {saturation}")
+        report["results"].append({"model": key, "display_set_size": display_set_size, "curve": curve, "saturation": saturation})
+
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote the load test report to {args.report}")
+    if registry is not None:
+        registry.close()
@@ -1,6 +1,11 @@
+import time
+start_time = time.perf_counter() # start of the process (before the heavy imports), used for the time to first step report
 from model.gan import GAN
-from data import Dataset, custom_collate_fn
+from model.sparse_inputs import is_item_ids
+from data import Dataset, custom_collate_fn, dataset_metadata, dataset_exists
 import yaml
+import os
+import re
 from copy import deepcopy
 import argparse
 from torch.utils.data import DataLoader
@@ -18,7 +23,9 @@ def arg_parse():
     parser.add_argument('--data_folder', type=str, default="./dropbox",
                         help='Path (str) that holds the dataset file.')
     parser.add_argument('--dataset', type=str, default="yelp",
-                        help='either ["yelp", "rsc", "tb"]. Dataset to use for initializing the DataLoaders.')
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset to use for initializing the DataLoaders.')
+    parser.add_argument('--config_overlay', type=str, nargs='*', default=[],
+                        help='yaml files whose keys override the ones of the config (applied in order), e.g. the output of autotune.py.')
     
 
     args = parser.parse_args()
@@ -39,17 +46,132 @@ def parse_config_yaml(file_path):
     return config_dict_yaml
 
 
-def get_dataLoaders(data_folder, dset, batch_size):
+def apply_config_overlays(config_dict, overlay_paths):
+    """
+    Input:
+        config_dict (dict): dictionary containing the information in the config yaml file
+        overlay_paths (list): paths of yaml files whose keys override the ones of the config_dict (applied in order)
+    Return:
+        config_dict (dict): the updated config_dict
+    """
+    for overlay_path in overlay_paths:
+        config_dict.update(parse_config_yaml(overlay_path) or {})
+    return config_dict
+
+
+def configure_threads(config_dict):
+    """
+    Input:
+        config_dict (dict): dictionary containing the information in the config yaml file
+    Sets the number of torch intra-op/inter-op threads if they are given in the config_dict (torch_num_threads, torch_interop_threads).
+    """
+    if config_dict.get("torch_num_threads"):
+        torch.set_num_threads(config_dict["torch_num_threads"])
+    if config_dict.get("torch_interop_threads"):
+        torch.set_num_interop_threads(config_dict["torch_interop_threads"])
+
+
+def get_dataLoaders(data_folder, dset, batch_size, num_workers=0, mmap_cache=False, splits=("train", "validation", "test"), sparse_inputs=False):
+    """
+    Input:
+        splits (tuple): splits whose Datasets are built (e.g. only ("test",) in the test mode).
+        sparse_inputs (bool): if True, the batches hold item ids instead of feature vectors (see GAN.set_item_features).
+    Return:
+        dataloaders (tuple): DataLoader of every split in the order of splits (only the train DataLoader is shuffled).
+    """
     # Initialize Dataloaders
-    train_dataset = Dataset(data_folder, dset, split="train")
-    val_dataset = Dataset(data_folder, dset, split="validation")
-    test_dataset = Dataset(data_folder, dset, split="test")
+    datasets = [Dataset(data_folder, dset, split=split, mmap_cache=mmap_cache, sparse_inputs=sparse_inputs) for split in splits]
+    if num_workers > 0:
+        # workers attach to the dataset tensors instead of copying them
+        for dataset in datasets:
+            dataset.share_memory()
 
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=custom_collate_fn, drop_last=True)
-    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, collate_fn=custom_collate_fn, drop_last=True)
-    test_dataloader = DataLoader(test_dataset, batch_size=batch_size, collate_fn=custom_collate_fn, drop_last=True)
+    return tuple(DataLoader(dataset, batch_size=batch_size, shuffle=(split == "train"), collate_fn=custom_collate_fn, drop_last=True, num_workers=num_workers) \
+        for split, dataset in zip(splits, datasets))
 
-    return train_dataloader, val_dataloader, test_dataloader
+
+def set_model_dims(config_dict, feature_dim, num_displayed_items):
+    """
+    Input:
+        config_dict (dict): dictionary containing the information in the config yaml file
+        feature_dim (int): dimension of the item features.
+        num_displayed_items (int): size of the (padded) display sets.
+    Writes the input/output dimensions of the models into the config_dict.
+    """
+    config_dict["generator_output_size"] = num_displayed_items + 1
+    config_dict["discriminator_output_size"] = num_displayed_items + 1
+    config_dict["history_input_size"] = feature_dim
+    config_dict["generator_input_size"] = config_dict["history_hidden_size"] + (config_dict["generator_output_size"] * config_dict["history_input_size"])
+    config_dict["discriminator_input_size"] = config_dict["history_hidden_size"] + (config_dict["discriminator_output_size"] * config_dict["history_input_size"])
+    return config_dict
+
+
+def infer_model_dims(config_dict, dataloader):
+    """
+    Input:
+        config_dict (dict): dictionary containing the information in the config yaml file
+        dataloader (torch.utils.data.DataLoader): DataLoader whose first batch is used to infer the dimensions
+    Infers the input/output dimensions of the models from the first batch of the dataloader and writes them into the config_dict.
+    """
+    real_click_history, display_set, clicked_items = next(iter(dataloader))
+    display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
+    if is_item_ids(display_set_unpacked):
+        # sparse inputs: the batch holds the item ids [*, num_displayed_items], the features stay in the dataset
+        return set_model_dims(config_dict, dataloader.dataset.item_features.shape[-1], display_set_unpacked.shape[-1])
+    return set_model_dims(config_dict, display_set_unpacked.shape[-1], display_set_unpacked.shape[-2])
+
+
+def infer_model_dims_from_metadata(config_dict, metadata, split):
+    """
+    Input:
+        config_dict (dict): dictionary containing the information in the config yaml file
+        metadata (dict): metadata header of the processed dataset (see data.dataset_metadata)
+        split (str): split whose display set size is used (the split the models are trained/tested on)
+    Reads the input/output dimensions of the models from the metadata of the dataset (instead of a batch of the data)
+    and writes them into the config_dict.
+    """
+    return set_model_dims(config_dict, metadata["feature_dim"], metadata["splits"][split]["max_display_size"])
+
+
+def infer_model_dims_from_checkpoints(config_dict):
+    """
+    Input:
+        config_dict (dict): dictionary containing the information in the config yaml file
+    Reads the input/output dimensions and the architecture (history_model, history_hidden_size, history_num_layers, *_n_hidden,
+    *_hidden_dim) of the models from the checkpoints specified in the config_dict (instead of a batch of the data and the config)
+    and writes them into the config_dict, so that checkpoints of other runs (e.g. a distilled GRU student) can be loaded.
+    """
+    def state_dict(path_key):
+        return torch.load(os.path.join(config_dict["ckpt_path"], config_dict[path_key]), map_location="cpu")["state_dict"]
+
+    history_state_dict = state_dict("pretrained_history_lstm_path")
+    config_dict["history_model"] = "gru" if any(k.startswith("gru_model.") for k in history_state_dict) else "lstm"
+    if config_dict["history_model"] == "gru":
+        config_dict["tbptt_window"] = None # tbptt_window requires the History_LSTM
+    config_dict["history_input_size"] = next(v for k, v in history_state_dict.items() if k.endswith("weight_ih_l0")).shape[1]
+    config_dict["history_hidden_size"] = next(v for k, v in history_state_dict.items() if k.endswith("weight_hh_l0")).shape[1]
+    config_dict["history_num_layers"] = sum(1 for k in history_state_dict if re.search(r"weight_ih_l\d+$", k))
+    for prefix, path_key in [("generator", "pretrained_generator_path"), ("discriminator", "pretrained_discriminator_path")]:
+        weights = [v for k, v in state_dict(path_key).items() if k.endswith(".weight")] # layers of the MLP in order
+        config_dict[prefix + "_input_size"] = weights[0].shape[1]
+        config_dict[prefix + "_output_size"] = weights[-1].shape[0]
+        config_dict[prefix + "_n_hidden"] = len(weights) - 1
+        config_dict[prefix + "_hidden_dim"] = weights[0].shape[0]
+    return config_dict
+
+
+def build_gan(config_dict):
+    """
+    Input:
+        config_dict (dict): dictionary containing the hyperparameters and the model dimensions (see infer_model_dims)
+    Return:
+        gan (GAN): GAN model initialized according to the config_dict
+    """
+    gan = GAN(config_dict, config_dict['history_input_size'], config_dict['history_hidden_size'], config_dict['history_num_layers'], \
+        config_dict['generator_input_size'], config_dict['generator_output_size'], config_dict['generator_n_hidden'], config_dict['generator_hidden_dim'], \
+            config_dict['discriminator_input_size'], config_dict['discriminator_output_size'], config_dict['discriminator_n_hidden'], config_dict['discriminator_hidden_dim'], \
+                lr=config_dict['lr'], betas=config_dict['betas'], epochs=config_dict['epochs'])
+    return gan
 
 
 
@@ -58,35 +180,47 @@ if __name__ == "__main__":
     args = arg_parse()
     # Parse the configurations yaml file
     config_dict = parse_config_yaml(args.config_path)
+    apply_config_overlays(config_dict, args.config_overlay)
+    configure_threads(config_dict)
 
-       # Initialize dataloaders
+    # Model dims from the metadata header of the processed dataset (no data is loaded), otherwise from the first batch
     data_folder = args.data_folder
-    dset = args.dataset # choose rsc, tb, or yelp
-    assert dset in ["yelp", "rsc", "tb"]
-    train_dataloader, val_dataloader, test_dataloader = get_dataLoaders(data_folder, dset, config_dict['batch_size'])
-
-    if args.mode == "train":
-        real_click_history, display_set, clicked_items = next(iter(train_dataloader))
-        display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
-    elif args.mode == "test":
-        real_click_history, display_set, clicked_items = next(iter(test_dataloader))
-        display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
-                        
-    config_dict["generator_output_size"] = display_set_unpacked.shape[-2] + 1
-    config_dict["discriminator_output_size"] = display_set_unpacked.shape[-2] + 1
-    config_dict["history_input_size"] = display_set_unpacked.shape[-1]
-    config_dict["generator_input_size"] = config_dict["history_hidden_size"] + (config_dict["generator_output_size"] * config_dict["history_input_size"])
-    config_dict["discriminator_input_size"] = config_dict["history_hidden_size"] + (config_dict["discriminator_output_size"] * config_dict["history_input_size"])
+    dset = args.dataset # choose rsc, tb, yelp, or an update dataset of incremental.py
+    assert dataset_exists(data_folder, dset), f"no processed dataset {dset} in {data_folder}"
+    assert args.mode in ["train", "test"]
+    splits = ("train", "validation") if args.mode == "train" else ("test",)
+    imports_time = time.perf_counter() - start_time
+    metadata = dataset_metadata(data_folder, dset)
+    if metadata is not None:
+        infer_model_dims_from_metadata(config_dict, metadata, splits[0])
+
+    # Initialize dataloaders (only the splits of the mode)
+    phase_start = time.perf_counter()
+    dataloaders = get_dataLoaders(data_folder, dset, config_dict['batch_size'], num_workers=config_dict.get('num_workers', 0), \
+        mmap_cache=config_dict.get('mmap_dataset', False), splits=splits, sparse_inputs=config_dict.get('sparse_inputs', False))
+    datasets_time = time.perf_counter() - phase_start
+    if metadata is None:
+        print(f"No metadata of the {dset} dataset in {data_folder} (see dropbox/process_data.py), the model dims are inferred from the first batch")
+        infer_model_dims(config_dict, dataloaders[0])
+    else:
+        dataset = dataloaders[0].dataset
+        assert (dataset.item_features.shape[-1], dataset.display_item_ids.shape[1] + 1) == (config_dict["history_input_size"], config_dict["generator_output_size"]), \
+            f"the metadata of the {dset} dataset does not match its data, re-run the dropbox script that processed it"
 
     # Initialize the GAN model
-    gan = GAN(config_dict, config_dict['history_input_size'], config_dict['history_hidden_size'], config_dict['history_num_layers'], \
-        config_dict['generator_input_size'], config_dict['generator_output_size'], config_dict['generator_n_hidden'], config_dict['generator_hidden_dim'], \
-            config_dict['discriminator_input_size'], config_dict['discriminator_output_size'], config_dict['discriminator_n_hidden'], config_dict['discriminator_hidden_dim'], \
-                lr=config_dict['lr'], betas=config_dict['betas'], epochs=config_dict['epochs'])
+    phase_start = time.perf_counter()
+    gan = build_gan(config_dict)
+    if config_dict.get('sparse_inputs', False):
+        gan.set_item_features(dataloaders[0].dataset.item_features)
+    model_time = time.perf_counter() - phase_start
+    print(f"Startup: {time.perf_counter() - start_time:.2f}s (imports {imports_time:.2f}s, {' + '.join(splits)} datasets {datasets_time:.2f}s, " \
+        f"model {model_time:.2f}s, model dims from {'the first batch' if metadata is None else 'metadata'})")
 
 
     # Train/Test using the GAN model
     if args.mode == "train":
-        train_dreal_losses, train_dfake_losses, val_dreal_losses, val_dfake_losses = gan.gan_training_loop(train_dataloader, val_dataloader)
+        train_dataloader, val_dataloader = dataloaders
+        train_dreal_losses, train_dfake_losses, val_dreal_losses, val_dfake_losses = gan.gan_training_loop(train_dataloader, val_dataloader, start_time=start_time)
     else:
-        test_cur_dreal_loss, test_cur_dfake_loss = gan.test(test_dataloader)
\ No newline at end of file
+        test_dataloader, = dataloaders
+        test_cur_dreal_loss, test_cur_dfake_loss = gan.test(test_dataloader)
@@ -0,0 +1,92 @@
+import os
+import queue
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+
+from data import custom_collate_fn
+
+# Validation of the GAN in a separate process. The training process sends CPU snapshots of the model weights
+# (GAN.snapshot) and keeps training; the worker validates every snapshot on the CPU and sends the losses back.
+
+
+def _validation_worker(config_dict, datasets, batch_size, num_threads, jobs, results):
+    # the worker validates on the CPU only (has to be set before CUDA is initialized)
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    torch.set_num_threads(num_threads)
+    from model.gan import GAN # model.gan imports this module
+
+    gan = GAN(config_dict, config_dict['history_input_size'], config_dict['history_hidden_size'], config_dict['history_num_layers'], \
+        config_dict['generator_input_size'], config_dict['generator_output_size'], config_dict['generator_n_hidden'], config_dict['generator_hidden_dim'], \
+            config_dict['discriminator_input_size'], config_dict['discriminator_output_size'], config_dict['discriminator_n_hidden'], config_dict['discriminator_hidden_dim'])
+    if datasets["full"].sparse_inputs:
+        gan.set_item_features(datasets["full"].item_features)
+    dataloaders = {name: DataLoader(dataset, batch_size=batch_size, collate_fn=custom_collate_fn, drop_last=True) for name, dataset in datasets.items()}
+    models = {"history_LSTM": gan.history_LSTM, "generator_UserModel": gan.generator_UserModel, "discriminator_RewardModel": gan.discriminator_RewardModel}
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        tag, dataset_name, model_state_dicts = job
+        for name, model in models.items():
+            model.load_state_dict(model_state_dicts[name])
+            model.eval()
+        dreal_loss, dfake_loss = gan.validate(dataloaders[dataset_name])
+        results.put((tag, float(dreal_loss), float(dfake_loss)))
+
+
+class BackgroundValidator():
+    def __init__(self, config_dict, validation_dataset, batch_size, subsample_size=None, num_threads=1, seed=0):
+        """
+        config_dict (dict): configuration of the GAN (including the inferred model dims).
+        validation_dataset (Dataset): validation split (its tensors are moved to shared memory).
+        batch_size (int): validation batch size.
+        subsample_size (int): if given, a fixed random subsample of this many validation users is available for frequent validations.
+        num_threads (int): number of CPU threads of the validation process.
+        """
+        validation_dataset.share_memory()
+        datasets = {"full": validation_dataset}
+        if subsample_size:
+            users = torch.randperm(len(validation_dataset), generator=torch.Generator().manual_seed(seed))[:max(subsample_size, batch_size)]
+            datasets["subsample"] = Subset(validation_dataset, users.sort().values.tolist())
+
+        context = mp.get_context("spawn")
+        self.jobs, self.results = context.Queue(), context.Queue()
+        self.process = context.Process(target=_validation_worker, args=(config_dict, datasets, batch_size, num_threads, self.jobs, self.results), daemon=True)
+        self.process.start()
+        self.num_pending = 0
+
+    def submit(self, tag, model_state_dicts, subsample=False):
+        """
+        Input:
+            tag: identifies the result (e.g. ("epoch", epoch)).
+            model_state_dicts (dict): CPU state dicts of the models (see GAN.snapshot).
+            subsample (bool): if True, the snapshot is validated on the fixed subsample instead of the whole validation split.
+        """
+        self.jobs.put((tag, "subsample" if subsample else "full", model_state_dicts))
+        self.num_pending += 1
+
+    def poll(self, block=False):
+        """
+        Input:
+            block (bool): if True, waits until every submitted snapshot is validated.
+        Return:
+            results (list): [(tag, dreal_loss, dfake_loss)] finished validations in submission order.
+        """
+        results = []
+        while self.num_pending > 0:
+            try:
+                results.append(self.results.get(timeout=1.0) if block else self.results.get_nowait())
+            except queue.Empty:
+                if not block:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError(f"the validation process exited with code {self.process.exitcode}")
+                continue
+            self.num_pending -= 1
+        return results
+
+    def close(self):
+        self.jobs.put(None)
+        self.process.join()
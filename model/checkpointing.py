@@ -0,0 +1,140 @@
+import inspect
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+# Activation checkpointing (recomputation in backward) helpers shared by History_LSTM, Generator_UserModel and Discriminator_RewardModel.
+
+# Non-reentrant checkpointing also computes the gradients of the parameters inside a checkpointed segment when none of
+# its inputs require grad (e.g. the first History_LSTM layers). Older torch versions only have the reentrant variant.
+_CHECKPOINT_KWARGS = {"use_reentrant": False} if "use_reentrant" in inspect.signature(checkpoint).parameters else {}
+
+# SavedActivationMemory trackers which are currently active
+_ACTIVE_TRACKERS = []
+
+
+class SavedActivationMemory():
+    """
+    Context manager which counts the bytes of the activations kept alive for the backward pass by the autograd graphs built inside it
+    (tensors saved for backward plus the inputs kept by checkpointed segments). Every storage is counted once.
+    Usage:
+        with SavedActivationMemory() as memory:
+            loss = model(x).sum()
+        print(memory.nbytes)
+    """
+    def __init__(self):
+        self.storages = {}
+        self._hooks = None
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+    def add(self, tensor):
+        if isinstance(tensor, torch.Tensor) and not isinstance(tensor, nn.Parameter):
+            storage = tensor.untyped_storage() if hasattr(tensor, "untyped_storage") else tensor.storage()
+            self.storages[storage.data_ptr()] = storage.nbytes() if hasattr(storage, "nbytes") else storage.size() * tensor.element_size()
+
+    def pack(self, tensor):
+        # parameters are not activations, they are alive anyway
+        if not tensor.requires_grad or tensor.grad_fn is not None:
+            self.add(tensor)
+        return tensor
+
+    def __enter__(self):
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+        self._hooks.__enter__()
+        _ACTIVE_TRACKERS.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _ACTIVE_TRACKERS.remove(self)
+        return self._hooks.__exit__(*exc)
+
+
+def _track_inputs(tensors):
+    for tracker in _ACTIVE_TRACKERS:
+        for tensor in tensors:
+            tracker.add(tensor)
+
+
+def checkpoint_mlp(sequential, segments, input):
+    """
+    Input:
+        sequential (torch.nn.Sequential): MLP to run.
+        segments (int): number of segments the MLP is split into. Only the inputs of the segments are kept for backward,
+            the activations inside a segment are recomputed during backward.
+    Return:
+        output (torch.Tensor): output of the MLP.
+    """
+    layers = list(sequential)
+    segment_size = -(-len(layers) // min(segments, len(layers))) # ceil
+    x = input
+    for first_layer in range(0, len(layers), segment_size):
+        def run_segment(x, segment_layers=layers[first_layer:first_layer + segment_size]):
+            for layer in segment_layers:
+                x = layer(x)
+            return x
+
+        _track_inputs([x])
+        x = checkpoint(run_segment, x, **_CHECKPOINT_KWARGS)
+    return x
+
+
+class CheckpointedLSTM():
+    """
+    Runs a multi-layer torch.nn.LSTM as `segments` groups of consecutive layers with activation checkpointing on every group.
+    The groups are nn.LSTM modules that share the parameters of the wrapped LSTM, so its state_dict (and checkpoints) are unchanged.
+    Note that this is deliberately not an nn.Module, the shared parameters must not be registered twice.
+    """
+    def __init__(self, lstm, segments):
+        """
+        lstm (torch.nn.LSTM): batch_first LSTM to run.
+        segments (int): number of layer groups, every group is checkpointed separately.
+        """
+        self.lstm = lstm
+        self.segments = min(segments, lstm.num_layers)
+        self._groups = None
+        self._parameter_ids = None
+
+    def _layer_groups(self):
+        # (re)build the groups if the parameters of the wrapped LSTM were replaced (e.g. by load_state_dict(assign=True))
+        parameter_ids = [id(p) for p in self.lstm.parameters()]
+        if self._groups is None or parameter_ids != self._parameter_ids:
+            self._groups = []
+            layers = list(range(self.lstm.num_layers))
+            group_size = -(-len(layers) // self.segments) # ceil
+            for first_layer in range(0, len(layers), group_size):
+                group_layers = layers[first_layer:first_layer + group_size]
+                input_size = self.lstm.input_size if first_layer == 0 else self.lstm.hidden_size
+                group = nn.LSTM(input_size, self.lstm.hidden_size, len(group_layers), bias=self.lstm.bias, batch_first=self.lstm.batch_first)
+                for j, layer in enumerate(group_layers):
+                    for name in ["weight_ih", "weight_hh"] + (["bias_ih", "bias_hh"] if self.lstm.bias else []):
+                        setattr(group, f"{name}_l{j}", getattr(self.lstm, f"{name}_l{layer}"))
+                self._groups.append((group, group_layers))
+            self._parameter_ids = parameter_ids
+        return self._groups
+
+    def __call__(self, actions, hidden=None):
+        """
+        Same inputs/outputs as torch.nn.LSTM.forward (actions can be a PackedSequence).
+        """
+        packed = isinstance(actions, torch.nn.utils.rnn.PackedSequence)
+        x = actions.data if packed else actions
+
+        h_n, c_n = [], []
+        for group, group_layers in self._layer_groups():
+            group_hidden = () if hidden is None else (hidden[0][group_layers[0]:group_layers[-1]+1].contiguous(), hidden[1][group_layers[0]:group_layers[-1]+1].contiguous())
+
+            def run_group(x, *group_hidden, group=group):
+                inp = torch.nn.utils.rnn.PackedSequence(x, actions.batch_sizes, actions.sorted_indices, actions.unsorted_indices) if packed else x
+                out, (h, c) = group(inp, group_hidden if group_hidden else None)
+                return (out.data if packed else out), h, c
+
+            _track_inputs([x, *group_hidden])
+            x, h, c = checkpoint(run_group, x, *group_hidden, **_CHECKPOINT_KWARGS)
+            h_n.append(h)
+            c_n.append(c)
+
+        out = torch.nn.utils.rnn.PackedSequence(x, actions.batch_sizes, actions.sorted_indices, actions.unsorted_indices) if packed else x
+        return out, (torch.cat(h_n, dim=0), torch.cat(c_n, dim=0))
@@ -0,0 +1,40 @@
+import numpy as np
+import json
+import os
+
+# Reader of the typed NumPy column files of a raw session log (<dset>-columns/, written by dropbox/ingest_logs.py, see the
+# format there). The rows are sorted by tr_val_tst, so a split is a contiguous row range of the memory mapped columns.
+
+
+class ColumnarLog():
+    def __init__(self, folder):
+        """
+        folder (str): output folder of ingest_log.
+        """
+        self.folder = folder
+        with open(os.path.join(folder, "index.json")) as f:
+            self.index = json.load(f)
+
+    def read(self, columns=None, tr_val_tst=None):
+        """
+        Input:
+            columns (list): names of the columns to read (default: all).
+            tr_val_tst (list): if given, only the rows of these splits are read (0: train, 1: validation, 2: test).
+        Return:
+            columns (dict): column name --> np.ndarray [rows] (sorted as in index["sorted_by"]).
+        """
+        ranges = [self.index["tr_val_tst_ranges"][str(tag)] for tag in sorted(tr_val_tst)] if tr_val_tst is not None else [[0, self.index["num_rows"]]]
+        out = {}
+        for name in (columns or list(self.index["columns"])):
+            # memory mapped, only the selected row ranges are read from the file
+            values = np.load(os.path.join(self.folder, name + '.npy'), mmap_mode='r')
+            out[name] = np.concatenate([values[start:end] for start, end in ranges])
+        return out
+
+    def dictionary(self, name):
+        """
+        Return:
+            raw_ids (list): raw id of every code of the SessionId/ItemId column.
+        """
+        with open(os.path.join(self.folder, name + '.txt')) as f:
+            return f.read().splitlines()
@@ -1,18 +1,22 @@
 import torch
-from torch import nn
+from model.packed_mlp import packed_mlp_forward
+from model.slot_mlp import SlotMLP
 
 # Note that Reward Generating model is the Discriminator in this context
-class Discriminator_RewardModel(nn.Module):
-    def __init__(self, input_size, output_size, n_hidden, hidden_dim):
+class Discriminator_RewardModel(SlotMLP):
+    def __init__(self, input_size, output_size, n_hidden, hidden_dim, checkpoint_segments=0):
         """
         input_size: should equal (num_displayed_items*feature_dims) + state_dim.
         output_size: should equal (num_displayed_items+1). 
         n_hidden: number of hidden layers of the Discriminator model's MLP.
         hidden_dim: hidden dimension of the layers of the Discriminator model's MLP.
+        checkpoint_segments: if > 0, the MLP is split into this many segments and the activations inside every segment are recomputed during backward (activation checkpointing).
         """
         super().__init__()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.input_size = input_size
+        self.checkpoint_segments = checkpoint_segments
+        self.item_table = None # ItemTable of the item ids (sparse inputs), see GAN.set_item_features
         layers = []
 
         layers.extend([torch.nn.Linear(input_size, hidden_dim),torch.nn.ReLU()])
@@ -27,31 +31,24 @@ class Discriminator_RewardModel(nn.Module):
          
         self.model = torch.nn.Sequential(*layers) # (inp_0 inp_1 .. inp_k) --> classification(inp_0, inp_1, .. inp_k) 
 
-    def forward(self, state, displayed_items):
+    def forward(self, state, displayed_items, packed_output=False):
         """
         Inputs:
             Input:
-                state (torch.Tensor): [max(num_time_steps), state_dim]
-                displayed_items (torch.Tensor): [max(num_time_steps), num_displayed_item, feature_dim]
+                state (rnn.PackedSequence or torch.Tensor): [batch_size (#users), max(num_time_steps), state_dim]
+                displayed_items (rnn.PackedSequence or torch.Tensor): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim], or the item ids
+                    [batch_size (#users), max(num_time_steps), num_displayed_item] (sparse inputs, requires item_table).
+                packed_output (bool): if True (and the inputs are packed), the rewards are returned as a PackedSequence of the valid time steps.
             Returns:
                 reward (torch.float): reward value for taking the action at the given state. 
                 [batch_size (#users), num_time_steps, (num_displayed_items+1)]
         """
+        if isinstance(state, torch.nn.utils.rnn.PackedSequence) and isinstance(displayed_items, torch.nn.utils.rnn.PackedSequence):
+            # the MLP only runs on the valid time steps (the rows of the packed data)
+            return packed_mlp_forward(self.mlp, state, displayed_items, packed_output=packed_output)
         # Convert rnn.PackedSequences to simple Tensors
         if isinstance(state, torch.nn.utils.rnn.PackedSequence):
             state, _ = torch.nn.utils.rnn.pad_packed_sequence(state, batch_first=True)
         if isinstance(displayed_items, torch.nn.utils.rnn.PackedSequence):
             displayed_items, lens_displayed_item = torch.nn.utils.rnn.pad_packed_sequence(displayed_items, batch_first=True)
-        
-        # Prepare input
-        batch_size = state.shape[0] # B
-        num_time_steps = displayed_items.shape[1] # L
-        # concat zero vector to displayed items to represent user not clicking on any of the displayed items
-        not_clicking_feature_vec = torch.zeros((batch_size, num_time_steps, 1, displayed_items.shape[-1])) # --> [batch_size (#users), max(num_time_steps), 1, feature_dim]
-        displayed_items = torch.cat((displayed_items.to(self.device), not_clicking_feature_vec.to(self.device)), -2) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1), feature_dims]
-        displayed_items_flat = displayed_items.view(batch_size, num_time_steps, -1) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)*feature_dims]
-        input_features = torch.cat((displayed_items_flat, state), dim=-1) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items*feature_dims) + state_dim]
-        
-            
-        return self.model(input_features) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-        
\ No newline at end of file
+        return self.mlp(state, displayed_items) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
@@ -1,14 +1,16 @@
-from distutils.command.config import config
 import torch
-import numpy as np
 # import custom models
 from model.historyLSTM import History_LSTM
+from model.historyGRU import History_GRU
 from model.generator import Generator_UserModel
 from model.discriminator import Discriminator_RewardModel
-import matplotlib.pyplot as plt
+from model.sparse_inputs import ItemTable, is_item_ids
+from model.sampled_softmax import valid_slots, slot_click_frequencies, sample_candidates, sampled_softmax_log_likelihood
 import os
+import time
 
 def plot_results(dreal_losses, dfake_losses, val_dreal_losses, val_dfake_losses):
+    import matplotlib.pyplot as plt # imported when it is used, it is slow to import (startup of main.py)
     plt.figure()
     plt.plot(list(range(1, len(dreal_losses)+1)), dreal_losses, marker='o', label="dreal_loss")
     plt.plot(list(range(1, len(dfake_losses)+1)), dfake_losses, marker='*', label="dfake_loss")
@@ -29,6 +31,24 @@ def plot_results(dreal_losses, dfake_losses, val_dreal_losses, val_dfake_losses)
 
     plt.show()
 
+def expand_slot_columns(weight, old_feature_dim, new_feature_dim, num_slots, mean_init=True):
+    """
+    Input:
+        weight (torch.Tensor): [out_features, num_slots*old_feature_dim + rest] weight whose input is num_slots item feature vectors followed by rest other inputs (e.g. the state).
+        old_feature_dim (int), new_feature_dim (int): feature_dim of the items before/after the expansion.
+        num_slots (int): number of item feature vectors in the input.
+        mean_init (bool): if True, the columns of the new feature dims are the mean of the old columns of the slot, zeros otherwise.
+    Return:
+        expanded_weight (torch.Tensor): [out_features, num_slots*new_feature_dim + rest]
+    """
+    slots = weight[:, :num_slots * old_feature_dim].reshape(weight.shape[0], num_slots, old_feature_dim) # --> [out_features, num_slots, old_feature_dim]
+    if mean_init:
+        new_columns = slots.mean(dim=-1, keepdim=True).expand(-1, -1, new_feature_dim - old_feature_dim)
+    else:
+        new_columns = torch.zeros((weight.shape[0], num_slots, new_feature_dim - old_feature_dim), dtype=weight.dtype, device=weight.device)
+    expanded_slots = torch.cat((slots, new_columns), dim=-1).reshape(weight.shape[0], -1) # --> [out_features, num_slots*new_feature_dim]
+    return torch.cat((expanded_slots, weight[:, num_slots * old_feature_dim:]), dim=1)
+
 # Note that GAN is a model which orchestrated the mini-max game (training) between the  discriminator and the  generator model.
 class GAN():
     def __init__(self, config_dict, history_input_size, history_hidden_size, history_num_layers, \
@@ -59,28 +79,645 @@ class GAN():
             epochs (int): number of epochs to train.
         """
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.history_LSTM = History_LSTM(history_input_size, history_hidden_size, history_num_layers).to(self.device)
+        # "history_model" selects the recurrent state model ("lstm" or "gru", e.g. a distilled student, see distill.py). It is stored as self.history_LSTM either way.
+        history_model = config_dict.get("history_model", "lstm")
+        assert history_model in ["lstm", "gru"], f"unknown history_model: {history_model}"
+        assert history_model == "lstm" or not config_dict.get("tbptt_window"), "tbptt_window requires the History_LSTM"
+        history_model_class = History_LSTM if history_model == "lstm" else History_GRU
+        self.history_LSTM = history_model_class(history_input_size, history_hidden_size, history_num_layers).to(self.device)
         self.generator_UserModel = Generator_UserModel(generator_input_size, generator_output_size, generator_n_hidden, generator_hidden_dim).to(self.device)
         self.discriminator_RewardModel = Discriminator_RewardModel(discriminator_input_size, discriminator_output_size, discriminator_n_hidden, discriminator_hidden_dim).to(self.device)
         self.lr = lr
         self.betas = betas
         self.epochs = epochs
         self.config_dict = config_dict
+
+        # Activation checkpointing (trades recomputation in backward for memory)
+        self.history_LSTM.set_checkpoint_segments(config_dict.get("history_checkpoint_segments", 0))
+        self.generator_UserModel.checkpoint_segments = config_dict.get("generator_checkpoint_segments", 0)
+        self.discriminator_RewardModel.checkpoint_segments = config_dict.get("discriminator_checkpoint_segments", 0)
+        self.slot_proposal = None # proposal of the sampled softmax negatives (uniform over the valid slots if None), see set_slot_proposal
+
+        # Gradient accumulation: the discriminator and the generator phase take an optimizer step every n micro-batches (see phase_update)
+        self.accumulation_steps = {"discriminator": config_dict.get("discriminator_accumulation_steps", 1), \
+            "generator": config_dict.get("generator_accumulation_steps", 1)}
+        assert min(self.accumulation_steps.values()) >= 1, f"accumulation steps have to be >= 1: {self.accumulation_steps}"
+        self.lr_scaling = config_dict.get("lr_scaling")
+        assert self.lr_scaling in [None, "linear", "sqrt"], f"unknown lr_scaling: {self.lr_scaling}"
+        self.lr_warmup_steps = config_dict.get("lr_warmup_steps", 0)
         
     
-    def gan_training_loop(self, train_loader, validation_loader):
+    def init_optimizers(self):
+        """
+        Initializes the ADAM optimizers of the History_LSTM, Discriminator_RewardModel and Generator_UserModel.
+        """
+        self.history_LSTM_optimizer = torch.optim.Adam(self.history_LSTM.parameters(), lr=self.lr, betas=self.betas)
+        self.discriminator_optimizer = torch.optim.Adam(self.discriminator_RewardModel.parameters(), lr=self.lr, betas=self.betas)
+        self.generator_optimizer = torch.optim.Adam(self.generator_UserModel.parameters(), lr=self.lr, betas=self.betas)
+        self.accumulated_grads = {"discriminator": None, "generator": None} # phase --> summed gradients of the pending micro-batches
+        self.accumulated_micro_batches = {"discriminator": 0, "generator": 0}
+        self.optimizer_steps = {"discriminator": 0, "generator": 0, "history": 0} # optimizer steps of every phase and of the History_LSTM (lr warmup)
+
+
+    def load_checkpoints(self, load_optimizers=True):
+        """
+        Input:
+            load_optimizers (bool): if True, optimizer states are loaded from the checkpoints too (requires init_optimizers() to be called first).
+        Return:
+            loaded_epoch (int): epoch at which the checkpoints were saved.
+            dreal_loaded_loss (float): best real validation loss stored in the checkpoint.
+            dfake_loaded_loss (float): best fake validation loss stored in the checkpoint.
+        Loads history_lstm, generator, and discriminator from the checkpoints specified in the config_dict.
+        """
+        history_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_history_lstm_path"]), map_location=self.device)
+        generator_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_generator_path"]), map_location=self.device)
+        discriminator_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_discriminator_path"]), map_location=self.device)
+
+        self.history_LSTM.load_state_dict(history_ckpt["state_dict"])
+        self.generator_UserModel.load_state_dict(generator_ckpt["state_dict"])
+        self.discriminator_RewardModel.load_state_dict(discriminator_ckpt["state_dict"])
+
+        if load_optimizers:
+            self.history_LSTM_optimizer.load_state_dict(history_ckpt["optimizer_state_dict"])
+            self.discriminator_optimizer.load_state_dict(discriminator_ckpt["optimizer_state_dict"])
+            self.generator_optimizer.load_state_dict(generator_ckpt["optimizer_state_dict"])
+            # the lr warmup continues where it stopped (checkpoints of older versions start it again)
+            self.optimizer_steps.update(generator_ckpt.get("optimizer_steps", {}))
+
+        loaded_epoch = generator_ckpt["epoch"]
+        dreal_loaded_loss = generator_ckpt["dreal_loss"]
+        dfake_loaded_loss = generator_ckpt["dfake_loss"]
+        print(f"Loaded History_lstm, Discriminator, and Generator from saved ckpt. Loaded epoch:{loaded_epoch}, \
+            Loaded best real validation loss: {dreal_loaded_loss}, Loaded best fake validation loss: {dfake_loaded_loss}")
+        return loaded_epoch, dreal_loaded_loss, dfake_loaded_loss
+
+
+    def set_item_features(self, item_features):
+        """
+        Input:
+            item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features.
+        Enables the sparse input path: batches of Datasets built with sparse_inputs=True hold item ids, whose feature vectors
+        are never materialized (the models gather the weight columns of their nonzero features, see model/sparse_inputs.py).
+        """
+        item_table = ItemTable(item_features).to(self.device)
+        for model in [self.history_LSTM, self.generator_UserModel, self.discriminator_RewardModel]:
+            model.item_table = item_table
+
+
+    def set_slot_proposal(self, clicked_items):
+        """
+        Input:
+            clicked_items (torch.Tensor): [num_steps] display set index of the clicked items of the train split (Dataset.clicked_items_index).
+        The negatives of the sampled softmax objective (sampled_softmax_negatives) are sampled in proportion to the click frequency
+        of the display slots instead of uniformly (the log-Q correction accounts for the proposal).
+        """
+        self.slot_proposal = slot_click_frequencies(clicked_items, self.config_dict["generator_output_size"]).to(self.device)
+
+
+    def prepare_training(self, train_dataset):
+        """
+        Input:
+            train_dataset (Dataset): train split the models are trained on.
+        Sets up the training state that depends on the train data, i.e. the "clicks" proposal of the sampled softmax negatives
+        (sampled_softmax_proposal, see set_slot_proposal). Called by gan_training_loop; scripts that call train_step directly
+        have to call it too (after init_optimizers).
+        """
+        assert self.config_dict.get("sampled_softmax_proposal", "uniform") in ["uniform", "clicks"], f"unknown sampled_softmax_proposal: {self.config_dict['sampled_softmax_proposal']}"
+        if self.config_dict.get("sampled_softmax_negatives") and self.config_dict.get("sampled_softmax_proposal", "uniform") == "clicks":
+            self.set_slot_proposal(train_dataset.clicked_items_index)
+
+
+    def sampled_click_log_likelihood(self, model, states, display_set, clicked_items, num_negatives):
+        """
+        Input:
+            model (Generator_UserModel or Discriminator_RewardModel): scores the slots.
+            states (torch.Tensor): [sum(num_time_steps), state_dim] packed data of the states.
+            display_set (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim]
+            clicked_items (rnn.PackedSequence): [batch_size (#users), max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
+            num_negatives (int): number of sampled negative slots per time step.
+        Return:
+            log_likelihood (torch.Tensor): [sum(num_time_steps)] log-Q corrected sampled softmax log probability of the clicked item
+                of every valid time step, only the clicked slot and the sampled slots are scored (see model/sampled_softmax.py).
+            clicked_scores (torch.Tensor): [sum(num_time_steps)] MLP output (after the output activation) of the clicked slot, i.e. the
+                score that the full display set path gives the click (e.g. the reward of the click for the validation scale dreal_loss).
+        """
+        valid = valid_slots(display_set.data, self.history_LSTM.item_table) # --> [sum(num_time_steps), (num_displayed_items+1)]
+        candidates, log_expected_counts = sample_candidates(clicked_items.data, valid, num_negatives, self.slot_proposal) # --> [sum(num_time_steps), 1+num_negatives]
+        candidate_logits = model.mlp(states, display_set.data, slots=candidates) # --> [sum(num_time_steps), 1+num_negatives]
+        return sampled_softmax_log_likelihood(candidate_logits, candidates, log_expected_counts), model.model[-1](candidate_logits[:, 0])
+
+
+    def snapshot(self, models_only=False):
+        """
+        Input:
+            models_only (bool): if True, only the model states are copied (e.g. for a validation that never saves the snapshot).
+        Return:
+            snapshot (dict): {"models": {name: state_dict}, "optimizers": {name: state_dict}, "optimizer_steps": dict} CPU copies of the current model and
+                optimizer states (names: "history_LSTM", "generator_UserModel", "discriminator_RewardModel"). Training can continue
+                without changing the snapshot, which can be validated (see model/background_validation.py) and saved (see save_checkpoints) later.
+        """
+        def to_cpu(obj):
+            if torch.is_tensor(obj):
+                return obj.detach().cpu().clone()
+            if isinstance(obj, dict):
+                return {key: to_cpu(value) for key, value in obj.items()}
+            if isinstance(obj, (list, tuple)):
+                return type(obj)(to_cpu(value) for value in obj)
+            return obj
+
+        models = {"history_LSTM": to_cpu(self.history_LSTM.state_dict()), "generator_UserModel": to_cpu(self.generator_UserModel.state_dict()), \
+            "discriminator_RewardModel": to_cpu(self.discriminator_RewardModel.state_dict())}
+        if models_only:
+            return {"models": models}
+        return {"models": models, "optimizer_steps": dict(self.optimizer_steps), \
+                "optimizers": {"history_LSTM": to_cpu(self.history_LSTM_optimizer.state_dict()), "generator_UserModel": to_cpu(self.generator_optimizer.state_dict()), \
+                    "discriminator_RewardModel": to_cpu(self.discriminator_optimizer.state_dict())}}
+
+
+    def save_checkpoints(self, epoch, dfake_loss, dreal_loss, snapshot=None):
+        """
+        Input:
+            epoch (int): epoch at which the checkpoints are saved.
+            dfake_loss (float): fake validation loss of the saved models.
+            dreal_loss (float): real validation loss of the saved models.
+            snapshot (dict): if given, the states of this snapshot (see snapshot()) are saved instead of the current states.
+        Saves history_lstm, generator, and discriminator (together with their optimizers and the optimizer step counts) to the checkpoints
+        specified in the config_dict.
+        """
+        if not os.path.exists(self.config_dict["ckpt_path"]):
+            os.mkdir(self.config_dict["ckpt_path"])
+
+        for name, model, optimizer, path_key in [("history_LSTM", self.history_LSTM, self.history_LSTM_optimizer, "pretrained_history_lstm_path"), \
+            ("generator_UserModel", self.generator_UserModel, self.generator_optimizer, "pretrained_generator_path"), \
+                ("discriminator_RewardModel", self.discriminator_RewardModel, self.discriminator_optimizer, "pretrained_discriminator_path")]:
+            torch.save({
+                'epoch': epoch,
+                'state_dict': model.state_dict() if snapshot is None else snapshot["models"][name],
+                'optimizer_state_dict': optimizer.state_dict() if snapshot is None else snapshot["optimizers"][name],
+                'optimizer_steps': dict(self.optimizer_steps) if snapshot is None else snapshot["optimizer_steps"],
+                'dfake_loss': float(dfake_loss),
+                'dreal_loss': float(dreal_loss),
+            }, os.path.join(self.config_dict["ckpt_path"], self.config_dict[path_key]))
+
+
+    def expand_feature_dim(self, new_feature_dim):
+        """
+        Input:
+            new_feature_dim (int): new feature_dim of the items (>= the current one), e.g. after the one hot item features were extended by unseen items.
+        Grows the input weights of the History_LSTM (weight_ih_l0) and of the first layers of the Generator_UserModel and Discriminator_RewardModel
+        (every display set slot) by the new feature dims, which are appended to the existing ones of every item (see expand_slot_columns).
+        The History_LSTM weights of the new feature dims start as the mean weight of the existing feature dims (a new clicked item looks like
+        an average item), the MLP weights start at zero: the padding placeholder of the display sets is all ones in the new dims too, so any
+        other MLP initialization would change the outputs of the old inputs. All other weights are kept, so old inputs (zero padded to the
+        new feature_dim) give the same outputs as before, which is checked on a random probe with padded display sets. The Adam states are
+        expanded with zeros and the optimizer step counts are kept. Requires init_optimizers() to be called first.
+        """
+        old_feature_dim = self.config_dict["history_input_size"]
+        assert new_feature_dim >= old_feature_dim, "the feature_dim can only grow"
+        if new_feature_dim == old_feature_dim:
+            return
+        num_slots = self.config_dict["generator_output_size"] # (num_displayed_items+1) item slots, followed by the state
+
+        def expand_optimizer_state(optimizer, num_slots):
+            # the expanded weight is the first parameter of every model
+            state_dict = optimizer.state_dict()
+            for key in ["exp_avg", "exp_avg_sq"]:
+                if 0 in state_dict["state"]:
+                    state_dict["state"][0][key] = expand_slot_columns(state_dict["state"][0][key], old_feature_dim, new_feature_dim, num_slots, mean_init=False)
+            return state_dict
+
+        optimizer_state_dicts = [expand_optimizer_state(self.history_LSTM_optimizer, 1), \
+            expand_optimizer_state(self.generator_optimizer, num_slots), expand_optimizer_state(self.discriminator_optimizer, num_slots)]
+
+        def probe_outputs(feature_dim):
+            # old items are zero padded in the new dims, the padding placeholder is all ones in every dim
+            features = torch.cat((probe_items, torch.zeros(probe_items.shape[:-1] + (feature_dim - old_feature_dim,), device=self.device)), -1)
+            clicked_items = features[:, :1].clone() # --> [8, 1, feature_dim] a one step click history
+            features[:, (num_slots - 1) // 2:] = 1.0 # padded display slots
+            with torch.no_grad():
+                return [self.history_LSTM(clicked_items), self.generator_UserModel.mlp(probe_state, features), \
+                    self.discriminator_RewardModel.mlp(probe_state, features)]
+
+        probe_items = torch.rand((8, num_slots - 1, old_feature_dim), device=self.device) # --> [8, num_displayed_items, old_feature_dim]
+        probe_state = torch.rand((8, self.generator_UserModel.input_size - num_slots * old_feature_dim), device=self.device) # --> [8, state_dim]
+        old_outputs = probe_outputs(old_feature_dim)
+
+        with torch.no_grad():
+            rnn = self.history_LSTM.gru_model if hasattr(self.history_LSTM, "gru_model") else self.history_LSTM.lstm_model
+            rnn.weight_ih_l0 = torch.nn.Parameter(expand_slot_columns(rnn.weight_ih_l0, old_feature_dim, new_feature_dim, 1))
+            rnn.input_size = new_feature_dim
+            for model in [self.generator_UserModel, self.discriminator_RewardModel]:
+                first_layer = model.model[0]
+                expanded_layer = torch.nn.Linear(first_layer.in_features + num_slots * (new_feature_dim - old_feature_dim), first_layer.out_features).to(first_layer.weight.device)
+                expanded_layer.weight.copy_(expand_slot_columns(first_layer.weight, old_feature_dim, new_feature_dim, num_slots, mean_init=False))
+                expanded_layer.bias.copy_(first_layer.bias)
+                model.model[0] = expanded_layer
+                model.input_size = expanded_layer.in_features
+
+        self.config_dict["history_input_size"] = new_feature_dim
+        self.config_dict["generator_input_size"] = self.generator_UserModel.input_size
+        self.config_dict["discriminator_input_size"] = self.discriminator_RewardModel.input_size
+
+        for old_output, new_output in zip(old_outputs, probe_outputs(new_feature_dim)):
+            assert torch.allclose(old_output, new_output, atol=1e-6), "the expansion changed the outputs of the old inputs"
+
+        # the optimizers have to point to the new parameters
+        optimizer_steps = self.optimizer_steps
+        self.init_optimizers()
+        self.optimizer_steps = optimizer_steps # lr warmup
+        for optimizer, state_dict in zip([self.history_LSTM_optimizer, self.generator_optimizer, self.discriminator_optimizer], optimizer_state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+    def generated_rewards(self, real_click_history_unpacked, display_set, generated_action_indices, generated_action_vectors, hidden=None):
+        """
+        Input:
+            real_click_history_unpacked (torch.Tensor): [batch_size (#users), max(num_time_steps), feature_dim] padded real user click history.
+            display_set (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim]
+            generated_action_indices (torch.Tensor): [batch_size (#users), num_time_steps] indices of the actions chosen by the generator_UserModel.
+            generated_action_vectors (torch.Tensor): [batch_size (#users), num_time_steps, feature_dims] feature vectors of the generated actions.
+            hidden (tuple): (h, c) History_LSTM states carried over from the previous window (see train_step_windowed), each [num_layers, batch_size (#users), state_dim].
+                If given, the rollouts start from these states and the first time step is rolled out too.
+        Return:
+            gen_reward (torch.Tensor): total reward of the generated actions. For every time step t the generated action is appended
+                to the real user's click history up to t and the discriminator_RewardModel scores the resulting state.
+        """
+        # generated_action_vectors --> [batch_size (#users), num_time_steps, feature_dims]
+        display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
+        class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
+        gen_reward = torch.tensor(0).float().to(self.device)
+        for b in range(generated_action_vectors.shape[0]): # index on batch_size
+            cur_hidden = None if hidden is None else (hidden[0][:, b:b+1, :].contiguous(), hidden[1][:, b:b+1, :].contiguous()) # --> [num_layers, 1, state_dim]
+            for t in range(0 if hidden is not None else 1, generated_action_vectors.shape[1]): # index on num_time_steps (L)
+                cur_generated_action_vector = generated_action_vectors[b, t].to(self.device) # --> [feature_dim] (item id for sparse inputs)
+                cur_real_past_actions = real_click_history_unpacked[b, :t].to(self.device) # --> [t, feature_dim] ([t] for sparse inputs)
+                # append generated action to past history from the real user
+                cur_generated_action_with_history = torch.cat((cur_real_past_actions, cur_generated_action_vector.unsqueeze(0)), dim=0) # --> [t+1, feature_dim]
+                cur_generated_action_with_history = cur_generated_action_with_history.unsqueeze(0) # --> [1, t+1, feature_dim]
+                # obtain new state representations after taking the current generated action
+                cur_fake_state = self.history_LSTM(cur_generated_action_with_history, cur_hidden) # --> [1, t+1, state_dim]
+
+                # calculate the reward for the currently generated action
+                cur_display_set = display_set_unpacked[b, :t+1].unsqueeze(0) # --> [1, t+1, num_displayed_item, feature_dim] ([1, t+1, num_displayed_item] for sparse inputs)
+                cur_dfake_reward = self.discriminator_RewardModel(cur_fake_state, cur_display_set) # --> [1, t+1, (num_displayed_items+1)]
+
+                # Calculate the rewards for the generated user actions by masking by the generated rewards for all of the possible acitons in the display_set
+                cur_generated_action_indices = generated_action_indices[b, :t+1].unsqueeze(0) # --> [1, t+1]
+                cur_clicked_item_mask = torch.nn.functional.one_hot(cur_generated_action_indices, num_classes= class_num) # --> [1, t+1, (num_displayed_items+1)]
+
+                cur_gen_reward = cur_dfake_reward * cur_clicked_item_mask.float() # --> [1, t+1, (num_displayed_items+1)]
+                gen_reward += torch.sum(cur_gen_reward) / cur_gen_reward.shape[1]
+
+        return gen_reward
+
+
+    def train_step(self, real_click_history, display_set, clicked_items):
+        """
+        Input:
+            real_click_history (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), feature_dim]
+            display_set (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim]
+            clicked_items (rnn.PackedSequence): [batch_size (#users), max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
+        Return:
+            dreal_loss (float): real loss of the batch (None if no update took place).
+            dfake_loss (float): fake loss of the batch (None if no update took place).
+        Performs a discriminator update followed by a generator update on the given batch.
+        If "tbptt_window" is set in the config_dict, the batch is trained in windows (see train_step_windowed).
+        Requires init_optimizers() and prepare_training() to be called first.
+        """
+        assert self.slot_proposal is not None or not self.config_dict.get("sampled_softmax_negatives") \
+            or self.config_dict.get("sampled_softmax_proposal", "uniform") != "clicks", "call prepare_training() before train_step()"
+        if self.config_dict.get("tbptt_window"):
+            return self.train_step_windowed(real_click_history, display_set, clicked_items, self.config_dict["tbptt_window"])
+
+        dreal_loss, dfake_loss, _ = self.adversarial_step(real_click_history, display_set, clicked_items)
+        return dreal_loss, dfake_loss
+
+
+    def train_step_windowed(self, real_click_history, display_set, clicked_items, window):
+        """
+        Input:
+            real_click_history (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), feature_dim]
+            display_set (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim]
+            clicked_items (rnn.PackedSequence): [batch_size (#users), max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
+            window (int): number of time steps per window.
+        Return:
+            dreal_loss (float): real loss summed over the windows (None if no update took place).
+            dfake_loss (float): fake loss summed over the windows (None if no update took place).
+        Truncated backpropagation through time: the sessions are split into windows of (at most) window time steps and
+        the GAN losses/updates are computed per window. The (h, c) states of the History_LSTM are carried (detached) from
+        one window to the next, so memory and step time are bounded by the window size instead of the longest session.
+        """
+        real_click_history_unpacked, lengths = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True) # --> [batch_size (#users), max(num_time_steps), feature_dim]
+        display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True) # --> [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim]
+        clicked_items_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(clicked_items, batch_first=True) # --> [batch_size (#users), max(num_time_steps)]
+
+        hidden = None # (h, c) --> [num_layers, batch_size (#users), state_dim]
+        total_dreal_loss = None
+        total_dfake_loss = None
+        for start in range(0, int(lengths.max()), window):
+            active_users = torch.nonzero(lengths > start).squeeze(-1) # users which still have time steps in this window
+            window_lengths = torch.clamp(lengths[active_users] - start, max=window)
+            end = start + int(window_lengths.max())
+
+            window_click_history, window_display_set, window_clicked_items = [torch.nn.utils.rnn.pack_padded_sequence(x[active_users, start:end], \
+                window_lengths, batch_first=True, enforce_sorted = False) for x in [real_click_history_unpacked, display_set_unpacked, clicked_items_unpacked]]
+            window_hidden = None if hidden is None else (hidden[0][:, active_users, :], hidden[1][:, active_users, :])
+
+            dreal_loss, dfake_loss, (h, c) = self.adversarial_step(window_click_history, window_display_set, window_clicked_items, hidden=window_hidden)
+
+            # carry the detached states over to the next window
+            if hidden is None:
+                hidden = (torch.zeros(h.shape[0], len(lengths), h.shape[-1], device=h.device), torch.zeros(c.shape[0], len(lengths), c.shape[-1], device=c.device))
+            hidden[0][:, active_users, :] = h.detach()
+            hidden[1][:, active_users, :] = c.detach()
+
+            if dfake_loss is not None:
+                total_dreal_loss = dreal_loss if total_dreal_loss is None else total_dreal_loss + dreal_loss
+                total_dfake_loss = dfake_loss if total_dfake_loss is None else total_dfake_loss + dfake_loss
+
+        return total_dreal_loss, total_dfake_loss
+
+
+    def phase_lr(self, phase):
+        """
+        Input:
+            phase (str): either ["discriminator", "generator", "history"] ("history": the History_LSTM, which steps in both phases).
+        Return:
+            lr (float): learning rate of the next optimizer step of the phase. The lr is scaled with the number n of accumulated
+                micro-batches ("lr_scaling": lr*sqrt(n) if "sqrt", lr*n if "linear") and warmed up linearly over the first
+                "lr_warmup_steps" optimizer steps of the phase. The History_LSTM has its own schedule: it steps once per phase step,
+                i.e. on average on the harmonic mean of the n of both phases, and counts its own steps.
+        Note that "sqrt" is the usual rule for Adam; "linear" is the rule of SGD and tends to be too large with Adam.
+        """
+        if phase == "history":
+            num_micro_batches = 2 / (1 / self.accumulation_steps["discriminator"] + 1 / self.accumulation_steps["generator"])
+        else:
+            num_micro_batches = self.accumulation_steps[phase]
+        lr = self.lr * {None: 1, "linear": num_micro_batches, "sqrt": num_micro_batches ** 0.5}[self.lr_scaling]
+        if self.lr_warmup_steps:
+            lr *= min(1.0, (self.optimizer_steps[phase] + 1) / self.lr_warmup_steps)
+        return lr
+
+
+    def phase_update(self, phase, loss):
+        """
+        Input:
+            phase (str): either ["discriminator", "generator"], the History_LSTM is updated together with the model of the phase.
+            loss (torch.Tensor): loss of the phase on the current (micro-)batch.
+        Backpropagates the loss and takes an optimizer step of the History_LSTM and the model of the phase. With gradient accumulation
+        (n = "discriminator_accumulation_steps"/"generator_accumulation_steps" > 1) the gradients of the phase are moved to a separate buffer
+        after every backward pass (the History_LSTM gets gradients in both phases) and the optimizers step on their mean every n micro-batches,
+        i.e. every micro-batch loss keeps its own normalization and the accumulated loss is the mean over the micro-batches.
+        Note that with "tbptt_window" every window is a micro-batch (a batch of sessions split into w windows counts as w micro-batches).
+        """
+        model = self.discriminator_RewardModel if phase == "discriminator" else self.generator_UserModel
+        self.history_LSTM_optimizer.zero_grad()
+        self.generator_optimizer.zero_grad()
+        self.discriminator_optimizer.zero_grad()
+        loss.backward()
+        if self.accumulation_steps[phase] == 1:
+            self.step_phase(phase)
+            return
+
+        params = list(self.history_LSTM.parameters()) + list(model.parameters())
+        if self.accumulated_grads[phase] is None:
+            self.accumulated_grads[phase] = [None] * len(params)
+        accumulated_grads = self.accumulated_grads[phase]
+        for i, param in enumerate(params):
+            if param.grad is not None:
+                if accumulated_grads[i] is None:
+                    accumulated_grads[i] = param.grad
+                else:
+                    accumulated_grads[i].add_(param.grad)
+                param.grad = None
+        self.accumulated_micro_batches[phase] += 1
+        if self.accumulated_micro_batches[phase] == self.accumulation_steps[phase]:
+            self.flush_accumulated_gradients(phase)
+
+
+    def step_phase(self, phase):
+        """
+        Takes an optimizer step of the History_LSTM and the model of the phase on the current gradients.
+        """
+        optimizer = self.discriminator_optimizer if phase == "discriminator" else self.generator_optimizer
+        if self.lr_scaling is not None or self.lr_warmup_steps:
+            for param_group in optimizer.param_groups:
+                param_group["lr"] = self.phase_lr(phase)
+            for param_group in self.history_LSTM_optimizer.param_groups:
+                param_group["lr"] = self.phase_lr("history")
+        self.history_LSTM_optimizer.step()
+        optimizer.step()
+        self.optimizer_steps[phase] += 1
+        self.optimizer_steps["history"] += 1
+
+
+    def flush_accumulated_gradients(self, phase=None):
+        """
+        Input:
+            phase (str): phase whose accumulated gradients are applied (both phases if None).
+        Takes the optimizer step of the pending micro-batches (fewer than n at the end of an epoch) on the mean of their gradients.
+        """
+        for phase in ["discriminator", "generator"] if phase is None else [phase]:
+            if not self.accumulated_micro_batches[phase]:
+                continue
+            model = self.discriminator_RewardModel if phase == "discriminator" else self.generator_UserModel
+            for param, grad in zip(list(self.history_LSTM.parameters()) + list(model.parameters()), self.accumulated_grads[phase]):
+                param.grad = None if grad is None else grad.div_(self.accumulated_micro_batches[phase])
+            self.step_phase(phase)
+            self.history_LSTM_optimizer.zero_grad()
+            (self.discriminator_optimizer if phase == "discriminator" else self.generator_optimizer).zero_grad()
+            self.accumulated_grads[phase] = None
+            self.accumulated_micro_batches[phase] = 0
+
+
+    def adversarial_step(self, real_click_history, display_set, clicked_items, hidden=None):
+        """
+        Input:
+            real_click_history (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), feature_dim]
+            display_set (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim]
+            clicked_items (rnn.PackedSequence): [batch_size (#users), max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
+            hidden (tuple): initial (h, c) states of the History_LSTM, each [num_layers, batch_size (#users), state_dim]. Zero states are used if None.
+        Return:
+            dreal_loss (float): real loss of the batch (None if no update took place).
+            dfake_loss (float): fake loss of the batch (None if no update took place).
+            (h, c) (tuple): final states of the History_LSTM for the real click history.
+        Performs a single discriminator update followed by a single generator update on the given batch (the updates are
+        accumulated over micro-batches if "discriminator_accumulation_steps"/"generator_accumulation_steps" > 1, see phase_update).
+        """
+        real_click_history = real_click_history.to(self.device)
+        display_set = display_set.to(self.device)
+        clicked_items = clicked_items.to(self.device)
+
+        # Updating the discriminator, here is a pseudocode
+        # call zero grad
+        # pass the real actions through D
+        # calculate d_real loss
+        # generate fake user actions
+        # pass the generated_user_actions through D
+        # calculate d_fake loss
+        # sum the two losses
+        # call backward and take optimizer step
+
+
+
+        # ************************************ discriminator_RewardModel Loss Calculation below: ************************************
+        # only the discriminator_RewardModel (and the History_LSTM) is trained in this phase, the flags have to be set before the
+        # forward pass: parameters that do not require grad are not recorded in the graph (and checkpointed segments are recomputed with the same flags)
+        for param in self.discriminator_RewardModel.parameters():
+            param.requires_grad = True
+        for param in self.generator_UserModel.parameters():
+            param.requires_grad = False
+
+        # Obtain state representations given the real user's past click history
+        real_states, real_hidden = self.history_LSTM(real_click_history, hidden, return_hidden=True) # --> [batch_size (#users)=1, num_time_steps, state_dim]
+        num_negatives = self.config_dict.get("sampled_softmax_negatives")
+        if num_negatives:
+            # sampled softmax: the reward of the clicked item against num_negatives sampled slots (instead of the one hot mask over all slots).
+            # The objective is the log likelihood, the reported dreal_loss stays the mean reward of the clicks (the scale of validation/test).
+            log_likelihood, clicked_rewards = self.sampled_click_log_likelihood(self.discriminator_RewardModel, real_states.data, display_set, clicked_items, num_negatives)
+            dreal_objective, dreal_loss = log_likelihood.mean(), clicked_rewards.mean()
+        else:
+            # Calculate the rewards for all of the possible actions (items in the (display_set+1))
+            dreal_reward = self.discriminator_RewardModel.forward(real_states, display_set) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
+
+            # Calculate the rewards for the real user actions by masking by the actions taken by the real user
+            class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
+            clicked_items_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(clicked_items, batch_first=True)
+            clicked_item_mask = torch.nn.functional.one_hot(clicked_items_unpacked.long(), num_classes= class_num) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
+            gt_reward = dreal_reward * clicked_item_mask.float()
+            _, total_unpadded_num_time_steps = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
+            dreal_loss = torch.sum(gt_reward) / sum(total_unpadded_num_time_steps) # avg loss/rewards for the real user actions (gt)
+            dreal_objective = dreal_loss
+
+
+
+        # ========== generator_UserModel Loss Calculation below:
+        # Obtain generated user action's indices/feature vectors for 1 time step ahead given the past real users state representation
+        with torch.no_grad():
+            generated_action_indices , generated_action_vectors = self.generator_UserModel.generate_actions(real_states, display_set)  # --> [batch_size (#users), num_time_steps] , [batch_size (#users), num_time_steps, feature_dims]
+        # convert rnn.PackedSequence to Tensor
+        real_click_history_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
+        gen_reward = self.generated_rewards(real_click_history_unpacked, display_set, generated_action_indices, generated_action_vectors, hidden=hidden)
+
+        dfake_loss = gen_reward # total loss/rewards for the real user actions (gt)
+
+        # Update Disciriminator (Reward) model
+        # ============ loss backpropagation:
+        combined_loss = dfake_loss - dreal_objective
+        if combined_loss.requires_grad:
+            # Backprop discriminator_RewardModel
+            # Note that discriminator_RewardModel tries to minimize the combined_loss
+            self.phase_update("discriminator", combined_loss)
+
+
+
+
+        # ************************************ generator_UserModel Loss Calculation below: ************************************
+        for param in self.generator_UserModel.parameters():
+            param.requires_grad = True
+        for param in self.discriminator_RewardModel.parameters():
+            param.requires_grad = False
+        # Obtain generated user action's indices/feature vectors for 1 time step ahead given the past real users state representation
+        generated_action_indices , generated_action_vectors = self.generator_UserModel.generate_actions(real_states, display_set)  # --> [batch_size (#users), num_time_steps] , [batch_size (#users), num_time_steps, feature_dims]
+        # generated_action_vectors --> [batch_size (#users), num_time_steps, feature_dims]
+        gen_reward = self.generated_rewards(real_click_history_unpacked, display_set, generated_action_indices, generated_action_vectors, hidden=hidden)
+
+        dfake_loss = -1 * gen_reward # total loss/rewards for the real user actions (gt)
+        combined_loss = dfake_loss
+        if num_negatives:
+            # sampled softmax: the generator_UserModel also learns to rank the clicked item above num_negatives sampled slots
+            # (the states are detached, the graph of the History_LSTM was freed by the discriminator update). The reported dfake_loss stays -gen_reward.
+            combined_loss = combined_loss - self.sampled_click_log_likelihood(self.generator_UserModel, real_states.data.detach(), display_set, clicked_items, num_negatives)[0].mean()
+
+        # ============ loss backpropagation:
+        if combined_loss.requires_grad:
+            # backprop generator_UserModel
+            # Note that generator_UserModel tries to maximize the combined_loss
+            self.phase_update("generator", combined_loss)
+
+            return dreal_loss.detach().cpu().numpy(), dfake_loss.detach().cpu().numpy(), real_hidden
+
+        return None, None, real_hidden
+
+
+    def validation_step(self, real_click_history, display_set, clicked_items):
+        """
+        Input:
+            real_click_history (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), feature_dim]
+            display_set (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim]
+            clicked_items (rnn.PackedSequence): [batch_size (#users), max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
+        Return:
+            dreal_loss (float): real loss of the batch.
+            dfake_loss (float): fake loss of the batch.
+        """
+        real_click_history = real_click_history.to(self.device)
+        display_set = display_set.to(self.device)
+        clicked_items = clicked_items.to(self.device)
+
+        with torch.no_grad():
+             # Obtain state representations given the real user's past click history
+            real_states = self.history_LSTM(real_click_history) # --> [batch_size (#users)=1, num_time_steps, state_dim]
+            # Calculate the rewards for all of the possible actions (items in the (display_set+1))
+            dreal_reward = self.discriminator_RewardModel.forward(real_states, display_set) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
+
+            # Calculate the rewards for the real user actions by masking by the actions taken by the real user
+            class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
+            clicked_items_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(clicked_items, batch_first=True)
+            clicked_item_mask = torch.nn.functional.one_hot(clicked_items_unpacked.long(), num_classes= class_num) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
+            gt_reward = dreal_reward * clicked_item_mask.float()
+            dreal_loss = torch.sum(gt_reward) / dreal_reward.shape[1] # avg loss/rewards for the real user actions (gt)
+
+
+
+            # ========== generator_UserModel Loss Calculation below:
+            # Obtain generated user action's indices/feature vectors for 1 time step ahead given the past real users state representation
+            generated_action_indices , generated_action_vectors = self.generator_UserModel.generate_actions(real_states, display_set)  # --> [batch_size (#users), num_time_steps] , [batch_size (#users), num_time_steps, feature_dims]
+            # convert rnn.PackedSequence to Tensor
+            real_click_history_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
+            gen_reward = self.generated_rewards(real_click_history_unpacked, display_set, generated_action_indices, generated_action_vectors)
+
+            dfake_loss = -1 * gen_reward # total loss/rewards for the real user actions (gt)
+
+        return dreal_loss.detach().cpu().numpy(), dfake_loss.detach().cpu().numpy()
+
+
+    def validate(self, validation_loader):
+        """
+        Input:
+            validation_loader (torch.utils.data.DataLoader): validation DataLoader
+        Return:
+            val_cur_dreal_loss (float): total real loss over the validation set.
+            val_cur_dfake_loss (float): total fake loss over the validation set.
+        """
+        val_cur_dreal_loss = 0 # total loss for cur batch
+        val_cur_dfake_loss = 0 # total loss for cur batch
+        for real_click_history, display_set, clicked_items  in validation_loader:
+            # real_click_history --> [max(num_time_steps), feature_dim]
+            # display_set --> [max(num_time_steps), num_displayed_item, feature_dim]
+            # clicked_items --> [max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
+            dreal_loss, dfake_loss = self.validation_step(real_click_history, display_set, clicked_items)
+
+            # record losses
+            val_cur_dfake_loss += dfake_loss
+            val_cur_dreal_loss += dreal_loss
+
+        return val_cur_dreal_loss, val_cur_dfake_loss
+
+
+    def gan_training_loop(self, train_loader, validation_loader, start_time=None):
         """
         Input:
             train_loader (torch.Tensor): training DataLoader
-            test_loader (torch.Tensor): training DataLoader 
+            test_loader (torch.Tensor): training DataLoader
+            start_time (float): if given (time.perf_counter() at the start of the process), the time from it to the end of the
+                first train step is printed and stored as self.time_to_first_step.
         Return:
             generated_actions (torch.tensor): Actions taken by the generator_UserModel.
             UserModel_rewards (torch.tensor): Reward values for the generator_UserModel generated actions.
             ground_truth_rewards (torch.tensor): Reward values for the ground truth actions.
         """
-        history_LSTM_optimizer = torch.optim.Adam(self.history_LSTM.parameters(), lr=self.lr, betas=self.betas)
-        discriminator_optimizer = torch.optim.Adam(self.discriminator_RewardModel.parameters(), lr=self.lr, betas=self.betas)
-        generator_optimizer = torch.optim.Adam(self.generator_UserModel.parameters(), lr=self.lr, betas=self.betas)
+        self.init_optimizers()
+        self.prepare_training(train_loader.dataset)
 
 
         # ============= Load models from ckpts
@@ -88,23 +725,7 @@ class GAN():
         dreal_loaded_loss = None
         dfake_loaded_loss = None
         if self.config_dict["load_pretrained"]:
-            history_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_history_lstm_path"]))
-            generator_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_generator_path"]))
-            discriminator_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_discriminator_path"]))
-
-            self.history_LSTM.load_state_dict(history_ckpt["state_dict"])
-            self.generator_UserModel.load_state_dict(generator_ckpt["state_dict"])
-            self.discriminator_RewardModel.load_state_dict(discriminator_ckpt["state_dict"])
-
-            history_LSTM_optimizer.load_state_dict(history_ckpt["optimizer_state_dict"])
-            discriminator_optimizer.load_state_dict(discriminator_ckpt["optimizer_state_dict"])
-            generator_optimizer.load_state_dict(generator_ckpt["optimizer_state_dict"])
-
-            loaded_epoch = generator_ckpt["epoch"]
-            dreal_loaded_loss = generator_ckpt["dreal_loss"]
-            dfake_loaded_loss = generator_ckpt["dfake_loss"]
-            print(f"Loaded History_lstm, Discriminator, and Generator from saved ckpt. Loaded epoch:{loaded_epoch}, \
-                Loaded best real validation loss: {dreal_loaded_loss}, Loaded best fkae validation loss: {dfake_loaded_loss}")
+            loaded_epoch, dreal_loaded_loss, dfake_loaded_loss = self.load_checkpoints()
         # ================
 
 
@@ -119,262 +740,95 @@ class GAN():
         print("Training GAN Model")
         print("*" * 30)
 
-        for epoch in range(self.epochs - loaded_epoch): 
+        # ============= Background validation: validation runs in a separate process on CPU snapshots of the weights while training continues
+        validator = None
+        validate_every_n_steps = self.config_dict.get("validate_every_n_steps")
+        if self.config_dict.get("background_validation", False):
+            from model.background_validation import BackgroundValidator # imports this module
+            validator = BackgroundValidator(self.config_dict, validation_loader.dataset, validation_loader.batch_size, \
+                subsample_size=self.config_dict.get("validation_subsample") if validate_every_n_steps else None, \
+                    num_threads=self.config_dict.get("validation_threads", 1))
+        pending_snapshots = {} # epoch --> snapshot, kept until its validation result decides whether it is saved
+        max_pending_snapshots = self.config_dict.get("max_pending_snapshots", 2)
+        assert max_pending_snapshots >= 1, f"max_pending_snapshots has to be >= 1: {max_pending_snapshots}"
+        dfake_best_val_loss = dfake_loaded_loss # best validation loss over all epochs (background validation)
+        self.step_val_losses = [] # (step, dreal_loss, dfake_loss) of the every-n-steps validations on the subsample
+        step = 0
+
+        def handle_validation_results(results):
+            nonlocal dfake_best_val_loss
+            for (kind, index), val_cur_dreal_loss, val_cur_dfake_loss in results:
+                if kind == "step":
+                    self.step_val_losses.append((index, val_cur_dreal_loss, val_cur_dfake_loss))
+                    print(f"step: {index}, subsample val_dreal_loss: {val_cur_dreal_loss}, val_dfake_loss: {val_cur_dfake_loss}")
+                    continue
+                snapshot = pending_snapshots.pop(index)
+                if (dfake_best_val_loss == None) or (dfake_best_val_loss >= val_cur_dfake_loss):
+                    dfake_best_val_loss = val_cur_dfake_loss
+                    self.save_checkpoints(index + loaded_epoch, dfake_best_val_loss, val_cur_dreal_loss, snapshot=snapshot)
+                    print("*" * 20)
+                    print(f"Saved model checkpoint at epoch: {index+loaded_epoch}")
+                val_dreal_losses.append(val_cur_dreal_loss)
+                val_dfake_losses.append(val_cur_dfake_loss)
+                print("_" * 25)
+                print(f"epoch: [{index+1+loaded_epoch}/{self.epochs}], train_dreal_loss: {dreal_losses[index]}, train_dfake_loss: {dfake_losses[index]} \
+                    val_dreal_loss: {val_cur_dreal_loss}, val_dfake_loss: {val_cur_dfake_loss}")
+                print("_" * 25)
+
+        for epoch in range(self.epochs - loaded_epoch):
             dreal_best_val_loss = None if dreal_loaded_loss == None else dreal_loaded_loss # best validation loss (used during saving checkpoints)
-            dfake_best_val_loss = None if dfake_loaded_loss == None else dfake_loaded_loss # best validation loss (used during saving checkpoints)
+            if validator is None:
+                dfake_best_val_loss = None if dfake_loaded_loss == None else dfake_loaded_loss # best validation loss (used during saving checkpoints)
             cur_dreal_loss = 0 # total loss for cur batch
             cur_dfake_loss = 0 # total loss for cur batch
             for real_click_history, display_set, clicked_items  in train_loader:
                 # real_click_history --> [max(num_time_steps), feature_dim]
                 # display_set --> [max(num_time_steps), num_displayed_item, feature_dim]
                 # clicked_items --> [max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
-                 
-                real_click_history = real_click_history.to(self.device)
-                display_set = display_set.to(self.device)
-                clicked_items = clicked_items.to(self.device)
-
-                # Updating the discriminator, here is a pseudocode        
-                # call zero grad
-                # pass the real actions through D
-                # calculate d_real loss
-                # generate fake user actions
-                # pass the generated_user_actions through D
-                # calculate d_fake loss
-                # sum the two losses
-                # call backward and take optimizer step
-
+                dreal_loss, dfake_loss = self.train_step(real_click_history, display_set, clicked_items)
+                if step == 0 and start_time is not None:
+                    self.time_to_first_step = time.perf_counter() - start_time
+                    print(f"Time to first train step: {self.time_to_first_step:.2f}s")
 
+                # record losses
+                if dfake_loss is not None:
+                    cur_dfake_loss += dfake_loss
+                    cur_dreal_loss += dreal_loss
 
-                # ************************************ discriminator_RewardModel Loss Calculation below: ************************************
-
-                # Obtain state representations given the real user's past click history
-                real_states = self.history_LSTM(real_click_history) # --> [batch_size (#users)=1, num_time_steps, state_dim]
-                # Calculate the rewards for all of the possible actions (items in the (display_set+1))
-                dreal_reward = self.discriminator_RewardModel.forward(real_states, display_set) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-                
-                # Calculate the rewards for the real user actions by masking by the actions taken by the real user
-                class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
-                clicked_items_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(clicked_items, batch_first=True)
-                clicked_item_mask = torch.nn.functional.one_hot(clicked_items_unpacked.long(), num_classes= class_num) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-                gt_reward = dreal_reward * clicked_item_mask.float()
-                _, total_unpadded_num_time_steps = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
-                dreal_loss = torch.sum(gt_reward) / sum(total_unpadded_num_time_steps) # avg loss/rewards for the real user actions (gt)
-
-
-
-                # ========== generator_UserModel Loss Calculation below: 
-                # Obtain generated user action's indices/feature vectors for 1 time step ahead given the past real users state representation
-                with torch.no_grad():
-                    generated_action_indices , generated_action_vectors = self.generator_UserModel.generate_actions(real_states, display_set)  # --> [batch_size (#users), num_time_steps] , [batch_size (#users), num_time_steps, feature_dims]
-                # convert rnn.PackedSequence to Tensor
-                real_click_history_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
-                # generated_action_vectors --> [batch_size (#users), num_time_steps, feature_dims]
-                gen_reward = torch.tensor(0).float().to(self.device)
-                for b in range(generated_action_vectors.shape[0]): # index on batch_size
-                    for t in range(1, generated_action_vectors.shape[1]): # index on num_time_steps (L)
-                        cur_generated_action_vector = generated_action_vectors[b, t, :].to(self.device) # --> [feature_dim]
-                        cur_real_past_actions = real_click_history_unpacked[b, :t, :].to(self.device) # --> [t, feature_dim]
-                        # append generated action to past history from the real user
-                        cur_generated_action_with_history = torch.cat((cur_real_past_actions, cur_generated_action_vector.unsqueeze(0)), dim=0) # --> [t+1, feature_dim]
-                        cur_generated_action_with_history = cur_generated_action_with_history.unsqueeze(0) # --> [1, t+1, feature_dim]
-                        # obtain new state representations after taking the current generated action
-                        cur_fake_state = self.history_LSTM(cur_generated_action_with_history) # --> [1, t+1, state_dim]
-
-                        # calculate the reward for the currently generated action
-                        display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
-                        cur_display_set = display_set_unpacked[b, :t+1, :, :].unsqueeze(0) # --> [1, t+1, num_displayed_item, feature_dim]
-                        cur_dfake_reward = self.discriminator_RewardModel(cur_fake_state, cur_display_set) # --> [1, t+1, (num_displayed_items+1)]
-
-                        # Calculate the rewards for the generated user actions by masking by the generated rewards for all of the possible acitons in the display_set
-                        cur_generated_action_indices = generated_action_indices[b, :t+1].unsqueeze(0) # --> [1, t+1]
-                        
-                        class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
-                        cur_clicked_item_mask = torch.nn.functional.one_hot(cur_generated_action_indices, num_classes= class_num) # --> [1, t+1, (num_displayed_items+1)]
-                        
-                        cur_gen_reward = cur_dfake_reward * cur_clicked_item_mask.float() # --> [1, t+1, (num_displayed_items+1)]
-                        gen_reward += torch.sum(cur_gen_reward) / cur_gen_reward.shape[1]
-                
-                dfake_loss = gen_reward # total loss/rewards for the real user actions (gt)
-
-                # Update Disciriminator (Reward) model
-                # ============ loss backpropagation:
-                combined_loss = dfake_loss - dreal_loss
-                if combined_loss.requires_grad:
-                    # Backprop discriminator_RewardModel
-                    # Note that discriminator_RewardModel tries to minimize the combined_loss
-                    for param in self.discriminator_RewardModel.parameters():
-                        param.requires_grad = True
-                    for param in self.generator_UserModel.parameters():
-                        param.requires_grad = False
-                    history_LSTM_optimizer.zero_grad()
-                    generator_optimizer.zero_grad()
-                    discriminator_optimizer.zero_grad()
-                    combined_loss.backward()
-                    history_LSTM_optimizer.step()
-                    discriminator_optimizer.step()
-
-
-
-
-                # ************************************ generator_UserModel Loss Calculation below: ************************************
-                # Obtain generated user action's indices/feature vectors for 1 time step ahead given the past real users state representation
-                generated_action_indices , generated_action_vectors = self.generator_UserModel.generate_actions(real_states, display_set)  # --> [batch_size (#users), num_time_steps] , [batch_size (#users), num_time_steps, feature_dims]
-                # convert rnn.PackedSequence to Tensor
-                # generated_action_vectors --> [batch_size (#users), num_time_steps, feature_dims]
-                gen_reward = torch.tensor(0).float().to(self.device)
-                for b in range(generated_action_vectors.shape[0]): # index on batch_size
-                    for t in range(1, generated_action_vectors.shape[1]): # index on num_time_steps (L)
-                        cur_generated_action_vector = generated_action_vectors[b, t, :].to(self.device) # --> [feature_dim]
-                        cur_real_past_actions = real_click_history_unpacked[b, :t, :].to(self.device) # --> [t, feature_dim]
-                        # append generated action to past history from the real user
-                        cur_generated_action_with_history = torch.cat((cur_real_past_actions, cur_generated_action_vector.unsqueeze(0)), dim=0) # --> [t+1, feature_dim]
-                        cur_generated_action_with_history = cur_generated_action_with_history.unsqueeze(0) # --> [1, t+1, feature_dim]
-                        # obtain new state representations after taking the current generated action
-                        cur_fake_state = self.history_LSTM(cur_generated_action_with_history) # --> [1, t+1, state_dim]
-                        # calculate the reward for the currently generated action
-                        display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
-                        cur_display_set = display_set_unpacked[b, :t+1, :, :].unsqueeze(0) # --> [1, t+1, num_displayed_item, feature_dim]
-                        
-                        cur_dfake_reward = self.discriminator_RewardModel(cur_fake_state, cur_display_set) # --> [1, t+1, (num_displayed_items+1)]
-
-                        # Calculate the rewards for the generated user actions by masking by the generated rewards for all of the possible acitons in the display_set
-                        cur_generated_action_indices = generated_action_indices[b, :t+1].unsqueeze(0) # --> [1, t+1]
-                        
-                        class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
-                        clicked_item_mask = torch.nn.functional.one_hot(clicked_items.long().data, num_classes= class_num) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-                        cur_clicked_item_mask = torch.nn.functional.one_hot(cur_generated_action_indices, num_classes= class_num) # --> [1, t+1, (num_displayed_items+1)]
-                        
-                        cur_gen_reward = cur_dfake_reward * cur_clicked_item_mask.float() # --> [1, t+1, (num_displayed_items+1)]
-                        gen_reward += torch.sum(cur_gen_reward) / cur_gen_reward.shape[1]
-                
-                dfake_loss = -1 * gen_reward # total loss/rewards for the real user actions (gt)
-                
-                # ============ loss backpropagation:
-                combined_loss = dfake_loss
-                if combined_loss.requires_grad:
-                    # backprop generator_UserModel
-                    # Note that generator_UserModel tries to maximize the combined_loss
-                    for param in self.generator_UserModel.parameters():
-                        param.requires_grad = True
-                    for param in self.discriminator_RewardModel.parameters():
-                        param.requires_grad = False
-                    history_LSTM_optimizer.zero_grad()
-                    generator_optimizer.zero_grad()
-                    discriminator_optimizer.zero_grad()
-                    combined_loss.backward()
-                    history_LSTM_optimizer.step()
-                    generator_optimizer.step()
-
-                    # record losses
-                    cur_dfake_loss += dfake_loss.detach().cpu().numpy()
-                    cur_dreal_loss += dreal_loss.detach().cpu().numpy()
+                step += 1
+                if validator is not None:
+                    if validate_every_n_steps and step % validate_every_n_steps == 0:
+                        validator.submit(("step", step), self.snapshot(models_only=True)["models"], subsample=True)
+                    handle_validation_results(validator.poll())
+            self.flush_accumulated_gradients() # step on the remaining micro-batches of the epoch
 
             # logging
             dreal_losses.append(cur_dreal_loss)
             dfake_losses.append(cur_dfake_loss)
 
-        
+            if validator is not None:
+                # validated while the next epoch trains, the results are handled as they arrive. Training waits for the validations
+                # when max_pending_snapshots snapshots (with their optimizer states) are held in memory.
+                if len(pending_snapshots) >= max_pending_snapshots:
+                    handle_validation_results(validator.poll(block=True))
+                pending_snapshots[epoch] = self.snapshot()
+                validator.submit(("epoch", epoch), pending_snapshots[epoch]["models"])
+                handle_validation_results(validator.poll())
+                continue
+
 
             # ================== Validation part
-            val_cur_dreal_loss = 0 # total loss for cur batch
-            val_cur_dfake_loss = 0 # total loss for cur batch
-            for real_click_history, display_set, clicked_items  in validation_loader:
-                # real_click_history --> [max(num_time_steps), feature_dim]
-                # display_set --> [max(num_time_steps), num_displayed_item, feature_dim]
-                # clicked_items --> [max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
-                
-                real_click_history = real_click_history.to(self.device)
-                display_set = display_set.to(self.device)
-                clicked_items = clicked_items.to(self.device)
-
-                with torch.no_grad():
-                     # Obtain state representations given the real user's past click history
-                    real_states = self.history_LSTM(real_click_history) # --> [batch_size (#users)=1, num_time_steps, state_dim]
-                    # Calculate the rewards for all of the possible actions (items in the (display_set+1))
-                    dreal_reward = self.discriminator_RewardModel.forward(real_states, display_set) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-                    
-                    # Calculate the rewards for the real user actions by masking by the actions taken by the real user
-                    class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
-                    clicked_items_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(clicked_items, batch_first=True)
-                    clicked_item_mask = torch.nn.functional.one_hot(clicked_items_unpacked.long(), num_classes= class_num) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-                    gt_reward = dreal_reward * clicked_item_mask.float()
-                    dreal_loss = torch.sum(gt_reward) / dreal_reward.shape[1] # avg loss/rewards for the real user actions (gt)
-
-
-
-                    # ========== generator_UserModel Loss Calculation below: 
-                    # Obtain generated user action's indices/feature vectors for 1 time step ahead given the past real users state representation
-                    generated_action_indices , generated_action_vectors = self.generator_UserModel.generate_actions(real_states, display_set)  # --> [batch_size (#users), num_time_steps] , [batch_size (#users), num_time_steps, feature_dims]
-                    # convert rnn.PackedSequence to Tensor
-                    real_click_history_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
-                    # generated_action_vectors --> [batch_size (#users), num_time_steps, feature_dims]
-                    gen_reward = torch.tensor(0).float().to(self.device)
-                    for b in range(generated_action_vectors.shape[0]): # index on batch_size
-                        for t in range(1, generated_action_vectors.shape[1]): # index on num_time_steps (L)
-                            cur_generated_action_vector = generated_action_vectors[b, t, :].to(self.device) # --> [feature_dim]
-                            cur_real_past_actions = real_click_history_unpacked[b, :t, :].to(self.device) # --> [t, feature_dim]
-                            # append generated action to past history from the real user
-                            cur_generated_action_with_history = torch.cat((cur_real_past_actions, cur_generated_action_vector.unsqueeze(0)), dim=0) # --> [t+1, feature_dim]
-                            cur_generated_action_with_history = cur_generated_action_with_history.unsqueeze(0) # --> [1, t+1, feature_dim]
-                            # obtain new state representations after taking the current generated action
-                            cur_fake_state = self.history_LSTM(cur_generated_action_with_history) # --> [1, t+1, state_dim]
-                            # calculate the reward for the currently generated action
-                            display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
-                            cur_display_set = display_set_unpacked[b, :t+1, :, :].unsqueeze(0) # --> [1, t+1, num_displayed_item, feature_dim]
-                            cur_dfake_reward = self.discriminator_RewardModel(cur_fake_state, cur_display_set) # --> [1, t+1, (num_displayed_items+1)]
-
-                            # Calculate the rewards for the generated user actions by masking by the generated rewards for all of the possible acitons in the display_set
-                            cur_generated_action_indices = generated_action_indices[b, :t+1].unsqueeze(0) # --> [1, t+1]
-                            
-                            class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
-                            cur_clicked_item_mask = torch.nn.functional.one_hot(cur_generated_action_indices, num_classes= class_num) # --> [1, t+1, (num_displayed_items+1)]
-                            
-                            cur_gen_reward = cur_dfake_reward * cur_clicked_item_mask.float() # --> [1, t+1, (num_displayed_items+1)]
-                            gen_reward += torch.sum(cur_gen_reward) / cur_gen_reward.shape[1]
-                    
-                    dfake_loss = -1 * gen_reward # total loss/rewards for the real user actions (gt)
-
-                    # record losses
-                    val_cur_dfake_loss += dfake_loss.detach().cpu().numpy()
-                    val_cur_dreal_loss += dreal_loss.detach().cpu().numpy()
+            val_cur_dreal_loss, val_cur_dfake_loss = self.validate(validation_loader)
 
 
             # =========== Save Checkpoints
             if (dfake_best_val_loss == None) or (dfake_best_val_loss >= val_cur_dfake_loss):
-                if not os.path.exists(self.config_dict["ckpt_path"]):
-                    os.mkdir(self.config_dict["ckpt_path"])
-
                 dfake_best_val_loss = val_cur_dfake_loss
-                # Save history_lstm
-                torch.save({
-                    'epoch': epoch + loaded_epoch,
-                    'state_dict': self.history_LSTM.state_dict(),
-                    'optimizer_state_dict': history_LSTM_optimizer.state_dict(),
-                    'dfake_loss': dfake_best_val_loss,
-                    'dreal_loss': val_cur_dreal_loss,
-                }, os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_history_lstm_path"]))
-
-                # Save Generator
-                torch.save({
-                    'epoch': epoch + loaded_epoch,
-                    'state_dict': self.generator_UserModel.state_dict(),
-                    'optimizer_state_dict': generator_optimizer.state_dict(),
-                    'dfake_loss': dfake_best_val_loss,
-                    'dreal_loss': val_cur_dreal_loss,
-                }, os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_generator_path"]))
-
-                # Save Discriminator
-                torch.save({
-                    'epoch': epoch + loaded_epoch,
-                    'state_dict': self.discriminator_RewardModel.state_dict(),
-                    'optimizer_state_dict': discriminator_optimizer.state_dict(),
-                    'dreal_loss': dfake_best_val_loss,
-                    'dreal_loss': val_cur_dreal_loss,
-                }, os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_discriminator_path"]))
+                self.save_checkpoints(epoch + loaded_epoch, dfake_best_val_loss, val_cur_dreal_loss)
 
                 print("*" * 20)
                 print(f"Saved model checkpoint at epoch: {epoch+loaded_epoch}")
-            
+
             # logging
             val_dreal_losses.append(val_cur_dreal_loss)
             val_dfake_losses.append(val_cur_dfake_loss)
@@ -384,205 +838,149 @@ class GAN():
                 val_dreal_loss: {val_dreal_losses[-1]}, val_dfake_loss: {val_dfake_losses[-1]}")
             print("_" * 25)
 
+        if validator is not None:
+            handle_validation_results(validator.poll(block=True))
+            validator.close()
+
         plot_results(dreal_losses, dfake_losses, val_dreal_losses, val_dfake_losses)
         # Return the losses
         return dreal_losses, dfake_losses, val_dreal_losses, val_dfake_losses
 
 
-    def test(self, test_dataloader):
-        print("*" * 30)
-        print("Testing GAN Model")
-        print("*" * 30)
-
-        # ================== Load ckpt
-        if self.config_dict["load_pretrained"]:
-            history_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_history_lstm_path"]))
-            generator_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_generator_path"]))
-            discriminator_ckpt = torch.load(os.path.join(self.config_dict["ckpt_path"], self.config_dict["pretrained_discriminator_path"]))
-
-            self.history_LSTM.load_state_dict(history_ckpt["state_dict"])
-            self.generator_UserModel.load_state_dict(generator_ckpt["state_dict"])
-            self.discriminator_RewardModel.load_state_dict(discriminator_ckpt["state_dict"])
-
-           
-            loaded_epoch = generator_ckpt["epoch"]
-            dreal_loaded_loss = generator_ckpt["dreal_loss"]
-            dfake_loaded_loss = generator_ckpt["dfake_loss"]
-            print(f"Loaded History_lstm, Discriminator, and Generator from saved ckpt. Loaded epoch:{loaded_epoch}, \
-                Loaded best real validation loss: {dreal_loaded_loss}, Loaded best fake validation loss: {dfake_loaded_loss}")
-        # ==================
-
-        top_k_precisions_list = [] # top k@precision 
-        generator_precision = [[]] # only top 1@prec scoker
-        for k in self.config_dict["k"]: # initialize list
-            top_k_precisions_list.append(list())
-                
-        test_cur_dreal_loss = 0 # total loss for cur batch
-        test_cur_dfake_loss = 0 # total loss for cur batch
-        
-        for real_click_history, display_set, clicked_items  in test_dataloader:
-            # real_click_history --> [max(num_time_steps), feature_dim]
-            # display_set --> [max(num_time_steps), num_displayed_item, feature_dim]
-            # clicked_items --> [max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
-            
-            real_click_history = real_click_history.to(self.device)
-            display_set = display_set.to(self.device)
-            clicked_items = clicked_items.to(self.device)
+    def test_step(self, real_click_history, display_set, clicked_items):
+        """
+        Input:
+            real_click_history (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), feature_dim]
+            display_set (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim]
+            clicked_items (rnn.PackedSequence): [batch_size (#users), max(num_time_steps)] display set index of the clicked items by the real user (gt user actions)
+        Return:
+            dreal_loss (float): real loss of the batch.
+            dfake_loss (float): fake loss of the batch.
+            discriminator_hits (dict): k --> [num_valid_steps] 1 if the clicked item is in the top k rewards of the (unpadded) display set, for k in config_dict["k"]
+            generator_hits (torch.Tensor): [num_valid_steps] 1 if the generator_UserModel chose the clicked item (Prec@1)
+        """
+        real_click_history = real_click_history.to(self.device)
+        display_set = display_set.to(self.device)
+        clicked_items = clicked_items.to(self.device)
+
+        with torch.no_grad():
+            # Obtain state representations given the real user's past click history
+            real_states = self.history_LSTM(real_click_history) # --> [batch_size (#users)=1, num_time_steps, state_dim]
+            # Calculate the rewards for all of the possible actions (items in the (display_set+1))
+            dreal_reward = self.discriminator_RewardModel.forward(real_states, display_set) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
+
+            # Unpadded slots of the display sets (padded items are the full 1 Tensor [1,1,1 ..., 1], or the padding id for sparse inputs)
+            unpacked_displayed_items, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
+            unpacked_displayed_items = unpacked_displayed_items.to(self.device)
+            if is_item_ids(unpacked_displayed_items):
+                unpadded = unpacked_displayed_items != self.history_LSTM.item_table.padding_id
+            else:
+                unpadded = unpacked_displayed_items.sum(-1) != unpacked_displayed_items.shape[-1]
+            unpadded = torch.cat((unpadded, torch.ones_like(unpadded[..., :1])), dim=-1) # not_clicking slot --> [B, max(num_time_steps), (num_displayed_items+1)]
+
+            unpacked_clicked_items, lens_clicked_item = torch.nn.utils.rnn.pad_packed_sequence(clicked_items, batch_first=True)
+            unpacked_clicked_items = unpacked_clicked_items.long().to(self.device) # --> [B, max(num_time_steps)]
+            valid_steps = torch.arange(unpacked_clicked_items.shape[1], device=self.device)[None, :] < lens_clicked_item.to(self.device)[:, None] # --> [B, max(num_time_steps)]
+
+            # Top k@Precision of the discriminator_RewardModel: the top k positions among the unpadded slots are compared with the clicked index.
+            # The time steps are grouped by their number of unpadded slots so that topk runs on [num_steps, num_unpadded] batches.
+            num_unpadded = unpadded.sum(-1) # --> [B, max(num_time_steps)]
+            discriminator_hits = {k: torch.zeros_like(unpacked_clicked_items) for k in self.config_dict["k"]}
+            for n in torch.unique(num_unpadded[valid_steps]).tolist():
+                rows = valid_steps & (num_unpadded == n)
+                unpadded_display_set = dreal_reward[rows][unpadded[rows]].view(-1, n) # --> [num_steps, n] rewards of the unpadded slots in order
+                for k in self.config_dict["k"]:
+                    _, top_k_pred = torch.topk(unpadded_display_set, min(k, n)) # --> [num_steps, k]
+                    discriminator_hits[k][rows] = (top_k_pred == unpacked_clicked_items[rows].unsqueeze(-1)).any(-1).long()
+            discriminator_hits = {k: hits[valid_steps].cpu() for k, hits in discriminator_hits.items()}
 
-            with torch.no_grad():
-                # Obtain state representations given the real user's past click history
-                real_states = self.history_LSTM(real_click_history) # --> [batch_size (#users)=1, num_time_steps, state_dim]
-                # Calculate the rewards for all of the possible actions (items in the (display_set+1))
-                dreal_reward = self.discriminator_RewardModel.forward(real_states, display_set) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-                
-                
-                # ===============
-                # Find unpadded indices of the displayed_set
-                unpacked_displayed_items, lens_displayed_item = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
-                unpacked_displayed_items = unpacked_displayed_items.to(self.device)
-                lens_displayed_item = lens_displayed_item.to(self.device)
-                # unpacked_displayed_items --> [B, max(num_time_steps), padded_display_set, feature_dim]
-                display_unpadded_indices = []
-                for b in range(unpacked_displayed_items.shape[0]):
-                    cur_l_indices = []
-                    for l in range(unpacked_displayed_items.shape[1]):
-                        cur_t_indices = []
-                        for i, item in enumerate(unpacked_displayed_items[b,l, :]):
-                            # item --> [feature_dim]
-                            if item.sum() != item.shape[-1]: # input is a padding vector for displayed_items (full 1 Tensor [1,1,1 ..., 1])
-                                cur_t_indices.append(i)
-                        cur_t_indices.append(len(unpacked_displayed_items[b,l, :])) # append non_clicking vector
-                        cur_l_indices.append(cur_t_indices)
-                                
-                    display_unpadded_indices.append(cur_l_indices)
-                
-                # display_unpadded_indices --> [B, l, value]
+            # Calculate the rewards for the real user actions by masking by the actions taken by the real user
+            class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
+            clicked_item_mask = torch.nn.functional.one_hot(unpacked_clicked_items, num_classes= class_num) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
+            gt_reward = dreal_reward * clicked_item_mask.float()
+            dreal_loss = torch.sum(gt_reward) / dreal_reward.shape[1] # avg loss/rewards for the real user actions (gt)
 
+            # ========== generator_UserModel top-k@Precision Calculation below: 
+            # Obtain generated user action's indices/feature vectors for 1 time step ahead given the past real users state representation
+            generated_action_indices , generated_action_vectors = self.generator_UserModel.generate_actions(real_states, display_set)  # --> [batch_size (#users), num_time_steps] , [batch_size (#users), num_time_steps, feature_dims]
+            # generated_action_indices --> [B, L] index of the best chosen action
+            generator_hits = (generated_action_indices.to(self.device) == unpacked_clicked_items)[valid_steps].long().cpu()
 
-                # Find max k indices which are not padded in the displayed_items
-                # dreal_reward --> [B, l, max(num_displayed_item)]
-                # unpacked_clicked_items --> [B, l]
-                # lens_clicked_item --> [l]
-                unpacked_clicked_items, lens_clicked_item = torch.nn.utils.rnn.pad_packed_sequence(clicked_items, batch_first=True)
-                unpacked_clicked_items =  unpacked_clicked_items.to(self.device)
-                lens_clicked_item = lens_clicked_item.to(self.device)
-                for k in self.config_dict["k"]:
-                    precision_list = []
-                    for b in range(dreal_reward.shape[0]):
-                        for l in range(lens_clicked_item[b]):
-                            # dreal_reward[b,l,:] --> 11
-                            # find max k indices
-                            unpadded_display_set = torch.gather(dreal_reward[b, l, :], 0, torch.tensor(display_unpadded_indices[b][l]).to(self.device))
-                            # chose max k from unpadded_display_set
-                            _, top_k_pred = torch.topk(unpadded_display_set, k)
-                            
-                            top_k_pred = top_k_pred.tolist()
-                            # find real user's choice index
-                            real_indices = unpacked_clicked_items[b, l]
-                            
-                            if real_indices in top_k_pred: # if the discriminator guessed right
-                                precision_list.append(1)
-                            else: # if the discriminator couldn't guess right
-                                precision_list.append(0)
-                    
-                    top_k_precisions_list[k-1].extend(precision_list)
-                # =====================
-                
-                
+            real_click_history_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
+            # generated_action_vectors --> [batch_size (#users), num_time_steps, feature_dims]
+            gen_reward = self.generated_rewards(real_click_history_unpacked, display_set, generated_action_indices, generated_action_vectors)
 
-                # Calculate the rewards for the real user actions by masking by the actions taken by the real user
-                class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
-                
+            dfake_loss = -1 * gen_reward # total loss/rewards for the real user actions (gt)
 
-                clicked_items_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(clicked_items, batch_first=True)
-                clicked_item_mask = torch.nn.functional.one_hot(clicked_items_unpacked.long(), num_classes= class_num) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-                gt_reward = dreal_reward * clicked_item_mask.float()
-                dreal_loss = torch.sum(gt_reward) / dreal_reward.shape[1] # avg loss/rewards for the real user actions (gt)
+        return dreal_loss.detach().cpu().numpy(), dfake_loss.detach().cpu().numpy(), discriminator_hits, generator_hits
 
 
+    def test(self, test_dataloader, return_metrics=False):
+        """
+        Input:
+            test_dataloader (torch.utils.data.DataLoader): test DataLoader
+            return_metrics (bool): if True, the precision metrics are returned too.
+        Return:
+            test_cur_dreal_loss (float): total real loss over the test set.
+            test_cur_dfake_loss (float): total fake loss over the test set.
+            metrics (dict): (only if return_metrics) {"discriminator_prec@k": float for k in config_dict["k"], "generator_prec@1": float}
+        """
+        print("*" * 30)
+        print("Testing GAN Model")
+        print("*" * 30)
 
-                # ========== generator_UserModel top-k@Precision Calculation below: 
-                # Obtain generated user action's indices/feature vectors for 1 time step ahead given the past real users state representation
-                # convert rnn.PackedSequence to Tensor
-                generated_action_indices , generated_action_vectors = self.generator_UserModel.generate_actions(real_states, display_set)  # --> [batch_size (#users), num_time_steps] , [batch_size (#users), num_time_steps, feature_dims]
-                # generated_action_indices --> [B, L] index of the best chosen action
-                
-                generator_precision_list = []
-                for b in range(generated_action_indices.shape[0]):
-                    for l in range(lens_clicked_item[b]):
-                            # dreal_reward[b,l,:] --> 11
-                            # find max k indices
-                        top_1_pred = generated_action_indices[b, l]
-                        top_1_pred = [top_1_pred.tolist()]
-
-                        # find real user's choice index
-                        real_indices = unpacked_clicked_items[b, l]
-                            
-                        if real_indices in top_1_pred: # if the discriminator guessed right
-                            generator_precision_list.append(1)
-                        else: # if the discriminator couldn't guess right
-                            generator_precision_list.append(0)
-                    
-                generator_precision[0].extend(generator_precision_list)
-                
-                
-                
-                real_click_history_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True)
-                # generated_action_vectors --> [batch_size (#users), num_time_steps, feature_dims]
-                gen_reward = torch.tensor(0).float().to(self.device)
-                
-                
-                for b in range(generated_action_vectors.shape[0]): # index on batch_size
-                    for t in range(1, generated_action_vectors.shape[1]): # index on num_time_steps (L)
-                        cur_generated_action_vector = generated_action_vectors[b, t, :].to(self.device) # --> [feature_dim]
-                        cur_real_past_actions = real_click_history_unpacked[b, :t, :].to(self.device) # --> [t, feature_dim]
-                        # append generated action to past history from the real user
-                        cur_generated_action_with_history = torch.cat((cur_real_past_actions, cur_generated_action_vector.unsqueeze(0)), dim=0) # --> [t+1, feature_dim]
-                        cur_generated_action_with_history = cur_generated_action_with_history.unsqueeze(0) # --> [1, t+1, feature_dim]
-                        # obtain new state representations after taking the current generated action
-                        cur_fake_state = self.history_LSTM(cur_generated_action_with_history) # --> [1, t+1, state_dim]
-                        # calculate the reward for the currently generated action
-                        display_set_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True)
-                        cur_display_set = display_set_unpacked[b, :t+1, :, :].unsqueeze(0) # --> [1, t+1, num_displayed_item, feature_dim]
-                        cur_dfake_reward = self.discriminator_RewardModel(cur_fake_state, cur_display_set) # --> [1, t+1, (num_displayed_items+1)]
-
-                        # Calculate the rewards for the generated user actions by masking by the generated rewards for all of the possible acitons in the display_set
-                        cur_generated_action_indices = generated_action_indices[b, :t+1].unsqueeze(0) # --> [1, t+1]
-                        
-                        class_num = ((display_set.data.shape[1])+1) # (num_displayed_items+1)
-                        cur_clicked_item_mask = torch.nn.functional.one_hot(cur_generated_action_indices, num_classes= class_num) # --> [1, t+1, (num_displayed_items+1)]
-                        
-                        cur_gen_reward = cur_dfake_reward * cur_clicked_item_mask.float() # --> [1, t+1, (num_displayed_items+1)]
-                        gen_reward += torch.sum(cur_gen_reward) / cur_gen_reward.shape[1]
-                
-                dfake_loss = -1 * gen_reward # total loss/rewards for the real user actions (gt)
+        # ================== Load ckpt
+        if self.config_dict["load_pretrained"]:
+            self.load_checkpoints(load_optimizers=False)
+        # ==================
 
-                # record losses
-                test_cur_dfake_loss += dfake_loss.detach().cpu().numpy()
-                test_cur_dreal_loss += dreal_loss.detach().cpu().numpy()
-        
-        
-        # calculate top k@prec
-        top_k_precicions = []
-        for e in top_k_precisions_list:
-            top_k_precicions.append(sum(e)/len(e))
+        test_cur_dreal_loss, test_cur_dfake_loss, metrics = self.test_metrics(test_dataloader)
 
         padded_display_set_size = self.config_dict["generator_output_size"]
         print("*"*10)
         print(f"Padded Display set size = {padded_display_set_size}")
         for k in self.config_dict["k"]:
-            print(f"Greedy Discriminator Reward Model Prec@{k} = {top_k_precicions[k-1]}")
+            print(f"Greedy Discriminator Reward Model Prec@{k} = {metrics[f'discriminator_prec@{k}']}")
 
-        print(f"Generator User Model Prec@1 = {np.mean(generator_precision[0])}")
+        print(f"Generator User Model Prec@1 = {metrics['generator_prec@1']}")
         print("*"*10)
                 
 
         print(f"test_cur_dfake_loss: {test_cur_dfake_loss}, test_cur_dreal_loss: {test_cur_dreal_loss}")
         print("_" * 25)
 
+        if return_metrics:
+            return test_cur_dreal_loss, test_cur_dfake_loss, metrics
         return test_cur_dreal_loss, test_cur_dfake_loss
 
 
+    def test_metrics(self, test_batches):
+        """
+        Input:
+            test_batches (iterable): test DataLoader, or the already collated batches (real_click_history, display_set, clicked_items).
+        Return:
+            test_cur_dreal_loss (float): total real loss over the test set.
+            test_cur_dfake_loss (float): total fake loss over the test set.
+            metrics (dict): {"discriminator_prec@k": float for k in config_dict["k"], "generator_prec@1": float}
+        """
+        discriminator_hits = {k: [] for k in self.config_dict["k"]} # top k@precision
+        generator_hits = [] # only top 1@prec score
+        test_cur_dreal_loss = 0 # total loss for cur batch
+        test_cur_dfake_loss = 0 # total loss for cur batch
+        for real_click_history, display_set, clicked_items in test_batches:
+            dreal_loss, dfake_loss, batch_discriminator_hits, batch_generator_hits = self.test_step(real_click_history, display_set, clicked_items)
+            # record losses
+            test_cur_dfake_loss += dfake_loss
+            test_cur_dreal_loss += dreal_loss
+            for k in self.config_dict["k"]:
+                discriminator_hits[k].append(batch_discriminator_hits[k])
+            generator_hits.append(batch_generator_hits)
+
+        metrics = {f"discriminator_prec@{k}": float(torch.cat(discriminator_hits[k]).double().mean()) for k in self.config_dict["k"]}
+        metrics["generator_prec@1"] = float(torch.cat(generator_hits).double().mean())
+        return test_cur_dreal_loss, test_cur_dfake_loss, metrics
+
+
 
 
 ## ========================================================== DEBUG 
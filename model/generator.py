@@ -1,19 +1,24 @@
 import torch
-from torch import nn
+from model.sparse_inputs import is_item_ids
+from model.packed_mlp import packed_mlp_forward
+from model.slot_mlp import SlotMLP
 
 # Note that User Model is the Generator in this context
-class Generator_UserModel(nn.Module):
-    def __init__(self, input_size, output_size, n_hidden, hidden_dim):
+class Generator_UserModel(SlotMLP):
+    def __init__(self, input_size, output_size, n_hidden, hidden_dim, checkpoint_segments=0):
         """
         input_size: equals ((num_displayed_items+1)*feature_dims + state_dim)
         output_size: equals (num_displayed_items+1)
         n_hidden: number of hidden layers in the generator model.
         hidden_dim: hidden dimension of the layers in the generator model.
+        checkpoint_segments: if > 0, the MLP is split into this many segments and the activations inside every segment are recomputed during backward (activation checkpointing).
         """
         
         super().__init__()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.input_size = input_size
+        self.checkpoint_segments = checkpoint_segments
+        self.item_table = None # ItemTable of the item ids (sparse inputs), see GAN.set_item_features
         layers = []
         
         layers.extend([torch.nn.Linear(input_size, hidden_dim),torch.nn.ReLU()])
@@ -28,29 +33,25 @@ class Generator_UserModel(nn.Module):
         self.model = torch.nn.Sequential(*layers) # (inp_0 inp_1 .. inp_k) --> classification(inp_0, inp_1, .. inp_k) 
                                                 
 
-    def forward(self, state, displayed_items):
+    def forward(self, state, displayed_items, packed_output=False):
         """
         Input:
-            state (torch.Tensor): [batch_size (#users), num_time_steps, state_dim]
-            displayed_items (torch.Tensor): [batch_size (#users), num_time_steps, num_displayed_items, feature_dims]
+            state (rnn.PackedSequence): [batch_size (#users), num_time_steps, state_dim] (or a padded torch.Tensor)
+            displayed_items (rnn.PackedSequence): [batch_size (#users), num_time_steps, num_displayed_items, feature_dims], or the item ids
+                [batch_size (#users), num_time_steps, num_displayed_items] (sparse inputs, requires item_table).
+            packed_output (bool): if True (and the inputs are packed), the action scores are returned as a PackedSequence of the valid time steps.
         Return:
-            action_scores (torch.Tensor): [batch_size (#users), num_time_steps, num_displayed_items]
+            action_scores (torch.Tensor): [batch_size (#users), num_time_steps, (num_displayed_items+1)]
         """
+        if isinstance(state, torch.nn.utils.rnn.PackedSequence) and isinstance(displayed_items, torch.nn.utils.rnn.PackedSequence):
+            # the MLP only runs on the valid time steps (the rows of the packed data)
+            return packed_mlp_forward(self.mlp, state, displayed_items, packed_output=packed_output)
         # Convert rnn.PackedSequences to simple Tensors
-        state_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(state, batch_first=True)
-        displayed_items_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(displayed_items, batch_first=True)
-        
-        # Prepare input
-        batch_size = state_unpacked.shape[0] # B
-        num_time_steps = displayed_items_unpacked.shape[1] # L
-        # concat zero vector to displayed items to represent user not clicking on any of the displayed items
-        not_clicking_feature_vec = torch.zeros((batch_size, num_time_steps, 1, displayed_items_unpacked.shape[-1])) # --> [batch_size (#users), max(num_time_steps), 1, feature_dim]
-        displayed_items_unpacked = torch.cat((displayed_items_unpacked.to(self.device), not_clicking_feature_vec.to(self.device)), -2) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1), feature_dims]
-        displayed_items_flat = displayed_items_unpacked.view(batch_size, num_time_steps, -1) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)*feature_dims]
-        input_features = torch.cat((displayed_items_flat, state_unpacked), dim=-1) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items*feature_dims) + state_dim]
-        
-        return self.model(input_features) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
-
+        if isinstance(state, torch.nn.utils.rnn.PackedSequence):
+            state, _ = torch.nn.utils.rnn.pad_packed_sequence(state, batch_first=True)
+        if isinstance(displayed_items, torch.nn.utils.rnn.PackedSequence):
+            displayed_items, _ = torch.nn.utils.rnn.pad_packed_sequence(displayed_items, batch_first=True)
+        return self.mlp(state, displayed_items) # --> [batch_size (#users), max(num_time_steps), (num_displayed_items+1)]
 
     def get_index(self, state, displayed_items):
         """
@@ -76,10 +77,16 @@ class Generator_UserModel(nn.Module):
             displayed_items (torch.Tensor): [num_time_steps, num_displayed_items, feature_dims]
         Return:
             generated_action_vectors (torch.Tensor): corresponding feature vectors of the generated actions specified with the generated_action_indices 
-                [batch_size (#users), num_time_steps, feature_dims]
+                [batch_size (#users), num_time_steps, feature_dims] (their item ids [batch_size (#users), num_time_steps] for sparse inputs)
         """
         # Convert rnn.PackedSequences to simple Tensors
         displayed_items_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(displayed_items, batch_first=True)
+
+        if is_item_ids(displayed_items_unpacked):
+            # sparse inputs: the item ids of the generated actions --> [batch_size (#users), num_time_steps]
+            not_clicking_ids = torch.full_like(displayed_items_unpacked[..., :1], self.item_table.not_clicking_id)
+            displayed_item_ids = torch.cat((displayed_items_unpacked, not_clicking_ids), -1).to(generated_action_indices.device) # --> [batch_size (#users), num_time_steps, (num_displayed_items+1)]
+            return torch.gather(displayed_item_ids, -1, generated_action_indices.unsqueeze(-1)).squeeze(-1)
         
         # Prepare input
         batch_size = generated_action_indices.shape[0] # B
@@ -0,0 +1,47 @@
+import torch
+from torch import nn
+from model.sparse_inputs import is_item_ids, sparse_recurrent
+
+# Compact alternative of the History_LSTM (e.g. as the distilled student of distill.py) with the same interface.
+# This model takes in the old state and the newly chosen action as input and produces the new state representation
+# using a GRU (Gated Recurrent Unit)
+class History_GRU(nn.Module):
+    def __init__(self, input_size, hidden_size, num_layers, checkpoint_segments=0):
+        """
+        input_size (int): feature_dim of the actions.
+        hidden_size (int): dimension of the state representation vector (dim of output)
+        num_layers (int): number of recurrent layers in the GRU model.
+        checkpoint_segments (int): activation checkpointing is not supported, must be 0.
+        """
+        super().__init__()
+        assert checkpoint_segments == 0, "History_GRU does not support activation checkpointing"
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.num_layers = num_layers
+        self.state_dim = hidden_size
+        self.gru_model = torch.nn.GRU(input_size, self.state_dim, self.num_layers, batch_first=True).to(self.device)
+        self.checkpoint_segments = 0
+        self.item_table = None # ItemTable of the item ids (sparse inputs), see GAN.set_item_features
+
+    def set_checkpoint_segments(self, checkpoint_segments):
+        assert checkpoint_segments == 0, "History_GRU does not support activation checkpointing"
+
+
+    def forward(self, actions, hidden=None, return_hidden=False):
+        """
+        Inputs:
+            new_action (torch.Tensor): action chosen by the user (either ground truth action or Generator_UserModel generated action).
+            [batch_size (#users), num_time_steps, feature_dim], or the item ids [batch_size (#users), num_time_steps] (sparse inputs, requires item_table).
+            hidden (torch.Tensor): initial hidden state [num_layers, batch_size (#users), state_dim]. Zero states are used if None.
+            return_hidden (bool): if True, the final hidden state is returned too.
+        Returns:
+            new_state (torch.Tensor): old_state updated after taking new_action (i.e. updated history representation).
+            [batch_size (#users), num_time_steps, state_dim]
+            h (torch.Tensor): hidden state (only if return_hidden).
+        """
+        if is_item_ids(actions):
+            out, h = sparse_recurrent(self.item_table, self.gru_model, actions, hidden)
+        else:
+            out, h = self.gru_model(actions, hidden)
+        if return_hidden:
+            return out, h
+        return out
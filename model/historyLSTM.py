@@ -1,32 +1,56 @@
 import torch
 from torch import nn
+from model.checkpointing import CheckpointedLSTM
+from model.sparse_inputs import is_item_ids, sparse_recurrent
 
 # This model takes in the old state and the newly chosen action as input and produces the new state representation
 # using LSTM(Long Short Term Memory)
 class History_LSTM(nn.Module):
-    def __init__(self, input_size, hidden_size, num_layers):
+    def __init__(self, input_size, hidden_size, num_layers, checkpoint_segments=0):
         """
         input_size (int): feature_dim of the actions.
         hidden_size (int): dimension of the state representation vector (dim of output)
         num_layers (int): number of recurrent layers in the LSTM model.
+        checkpoint_segments (int): if > 0, the LSTM layers are split into this many groups and the activations inside 
+            every group are recomputed during backward (activation checkpointing) instead of being stored.
         """
         super().__init__()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.num_layers = num_layers
         self.state_dim = hidden_size
         self.lstm_model = torch.nn.LSTM(input_size, self.state_dim, self.num_layers, batch_first=True).to(self.device)
+        self.checkpoint_segments = checkpoint_segments
+        self.checkpointed_lstm = CheckpointedLSTM(self.lstm_model, checkpoint_segments) if checkpoint_segments > 0 else None
+        self.item_table = None # ItemTable of the item ids (sparse inputs), see GAN.set_item_features
+
+    def set_checkpoint_segments(self, checkpoint_segments):
+        """
+        checkpoint_segments (int): number of activation checkpointing segments (0 disables activation checkpointing).
+        """
+        self.checkpoint_segments = checkpoint_segments
+        self.checkpointed_lstm = CheckpointedLSTM(self.lstm_model, checkpoint_segments) if checkpoint_segments > 0 else None
 
 
-    def forward(self, actions):
+    def forward(self, actions, hidden=None, return_hidden=False):
         """
         Inputs:
             new_action (torch.Tensor): action chosen by the user (either ground truth action or Generator_UserModel generated action).
-            [batch_size (#users), num_time_steps, feature_dim]
+            [batch_size (#users), num_time_steps, feature_dim], or the item ids [batch_size (#users), num_time_steps] (sparse inputs, requires item_table).
+            hidden (tuple): initial (h, c) states, each [num_layers, batch_size (#users), state_dim]. Zero states are used if None.
+            return_hidden (bool): if True, the final (h, c) states are returned too.
         Returns:
             new_state (torch.Tensor): old_state updated after taking new_action (i.e. updated history representation). 
             [batch_size (#users), num_time_steps, state_dim]
-            (h, c) (tuple): hidden and cell states. 
+            (h, c) (tuple): hidden and cell states (only if return_hidden). 
             Note that the returned new_state tensor is of same shape as the old_state tensor. 
         """
-        out, _ = self.lstm_model(actions)
-        return out 
+        if is_item_ids(actions):
+            # the input projection of the first layer gathers the weight columns of the items (activation checkpointing is not used)
+            out, (h, c) = sparse_recurrent(self.item_table, self.lstm_model, actions, hidden)
+        elif self.checkpointed_lstm is not None and torch.is_grad_enabled():
+            out, (h, c) = self.checkpointed_lstm(actions, hidden)
+        else:
+            out, (h, c) = self.lstm_model(actions, hidden)
+        if return_hidden:
+            return out, (h, c)
+        return out
@@ -0,0 +1,123 @@
+import importlib.util
+import inspect
+import torch
+from torch import nn
+from copy import deepcopy
+
+# Static shape inference path of the trained user model. Unlike History_LSTM, Generator_UserModel and Discriminator_RewardModel
+# it works on padded tensors of fixed shape (no PackedSequence handling, no per call allocations), so that it can be
+# compiled with torch.compile and exported to TorchScript/ONNX.
+
+
+def fold_not_clicking_slot(mlp, num_displayed_items, feature_dim):
+    """
+    Input:
+        mlp (torch.nn.Sequential): MLP of a Generator_UserModel/Discriminator_RewardModel. Its input is
+            [(num_displayed_items+1)*feature_dims + state_dim] where the (num_displayed_items+1)^th feature vector is the zero "not clicking" vector.
+        num_displayed_items (int): number of displayed items (without the "not clicking" slot).
+        feature_dim (int): feature dim of the items.
+    Return:
+        folded_mlp (torch.nn.Sequential): copy of the mlp whose input is [num_displayed_items*feature_dims + state_dim].
+    The "not clicking" feature vector is all zeros, so its columns of the first layer never contribute to the output.
+    Dropping them is exact and removes the concatenation of the zero slot from the forward pass.
+    """
+    folded_mlp = deepcopy(mlp)
+    first_layer = folded_mlp[0]
+    keep_columns = torch.cat((torch.arange(num_displayed_items * feature_dim),
+        torch.arange((num_displayed_items + 1) * feature_dim, first_layer.in_features)))
+    folded_layer = nn.Linear(len(keep_columns), first_layer.out_features, bias=first_layer.bias is not None)
+    with torch.no_grad():
+        folded_layer.weight.copy_(first_layer.weight[:, keep_columns])
+        if first_layer.bias is not None:
+            folded_layer.bias.copy_(first_layer.bias)
+    folded_mlp[0] = folded_layer
+    return folded_mlp
+
+
+class StaticUserModel(nn.Module):
+    def __init__(self, history_LSTM, generator_UserModel, discriminator_RewardModel, num_displayed_items, feature_dim):
+        """
+        history_LSTM (History_LSTM), generator_UserModel (Generator_UserModel), discriminator_RewardModel (Discriminator_RewardModel): trained models (they are copied).
+        num_displayed_items (int): number of displayed items per time step (without the "not clicking" slot).
+        feature_dim (int): feature dim of the items.
+        """
+        super().__init__()
+        self.num_displayed_items = num_displayed_items
+        self.feature_dim = feature_dim
+        self.state_dim = history_LSTM.state_dim
+        # History_LSTM or History_GRU
+        self.rnn_model = deepcopy(history_LSTM.gru_model if hasattr(history_LSTM, "gru_model") else history_LSTM.lstm_model)
+        self.generator = fold_not_clicking_slot(generator_UserModel.model, num_displayed_items, feature_dim)
+        self.discriminator = fold_not_clicking_slot(discriminator_RewardModel.model, num_displayed_items, feature_dim)
+
+    def forward(self, click_history, display_set):
+        """
+        Input:
+            click_history (torch.Tensor): [batch_size (#users), num_time_steps, feature_dim] (zero padded) feature vectors of the clicked items.
+            display_set (torch.Tensor): [batch_size (#users), num_time_steps, num_displayed_items, feature_dim] (zero padded) feature vectors of the displayed items.
+        Return:
+            action_scores (torch.Tensor): [batch_size (#users), num_time_steps, (num_displayed_items+1)] Generator_UserModel scores.
+            rewards (torch.Tensor): [batch_size (#users), num_time_steps, (num_displayed_items+1)] Discriminator_RewardModel rewards.
+        Note that the outputs of the padded time steps are meaningless, the recurrent model is causal so the other time steps are not affected by the padding.
+        """
+        state, _ = self.rnn_model(click_history) # --> [batch_size (#users), num_time_steps, state_dim]
+        input_features = torch.cat((display_set.flatten(start_dim=2), state), dim=-1) # --> [batch_size (#users), num_time_steps, num_displayed_items*feature_dims + state_dim]
+        return self.generator(input_features), self.discriminator(input_features)
+
+
+def to_static_inputs(real_click_history, display_set, num_time_steps=None):
+    """
+    Input:
+        real_click_history (PackedSequence), display_set (PackedSequence): batch as returned by custom_collate_fn.
+        num_time_steps (int): time steps of the static shape. Defaults to the longest session of the batch.
+    Return:
+        click_history (torch.Tensor): [batch_size (#users), num_time_steps, feature_dim]
+        display_set (torch.Tensor): [batch_size (#users), num_time_steps, num_displayed_items, feature_dim]
+        lengths (torch.Tensor): [batch_size (#users)] number of valid time steps of every user.
+    """
+    click_history, lengths = torch.nn.utils.rnn.pad_packed_sequence(real_click_history, batch_first=True, total_length=num_time_steps)
+    display_set, _ = torch.nn.utils.rnn.pad_packed_sequence(display_set, batch_first=True, total_length=num_time_steps)
+    return click_history, display_set, lengths
+
+
+def compile_static_model(model, **compile_kwargs):
+    """
+    Return:
+        compiled model (torch.compile), or the model itself if torch.compile is not available (torch < 2.0).
+    """
+    if not hasattr(torch, "compile"):
+        return model
+    return torch.compile(model, **compile_kwargs)
+
+
+def export_torchscript(model, example_inputs, filename):
+    """
+    Input:
+        model (StaticUserModel): model to export (eval mode).
+        example_inputs (tuple): (click_history, display_set) of the static shape.
+        filename (str): path of the TorchScript file.
+    Return:
+        traced model (torch.jit.ScriptModule).
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_inputs)
+    traced.save(filename)
+    return traced
+
+
+def export_onnx(model, example_inputs, filename, dynamic_batch=True):
+    """
+    Input:
+        model (StaticUserModel): model to export (eval mode).
+        example_inputs (tuple): (click_history, display_set) of the static shape.
+        filename (str): path of the ONNX file.
+        dynamic_batch (bool): if True, the batch dim of the exported graph is dynamic (the other dims are static).
+    Requires the onnx package.
+    """
+    if importlib.util.find_spec("onnx") is None:
+        raise ImportError("ONNX export requires the onnx package (pip install onnx)")
+    dynamic_axes = {"click_history": {0: "batch_size"}, "display_set": {0: "batch_size"}, "action_scores": {0: "batch_size"}, "rewards": {0: "batch_size"}} if dynamic_batch else None
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(model, example_inputs, filename, input_names=["click_history", "display_set"], output_names=["action_scores", "rewards"], \
+            dynamic_axes=dynamic_axes, **kwargs)
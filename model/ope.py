@@ -0,0 +1,197 @@
+import torch
+from torch.utils.data import DataLoader
+
+from data import custom_collate_fn
+
+# Offline (counterfactual) evaluation of recommendation policies on the logged display sets of a Dataset split.
+# A policy recommends one item of the catalog per time step: policy(states) --> scores [num_steps, num_items], its action
+# probabilities are softmax(scores / temperature). The logged display sets are treated as item-level actions of the logging
+# policy (the displayed items are observed, the clicked one has reward 1), with the inclusion probability of an item in a
+# display set as its propensity (item-level IPS). All estimators estimate the expected clicks per time step and are computed
+# batched over every time step of the split; the bootstrap resamples users (all of their time steps at once).
+
+
+def logged_steps(dataset):
+    """
+    Input:
+        dataset (Dataset): logged split.
+    Return:
+        steps (dict):
+            display_item_ids (torch.Tensor): [num_steps, num_displayed_items] (padded with padding_item_id)
+            picked_item_ids (torch.Tensor): [num_steps] clicked item of every time step.
+            step_users (torch.Tensor): [num_steps] user (index in the dataset) of every time step.
+            num_items (int): number of items of the catalog (padding_item_id = num_items).
+    """
+    lengths = dataset.user_offsets[1:] - dataset.user_offsets[:-1] # --> [num_users]
+    return {"display_item_ids": dataset.display_item_ids.long(), "picked_item_ids": dataset.picked_item_ids.long(),
+        "step_users": torch.repeat_interleave(torch.arange(len(lengths)), lengths), "num_items": dataset.item_features.shape[0] - 1}
+
+
+def inclusion_propensities(display_item_ids, num_items, floor=1e-6):
+    """
+    Input:
+        display_item_ids (torch.Tensor): [num_steps, num_displayed_items] logged display sets (ids >= num_items are padding).
+        num_items (int): number of items of the catalog.
+        floor (float): minimum propensity (items that are never displayed).
+    Return:
+        propensities (torch.Tensor): [num_items] fraction of the time steps whose display set contains the item.
+    """
+    valid = display_item_ids < num_items
+    counts = torch.bincount(display_item_ids[valid], minlength=num_items).double()
+    return (counts / display_item_ids.shape[0]).clamp_min(floor)
+
+
+def causal_states(history_model, dataset, batch_size, device="cpu"):
+    """
+    Input:
+        history_model (History_LSTM/History_GRU): trained recurrent state model.
+        dataset (Dataset): logged split.
+    Return:
+        states (torch.Tensor): [num_steps, state_dim] state of every time step before its click (zero state at the first time step),
+            in the order of the dataset time steps. Unlike GAN.test, the state of a time step does not see the click it is evaluated on.
+    """
+    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=custom_collate_fn)
+    states = []
+    with torch.no_grad():
+        for real_click_history, _, _ in dataloader:
+            batch_states, lengths = torch.nn.utils.rnn.pad_packed_sequence(history_model(real_click_history.to(device)), batch_first=True)
+            batch_states = torch.cat((torch.zeros_like(batch_states[:, :1]), batch_states[:, :-1]), dim=1) # --> [batch_size, max(num_time_steps), state_dim]
+            states.extend(batch_states[b, :lengths[b]].cpu() for b in range(batch_states.shape[0]))
+    return torch.cat(states)
+
+
+def single_item_click_probs(generator, states, item_features, num_displayed_items, item_ids=None, block_size=65536):
+    """
+    Input:
+        generator (Generator_UserModel): trained user model.
+        states (torch.Tensor): [num_states, state_dim]
+        item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features (the last row is the padding placeholder).
+        num_displayed_items (int): display set size of the generator (without the "not clicking" slot).
+        item_ids (torch.Tensor): [num_states] if given, only the item of every state is scored.
+        block_size (int): number of (state, item) pairs scored at once.
+    Return:
+        click_probs (torch.Tensor): [num_states, num_items] probability that the user clicks the item if it is displayed alone
+            (the other slots hold the padding placeholder), i.e. softmax over the item and the "not clicking" slot. [num_states] if item_ids is given.
+    The first layer of the generator is linear in its input slots, so it is computed once per item and once per state
+    and the (state, item) pairs only run through the remaining layers.
+    """
+    first_layer, rest = generator.model[0], generator.model[1:]
+    feature_dim = item_features.shape[-1]
+    weight = first_layer.weight # --> [hidden_dim, (num_displayed_items+1)*feature_dims + state_dim]
+    slot_weight = weight[:, :num_displayed_items * feature_dim].view(weight.shape[0], num_displayed_items, feature_dim)
+    state_weight = weight[:, (num_displayed_items + 1) * feature_dim:]
+
+    items, placeholder = item_features[:-1].to(weight.device), item_features[-1].to(weight.device)
+    item_part = items @ slot_weight[:, 0].T # --> [num_items, hidden_dim]
+    padding_part = slot_weight[:, 1:].sum(1) @ placeholder # --> [hidden_dim]
+    click_probs = []
+    with torch.no_grad():
+        if item_ids is not None:
+            scores = rest(states.to(weight.device) @ state_weight.T + padding_part + first_layer.bias + item_part[item_ids.to(weight.device)]) # --> [num_states, (num_displayed_items+1)]
+            return torch.sigmoid(scores[:, 0] - scores[:, -1]).cpu()
+        rows = max(1, block_size // items.shape[0])
+        for start in range(0, states.shape[0], rows):
+            context = states[start:start + rows].to(weight.device) @ state_weight.T + padding_part + first_layer.bias # --> [rows, hidden_dim]
+            scores = rest(context[:, None, :] + item_part[None, :, :]) # --> [rows, num_items, (num_displayed_items+1)]
+            click_probs.append(torch.sigmoid(scores[..., 0] - scores[..., -1]).cpu())
+    return torch.cat(click_probs)
+
+
+def policy_probs(scores, temperature=1.0):
+    """
+    Return:
+        probs (torch.Tensor): [num_steps, num_items] action probabilities softmax(scores / temperature).
+    """
+    return torch.softmax(scores.double() / temperature, dim=-1)
+
+
+def step_estimates(probs, steps, propensities, reward_model=None, max_weight=None):
+    """
+    Input:
+        probs (torch.Tensor): [num_steps, num_items] action probabilities of the evaluated policy.
+        steps (dict): see logged_steps.
+        propensities (torch.Tensor): [num_items] see inclusion_propensities.
+        reward_model (torch.Tensor): [num_steps, num_items] predicted click probabilities (direct method / doubly robust).
+        max_weight (float): if given, the importance weights are clipped to this value.
+    Return:
+        estimates (dict): estimator --> (numerator, denominator) [num_steps] per time step terms, the estimate is sum(numerator) / sum(denominator).
+    """
+    num_items = steps["num_items"]
+    display = steps["display_item_ids"]
+    valid = display < num_items # --> [num_steps, num_displayed_items]
+    display_ids = display.clamp_max(num_items - 1)
+    weights = probs.gather(1, display_ids) / propensities[display_ids] * valid # --> [num_steps, num_displayed_items]
+    if max_weight is not None:
+        weights = weights.clamp_max(max_weight)
+    rewards = (display == steps["picked_item_ids"][:, None]).double() # --> [num_steps, num_displayed_items]
+    ips = (weights * rewards).sum(1)
+    ones = torch.ones_like(ips)
+
+    estimates = {"ips": (ips, ones), "snips": (ips, weights.sum(1))}
+    if reward_model is not None:
+        reward_model = reward_model.double()
+        direct = (probs * reward_model).sum(1)
+        estimates["dm"] = (direct, ones)
+        estimates["dr"] = (direct + (weights * (rewards - reward_model.gather(1, display_ids))).sum(1), ones)
+    return estimates
+
+
+def per_user(values, step_users, num_users):
+    """
+    Return:
+        values (torch.Tensor): [num_users] sum of the per time step values of every user.
+    """
+    return torch.zeros(num_users, dtype=values.dtype).index_add_(0, step_users, values)
+
+
+def bootstrap(numerators, denominators, num_samples=1000, alpha=0.05, seed=0):
+    """
+    Input:
+        numerators, denominators (torch.Tensor): [num_users] per user sums of an estimator.
+        num_samples (int): number of bootstrap resamples of the users.
+        alpha (float): the confidence interval covers 1-alpha.
+    Return:
+        result (dict): estimate, confidence interval (percentile bootstrap) and standard error.
+    """
+    num_users = numerators.shape[0]
+    generator = torch.Generator().manual_seed(seed)
+    # every resample is a vector of user counts, all resamples are evaluated with one matrix product
+    resampled = torch.randint(num_users, (num_samples, num_users), generator=generator)
+    counts = torch.zeros(num_samples, num_users, dtype=torch.float64).scatter_add_(1, resampled, torch.ones(num_samples, num_users, dtype=torch.float64))
+    samples = (counts @ numerators.double()) / (counts @ denominators.double()).clamp_min(1e-12)
+    low, high = torch.quantile(samples, torch.tensor([alpha / 2, 1 - alpha / 2], dtype=torch.float64))
+    return {"estimate": (numerators.sum() / denominators.sum()).item(), "ci_low": low.item(), "ci_high": high.item(), "std_error": samples.std().item()}
+
+
+def simulate_returns(history_model, generator, policy, item_features, horizons, num_displayed_items, temperature=1.0, num_simulations=1, seed=0):
+    """
+    Input:
+        history_model (History_LSTM/History_GRU), generator (Generator_UserModel): trained user model (the simulator).
+        policy (callable): states [num_states, state_dim] --> scores [num_states, num_items].
+        item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features.
+        horizons (torch.Tensor): [num_users] number of simulated time steps of every user.
+        num_simulations (int): number of simulated sessions per user.
+    Return:
+        clicks (torch.Tensor): [num_users] expected number of clicks of every user over its horizon (averaged over the simulations).
+    All users (and simulations) are simulated at once. At every time step the policy recommends an item, the user model gives its
+    click probability (which is accumulated) and the sampled click (the item's features, or the zero "not clicking" vector) updates the state.
+    """
+    generator_rng = torch.Generator().manual_seed(seed)
+    horizons = horizons.repeat(num_simulations) # --> [num_users*num_simulations]
+    device = generator.model[0].weight.device
+    items = item_features[:-1].to(device)
+    state = torch.zeros(horizons.shape[0], history_model.state_dim, device=device)
+    hidden = None
+    clicks = torch.zeros(horizons.shape[0], dtype=torch.float64)
+    with torch.no_grad():
+        for t in range(int(horizons.max())):
+            active = (horizons > t).double()
+            probs = policy_probs(policy(state), temperature)
+            actions = torch.multinomial(probs.float().cpu(), 1, generator=generator_rng).squeeze(1) # --> [num_users*num_simulations]
+            click_probs = single_item_click_probs(generator, state, item_features, num_displayed_items, item_ids=actions)
+            clicks += active * click_probs.double()
+            clicked = torch.rand(click_probs.shape, generator=generator_rng) < click_probs
+            clicked_features = items[actions.to(device)] * clicked.to(device)[:, None].float() # --> [num_users*num_simulations, feature_dim]
+            out, hidden = history_model(clicked_features[:, None, :], hidden, return_hidden=True)
+            state = out[:, -1]
+    return clicks.view(num_simulations, -1).mean(0)
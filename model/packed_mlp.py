@@ -0,0 +1,30 @@
+import torch
+
+# Packed computation of the Generator_UserModel/Discriminator_RewardModel MLPs. Instead of unpacking the PackedSequences to
+# [batch_size, max(num_time_steps), ...] and running the MLP on every padded time step, the MLP runs on the rows of the packed
+# .data (the valid time steps) only. The padded time steps of pad_packed_sequence all have the same (all zero) input, so when a
+# padded output is requested their output is computed once and broadcast.
+
+
+def packed_mlp_forward(mlp, state, displayed_items, packed_output=False):
+    """
+    Input:
+        mlp (callable): mlp(state [num_rows, state_dim], displayed_items [num_rows, num_displayed_items, ...]) --> [num_rows, output_size]
+        state (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), state_dim]
+        displayed_items (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_items, feature_dims] (or the item ids),
+            packed with the same lengths as the state.
+        packed_output (bool): if True, the output is returned as a PackedSequence of the valid time steps.
+    Return:
+        output (torch.Tensor): [batch_size (#users), max(num_time_steps), output_size] (rnn.PackedSequence if packed_output),
+            the padded time steps hold the output of the all zero input (same as the MLP on the pad_packed_sequence inputs).
+    """
+    output = torch.nn.utils.rnn.PackedSequence(mlp(state.data, displayed_items.data), state.batch_sizes, state.sorted_indices, state.unsorted_indices) # --> [sum(num_time_steps), output_size]
+    if packed_output:
+        return output
+
+    output_unpacked, lens_unpacked = torch.nn.utils.rnn.pad_packed_sequence(output, batch_first=True) # --> [batch_size (#users), max(num_time_steps), output_size]
+    if int(lens_unpacked.sum()) == output_unpacked.shape[0] * output_unpacked.shape[1]:
+        return output_unpacked # no padding
+    padding_output = mlp(torch.zeros_like(state.data[:1]), torch.zeros_like(displayed_items.data[:1])) # --> [1, output_size]
+    valid = torch.arange(output_unpacked.shape[1])[None, :] < lens_unpacked[:, None] # --> [batch_size (#users), max(num_time_steps)]
+    return torch.where(valid[..., None].to(output_unpacked.device), output_unpacked, padding_output)
@@ -0,0 +1,254 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
+import torch
+
+# Registry of trained user models (History_LSTM, Generator_UserModel and Discriminator_RewardModel bundles) served from one
+# process, keyed by (dataset, version). New checkpoint versions are loaded by a background thread and swapped in atomically:
+# a request holds the bundle it started with until it finishes, so switching the active version never drops in-flight requests
+# and a retired version is released only after its last request. The weights of a bundle are read-only (eval mode, no grad) and
+# shared by every thread that scores with it.
+
+
+def tensors_nbytes(tensors, seen=None):
+    """
+    Input:
+        tensors (iterable): torch.Tensors.
+        seen (set): data pointers of the storages that are already counted (updated in place), e.g. to count storages shared by bundles once.
+    Return:
+        nbytes (int): bytes of the distinct storages of the tensors.
+    """
+    seen = set() if seen is None else seen
+    nbytes = 0
+    for tensor in tensors:
+        storage = tensor.untyped_storage() if hasattr(tensor, "untyped_storage") else tensor.storage()
+        if storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            nbytes += storage.nbytes() if hasattr(storage, "nbytes") else storage.size() * tensor.element_size()
+    return nbytes
+
+
+class ModelBundle():
+    def __init__(self, dataset, version, config_dict, history_LSTM, generator_UserModel, discriminator_RewardModel, loaded_epoch=None):
+        """
+        dataset (str): dataset the models were trained on (e.g. "yelp").
+        version (str): version of the checkpoints (e.g. the name of their folder).
+        config_dict (dict): configuration of the models (including the model dims).
+        history_LSTM (History_LSTM/History_GRU), generator_UserModel (Generator_UserModel), discriminator_RewardModel (Discriminator_RewardModel):
+            trained models, they are switched to eval mode and their parameters to requires_grad=False (read-only).
+        loaded_epoch (int): epoch of the checkpoints.
+        """
+        self.dataset = dataset
+        self.version = version
+        self.config_dict = config_dict
+        self.history_LSTM = history_LSTM
+        self.generator_UserModel = generator_UserModel
+        self.discriminator_RewardModel = discriminator_RewardModel
+        self.loaded_epoch = loaded_epoch
+        self.loaded_at = time.time()
+        self.in_flight = 0 # number of requests that currently use the bundle (guarded by the lock of the ModelRegistry)
+        for model in self.models():
+            model.eval()
+            for param in model.parameters():
+                param.requires_grad = False
+
+    def models(self):
+        return [self.history_LSTM, self.generator_UserModel, self.discriminator_RewardModel]
+
+    def tensors(self):
+        """
+        Return:
+            tensors (list): parameters and buffers of the models and the tensors of their ItemTable (sparse inputs).
+        """
+        tensors = [tensor for model in self.models() for tensor in list(model.parameters()) + list(model.buffers())]
+        item_table = self.history_LSTM.item_table
+        if item_table is not None:
+            tensors.extend(tensor for tensor in vars(item_table).values() if isinstance(tensor, torch.Tensor))
+        return tensors
+
+    @property
+    def nbytes(self):
+        return tensors_nbytes(self.tensors())
+
+    def score(self, real_click_history, display_set):
+        """
+        Input:
+            real_click_history (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), feature_dim] (or the item ids)
+            display_set (rnn.PackedSequence): [batch_size (#users), max(num_time_steps), num_displayed_item, feature_dim] (or the item ids)
+        Return:
+            action_scores (torch.Tensor): [batch_size (#users), max(num_time_steps), (num_displayed_items+1)] Generator_UserModel scores.
+            rewards (torch.Tensor): [batch_size (#users), max(num_time_steps), (num_displayed_items+1)] Discriminator_RewardModel rewards.
+        """
+        device = self.generator_UserModel.device
+        real_click_history = real_click_history.to(device)
+        display_set = display_set.to(device)
+        with torch.no_grad():
+            real_states = self.history_LSTM(real_click_history) # --> [batch_size (#users), max(num_time_steps), state_dim]
+            return self.generator_UserModel(real_states, display_set), self.discriminator_RewardModel(real_states, display_set)
+
+
+def load_bundle(dataset, version, config_dict, item_features=None):
+    """
+    Input:
+        dataset (str), version (str): key of the bundle.
+        config_dict (dict): configuration whose ckpt_path/pretrained_*_path point to the checkpoints of the version. The model dims are read from the checkpoints.
+        item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features, enables the sparse input path (see GAN.set_item_features).
+    Return:
+        bundle (ModelBundle): the loaded models.
+    """
+    from main import infer_model_dims_from_checkpoints, build_gan # main imports the model package
+    config_dict = infer_model_dims_from_checkpoints(deepcopy(config_dict))
+    gan = build_gan(config_dict)
+    loaded_epoch, _, _ = gan.load_checkpoints(load_optimizers=False)
+    if item_features is not None:
+        gan.set_item_features(item_features)
+    return ModelBundle(dataset, version, config_dict, gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel, loaded_epoch=loaded_epoch)
+
+
+class ModelRegistry():
+    def __init__(self, num_loader_threads=1, keep_retired=False):
+        """
+        num_loader_threads (int): number of background threads that load checkpoint versions.
+        keep_retired (bool): if True, versions that are switched out stay loaded (e.g. for a fast rollback with activate()),
+            otherwise they are released once their in-flight requests finished.
+        """
+        self._lock = threading.Lock()
+        self._active = {} # dataset --> active ModelBundle
+        self._bundles = {} # (dataset, version) --> loaded ModelBundle (active, retired with in-flight requests, or kept)
+        self._loading = {} # (dataset, version) --> Future of the background load
+        self._executor = ThreadPoolExecutor(max_workers=num_loader_threads, thread_name_prefix="registry-loader")
+        self.keep_retired = keep_retired
+
+    def load(self, dataset, version, config_dict, item_features=None, activate=True, check=None):
+        """
+        Input:
+            dataset (str), version (str): key of the bundle.
+            config_dict (dict), item_features (torch.Tensor): see load_bundle.
+            activate (bool): if True, the version becomes the active version of the dataset as soon as it is loaded.
+            check (callable): if given, check(bundle) is called before the bundle is registered and raises if it must not be served
+                (e.g. its feature_dim does not match the item features of the dataset).
+        Return:
+            future (concurrent.futures.Future): resolves to the ModelBundle (or raises the loading error, the active version is unchanged then).
+        Loads the checkpoints of the version in a background thread, requests keep being served by the active version meanwhile.
+        """
+        key = (dataset, version)
+        with self._lock:
+            if key in self._loading:
+                return self._loading[key]
+            future = self._executor.submit(self._load, dataset, version, config_dict, item_features, activate, check)
+            self._loading[key] = future
+        return future
+
+    def _load(self, dataset, version, config_dict, item_features, activate, check):
+        try:
+            bundle = load_bundle(dataset, version, config_dict, item_features=item_features)
+            if check is not None:
+                check(bundle)
+            with self._lock:
+                self._bundles[(dataset, version)] = bundle
+                if activate:
+                    self._activate(dataset, version)
+            return bundle
+        finally:
+            with self._lock:
+                self._loading.pop((dataset, version), None)
+
+    def add(self, bundle, activate=True):
+        """
+        Input:
+            bundle (ModelBundle): already loaded models (e.g. built in this process).
+            activate (bool): if True, the bundle becomes the active version of its dataset.
+        """
+        with self._lock:
+            self._bundles[(bundle.dataset, bundle.version)] = bundle
+            if activate:
+                self._activate(bundle.dataset, bundle.version)
+
+    def activate(self, dataset, version):
+        """
+        Switches the active version of the dataset to a loaded version (e.g. a kept retired version for a rollback).
+        """
+        with self._lock:
+            self._activate(dataset, version)
+
+    def _activate(self, dataset, version):
+        # requires the lock. The switch is a single assignment: requests that already hold the old bundle finish with it.
+        retired = self._active.get(dataset)
+        self._active[dataset] = self._bundles[(dataset, version)]
+        if retired is not None and retired is not self._active[dataset]:
+            self._release_if_unused(retired)
+
+    def _release_if_unused(self, bundle):
+        # requires the lock
+        key = (bundle.dataset, bundle.version)
+        if self._active.get(bundle.dataset) is not bundle and bundle.in_flight == 0 and not self.keep_retired and self._bundles.get(key) is bundle:
+            del self._bundles[key]
+
+    def unload(self, dataset, version):
+        """
+        Releases a loaded version that is not active (kept retired versions). Its in-flight requests still finish with it.
+        """
+        with self._lock:
+            bundle = self._bundles[(dataset, version)]
+            assert self._active.get(dataset) is not bundle, f"{dataset} {version} is the active version"
+            del self._bundles[(dataset, version)]
+
+    @contextmanager
+    def acquire(self, dataset):
+        """
+        Usage:
+            with registry.acquire("yelp") as bundle:
+                action_scores, rewards = bundle.score(real_click_history, display_set)
+        The bundle stays valid until the end of the block even if another version is activated meanwhile.
+        """
+        with self._lock:
+            if dataset not in self._active:
+                raise KeyError(f"no active model of the {dataset} dataset")
+            bundle = self._active[dataset]
+            bundle.in_flight += 1
+        try:
+            yield bundle
+        finally:
+            with self._lock:
+                bundle.in_flight -= 1
+                self._release_if_unused(bundle)
+
+    def score(self, dataset, real_click_history, display_set):
+        """
+        Return:
+            action_scores, rewards (torch.Tensor): see ModelBundle.score, computed by the active version of the dataset.
+            version (str): version that computed them.
+        """
+        with self.acquire(dataset) as bundle:
+            action_scores, rewards = bundle.score(real_click_history, display_set)
+            return action_scores, rewards, bundle.version
+
+    def active_versions(self):
+        with self._lock:
+            return {dataset: bundle.version for dataset, bundle in self._active.items()}
+
+    def memory_report(self):
+        """
+        Return:
+            report (dict): {"bundles": [{"dataset", "version", "active", "in_flight", "loaded_epoch", "nbytes"}], "loading": [(dataset, version)],
+                "total_nbytes": bytes of all loaded bundles (storages shared by several bundles are counted once)}
+        """
+        with self._lock:
+            bundles = list(self._bundles.values())
+            rows = [{"dataset": bundle.dataset, "version": bundle.version, "active": self._active.get(bundle.dataset) is bundle, \
+                "in_flight": bundle.in_flight, "loaded_epoch": bundle.loaded_epoch} for bundle in bundles]
+            loading = list(self._loading)
+        seen = set()
+        total_nbytes = 0
+        for row, bundle in zip(rows, bundles):
+            row["nbytes"] = bundle.nbytes
+            total_nbytes += tensors_nbytes(bundle.tensors(), seen)
+        return {"bundles": rows, "loading": loading, "total_nbytes": total_nbytes}
+
+    def close(self, wait=True):
+        """
+        Stops the background loader threads (waits for the running loads if wait is True).
+        """
+        self._executor.shutdown(wait=wait)
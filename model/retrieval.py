@@ -0,0 +1,187 @@
+import torch
+
+# Full catalog candidate retrieval for the learned user state. The History_LSTM states are mapped into the item feature space
+# by a linear query projection (fit_query_projection) and the items with the largest inner products are retrieved, either
+# exactly (BruteForceIndex, blocked matrix products) or approximately (IVFIndex, inverted file over k-means clusters).
+# The retrieved items can be fed to the Discriminator_RewardModel as a display set (see to_display_set).
+
+
+def blocked_topk(queries, item_vectors, k, block_size=65536, item_ids=None):
+    """
+    Input:
+        queries (torch.Tensor): [num_queries, dim]
+        item_vectors (torch.Tensor): [num_items, dim]
+        k (int): number of items to retrieve per query.
+        block_size (int): number of items scored at once, bounds the memory of the score matrix to [num_queries, block_size].
+        item_ids (torch.Tensor): [num_items] ids of the item_vectors. Defaults to their row index.
+    Return:
+        top_scores (torch.Tensor): [num_queries, k] inner products of the retrieved items (descending).
+        top_ids (torch.Tensor): [num_queries, k] ids of the retrieved items.
+    """
+    k = min(k, item_vectors.shape[0])
+    top_scores = torch.full((queries.shape[0], 0), float("-inf"), dtype=queries.dtype, device=queries.device)
+    top_ids = torch.zeros((queries.shape[0], 0), dtype=torch.int64, device=queries.device)
+    for start in range(0, item_vectors.shape[0], block_size):
+        block_scores = queries @ item_vectors[start:start + block_size].T # --> [num_queries, block_size]
+        block_scores, block_ids = torch.topk(block_scores, min(k, block_scores.shape[1]), dim=1)
+        block_ids = block_ids + start if item_ids is None else item_ids[block_ids + start]
+        # merge with the running top-k
+        top_scores, merged = torch.topk(torch.cat((top_scores, block_scores), dim=1), min(k, top_scores.shape[1] + block_scores.shape[1]), dim=1)
+        top_ids = torch.gather(torch.cat((top_ids, block_ids), dim=1), 1, merged)
+    return top_scores, top_ids
+
+
+class BruteForceIndex():
+    """
+    Exact inner product search over the whole catalog with blocked matrix products.
+    """
+    def __init__(self, item_vectors, block_size=65536):
+        """
+        item_vectors (torch.Tensor): [num_items, dim] precomputed item vectors.
+        block_size (int): number of items scored at once.
+        """
+        self.item_vectors = item_vectors
+        self.block_size = block_size
+
+    def search(self, queries, k):
+        """
+        Input:
+            queries (torch.Tensor): [num_queries, dim]
+            k (int): number of items to retrieve per query.
+        Return:
+            top_scores (torch.Tensor), top_ids (torch.Tensor): [num_queries, k] scores and item ids (descending).
+        """
+        return blocked_topk(queries, self.item_vectors, k, self.block_size)
+
+
+def kmeans(vectors, num_clusters, iterations=10, block_size=65536, seed=0):
+    """
+    Input:
+        vectors (torch.Tensor): [num_vectors, dim]
+        num_clusters (int): number of clusters.
+        iterations (int): number of Lloyd iterations.
+        block_size (int): number of vectors assigned at once.
+        seed (int): seed of the initial centroid sample.
+    Return:
+        centroids (torch.Tensor): [num_clusters, dim]
+        assignments (torch.Tensor): [num_vectors] cluster of every vector.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = vectors[torch.randperm(vectors.shape[0], generator=generator)[:num_clusters].to(vectors.device)].clone()
+    assignments = torch.zeros(vectors.shape[0], dtype=torch.int64, device=vectors.device)
+    for _ in range(iterations):
+        # nearest centroid: argmin ||x - c||^2 = argmax (2 x.c - ||c||^2)
+        centroid_norms = (centroids ** 2).sum(-1)
+        for start in range(0, vectors.shape[0], block_size):
+            assignments[start:start + block_size] = torch.argmax(2 * vectors[start:start + block_size] @ centroids.T - centroid_norms, dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, vectors)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+        # empty clusters keep their centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None].to(vectors.dtype)
+    return centroids, assignments
+
+
+class IVFIndex():
+    """
+    Approximate inner product search: the items are clustered with k-means (inverted lists) and only the items of the
+    nprobe lists whose centroids have the largest inner products with the query are scored exactly.
+    """
+    def __init__(self, item_vectors, num_lists=None, nprobe=8, iterations=10, block_size=65536, seed=0, search_block_size=2**22):
+        """
+        item_vectors (torch.Tensor): [num_items, dim] precomputed item vectors.
+        num_lists (int): number of inverted lists (k-means clusters). Defaults to sqrt(num_items).
+        nprobe (int): number of lists scored per query (trades recall for latency).
+        iterations (int): k-means iterations.
+        block_size (int): number of items processed at once during clustering.
+        seed (int): seed of the k-means initialization.
+        search_block_size (int): number of candidate scores buffered at once during a search (bounds the size of the query blocks).
+        """
+        num_lists = num_lists or max(1, int(item_vectors.shape[0] ** 0.5))
+        self.nprobe = min(nprobe, num_lists)
+        self.centroids, assignments = kmeans(item_vectors, num_lists, iterations, block_size, seed)
+        # items sorted by list, the items of list l are sorted_ids[list_offsets[l]:list_offsets[l+1]]
+        order = torch.argsort(assignments)
+        self.sorted_ids = order
+        self.sorted_vectors = item_vectors[order].contiguous()
+        self.list_offsets = torch.cat((torch.zeros(1, dtype=torch.int64, device=item_vectors.device), \
+            torch.cumsum(torch.bincount(assignments, minlength=num_lists), dim=0)))
+        self.max_list_size = int((self.list_offsets[1:] - self.list_offsets[:-1]).max())
+        self.search_block_size = search_block_size
+
+    def search(self, queries, k, nprobe=None):
+        """
+        Input:
+            queries (torch.Tensor): [num_queries, dim]
+            k (int): number of items to retrieve per query.
+            nprobe (int): overrides the nprobe of the index.
+        Return:
+            top_scores (torch.Tensor), top_ids (torch.Tensor): [num_queries, k] scores and item ids (descending).
+            Rows are padded with -inf scores and id -1 if the probed lists hold less than k items.
+        """
+        nprobe = min(nprobe or self.nprobe, self.centroids.shape[0])
+        probed_lists = torch.topk(queries @ self.centroids.T, nprobe, dim=1).indices # --> [num_queries, nprobe]
+        top_scores = torch.full((queries.shape[0], k), float("-inf"), dtype=queries.dtype, device=queries.device)
+        top_ids = torch.full((queries.shape[0], k), -1, dtype=torch.int64, device=queries.device)
+        # the queries are processed in blocks, the probed lists of a block are scored list by list: every list is scored
+        # against all of the queries of the block that probe it with one matrix product
+        query_block_size = max(1, self.search_block_size // (nprobe * max(self.max_list_size, 1)))
+        for block_start in range(0, queries.shape[0], query_block_size):
+            block_queries = queries[block_start:block_start + query_block_size]
+            block_lists = probed_lists[block_start:block_start + query_block_size].reshape(-1) # --> [block_num_queries*nprobe]
+            scores = torch.full((len(block_lists), self.max_list_size), float("-inf"), dtype=queries.dtype, device=queries.device)
+            # (query, probe) pairs grouped by list
+            order = torch.argsort(block_lists)
+            lists, counts = torch.unique_consecutive(block_lists[order], return_counts=True)
+            for l, pairs in zip(lists.tolist(), torch.split(order, counts.tolist())):
+                start, end = self.list_offsets[l].item(), self.list_offsets[l+1].item()
+                scores[pairs, :end-start] = block_queries[pairs // nprobe] @ self.sorted_vectors[start:end].T
+            block_top_scores, top = torch.topk(scores.view(len(block_queries), -1), min(k, nprobe * self.max_list_size), dim=1) # over [nprobe*max_list_size]
+            # buffer position --> (query, probe) pair and position in the probed list --> item id
+            pairs = top // self.max_list_size + torch.arange(len(block_queries), device=queries.device)[:, None] * nprobe
+            positions = torch.clamp(self.list_offsets[block_lists[pairs]] + top % self.max_list_size, max=len(self.sorted_ids) - 1)
+            block_top_ids = torch.where(torch.isinf(block_top_scores), torch.full_like(top, -1), self.sorted_ids[positions])
+            top_scores[block_start:block_start + len(block_queries), :top.shape[1]] = block_top_scores
+            top_ids[block_start:block_start + len(block_queries), :top.shape[1]] = block_top_ids
+        return top_scores, top_ids
+
+
+def fit_query_projection(states, next_clicked_features, ridge=1.0):
+    """
+    Input:
+        states (torch.Tensor): [num_samples, state_dim] History_LSTM states.
+        next_clicked_features (torch.Tensor): [num_samples, feature_dim] features of the item clicked at the next time step.
+        ridge (float): L2 regularization.
+    Return:
+        projection (torch.Tensor): [state_dim+1, feature_dim] ridge regression from [state, 1] to the next clicked item features.
+            The query of a state is [state, 1] @ projection, so items are scored by their inner product with the predicted next click.
+    """
+    inputs = torch.cat((states, torch.ones((states.shape[0], 1), dtype=states.dtype, device=states.device)), dim=1).double()
+    gram = inputs.T @ inputs + ridge * torch.eye(inputs.shape[1], dtype=inputs.dtype, device=inputs.device)
+    projection = torch.linalg.solve(gram, inputs.T @ next_clicked_features.double())
+    return projection.to(states.dtype)
+
+
+def state_queries(states, projection):
+    """
+    Input:
+        states (torch.Tensor): [num_queries, state_dim]
+        projection (torch.Tensor): [state_dim+1, feature_dim] (see fit_query_projection)
+    Return:
+        queries (torch.Tensor): [num_queries, feature_dim]
+    """
+    return states @ projection[:-1] + projection[-1]
+
+
+def to_display_set(item_features, item_ids, padding_item_id):
+    """
+    Input:
+        item_features (torch.Tensor): [num_items+1, feature_dim] item features (Dataset.item_features, the last row is the padding placeholder).
+        item_ids (torch.Tensor): [num_queries, num_displayed_items] retrieved item ids (-1 for missing items).
+        padding_item_id (int): row of the padding placeholder.
+    Return:
+        display_set (torch.Tensor): [num_queries, 1, num_displayed_items, feature_dim] display set of one time step per query,
+            the input format of the Discriminator_RewardModel.
+    """
+    item_ids = torch.where(item_ids < 0, torch.full_like(item_ids, padding_item_id), item_ids)
+    return item_features[item_ids].unsqueeze(1)
@@ -0,0 +1,84 @@
+import torch
+
+# Sampled softmax objective of the Generator_UserModel/Discriminator_RewardModel (sampled_softmax_negatives in config.yaml).
+# Instead of scoring all (num_displayed_items+1) slots of a time step and masking them with one hot vectors, the clicked slot and
+# num_negatives slots sampled from a proposal distribution Q over the valid slots of the step are scored (only their rows of the
+# output layer are computed). The logits of the negatives are corrected by log(expected number of samples) (log-Q correction) and
+# negatives that hit the clicked slot are removed (accidental hits), so the sampled normalizer converges to the one of the full
+# softmax over the display set as num_negatives grows.
+
+
+def valid_slots(displayed_items, item_table=None):
+    """
+    Input:
+        displayed_items (torch.Tensor): [num_rows, num_displayed_items, feature_dims], or the item ids [num_rows, num_displayed_items] (sparse inputs).
+        item_table (ItemTable): item features of the ids (sparse inputs only).
+    Return:
+        valid (torch.Tensor): [num_rows, (num_displayed_items+1)] False for the padded slots of the display sets, the last
+            ("not clicking") slot is always valid.
+    """
+    if item_table is not None and not torch.is_floating_point(displayed_items):
+        valid = displayed_items != item_table.padding_id
+    else:
+        valid = (displayed_items != 1).any(-1) # the padding placeholder is the all ones vector
+    return torch.cat((valid, torch.ones_like(valid[:, :1])), dim=-1)
+
+
+def slot_click_frequencies(clicked_items, num_slots, smoothing=1.0):
+    """
+    Input:
+        clicked_items (torch.Tensor): [num_steps] display set index of the clicked items (e.g. Dataset.clicked_items_index of the train split).
+        num_slots (int): (num_displayed_items+1)
+        smoothing (float): count added to every slot (additive smoothing, every slot can be sampled).
+    Return:
+        proposal (torch.Tensor): [num_slots] click frequency of every display slot, used as the proposal Q of the negatives.
+    """
+    counts = torch.bincount(clicked_items.long(), minlength=num_slots)[:num_slots].float() + smoothing
+    return counts / counts.sum()
+
+
+def sample_candidates(positives, valid, num_negatives, proposal=None):
+    """
+    Input:
+        positives (torch.Tensor): [num_rows] clicked slot of every row.
+        valid (torch.Tensor): [num_rows, num_slots] valid slots of every row (see valid_slots).
+        num_negatives (int): number of negatives sampled (with replacement) per row.
+        proposal (torch.Tensor): [num_slots] proposal weights of the slots (see slot_click_frequencies), uniform over the valid slots if None.
+    Return:
+        candidates (torch.Tensor): [num_rows, 1+num_negatives] slots to score, the clicked slot first.
+        log_expected_counts (torch.Tensor): [num_rows, 1+num_negatives] log(num_negatives * Q(slot)) of the sampled negatives (log-Q correction),
+            0 for the clicked slot (it is always scored).
+    """
+    q = valid.float() if proposal is None else valid.float() * proposal.to(valid.device)[None, :]
+    q = q / q.sum(dim=-1, keepdim=True) # --> [num_rows, num_slots]
+    negatives = torch.multinomial(q, num_negatives, replacement=True) # --> [num_rows, num_negatives]
+    candidates = torch.cat((positives.long()[:, None], negatives), dim=-1) # --> [num_rows, 1+num_negatives]
+    log_expected_counts = torch.log(num_negatives * q.gather(1, negatives)) # --> [num_rows, num_negatives]
+    return candidates, torch.cat((torch.zeros_like(log_expected_counts[:, :1]), log_expected_counts), dim=-1)
+
+
+def score_slots(output_layer, hidden, slots):
+    """
+    Input:
+        output_layer (torch.nn.Linear): last Linear of the MLP, one output row per slot.
+        hidden (torch.Tensor): [num_rows, hidden_dim] input of the output_layer.
+        slots (torch.Tensor): [num_rows, num_candidates] slots to score.
+    Return:
+        logits (torch.Tensor): [num_rows, num_candidates] outputs of the output_layer for the slots, before the (Tanh) activation of the MLP
+            which would bound the logits of the softmax (the other rows of the output_layer are not computed).
+    """
+    return torch.bmm(output_layer.weight[slots], hidden.unsqueeze(-1)).squeeze(-1) + output_layer.bias[slots] # --> [num_rows, num_candidates]
+
+
+def sampled_softmax_log_likelihood(candidate_scores, candidates, log_expected_counts):
+    """
+    Input:
+        candidate_scores (torch.Tensor): [num_rows, 1+num_negatives] logits of the candidates (clicked slot first, see score_slots).
+        candidates (torch.Tensor), log_expected_counts (torch.Tensor): see sample_candidates.
+    Return:
+        log_likelihood (torch.Tensor): [num_rows] log-Q corrected sampled softmax log probability of the clicked slot.
+    """
+    logits = candidate_scores - log_expected_counts
+    accidental_hits = candidates[:, 1:] == candidates[:, :1] # the clicked slot sampled as a negative
+    logits = torch.cat((logits[:, :1], logits[:, 1:].masked_fill(accidental_hits, float("-inf"))), dim=-1)
+    return torch.log_softmax(logits, dim=-1)[:, 0]
@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+import json
+import os
+
+#======================================================================================================
+### Append-only processed store of a dataset. Every ingested raw log (.txt, same format as yelp.txt) is
+# processed once and written as a new segment file; nothing that was written before is rewritten.
+#
+# <dset>-store/
+#     index.json       number of items/users (and users per split), the list of segments with their number of time steps per split
+#                      and display size (written last, readers only trust what it lists)
+#     items.txt        raw ItemId of every item, line i is item i (appended in place)
+#     item_features.npy  [num_items, feature_dim] dense item features, only if index.json has "features": "item_features.npy"
+#                      (e.g. synthetic logs of a .pkl dataset, see generate_trajectories.py)
+#     users.tsv        raw SessionId and split (0: train, 1: validation, 2: test) of every user, line u is user u (appended in place)
+#     seg-XXXXX.npz    per time step arrays of the segment (same layout as the data.Dataset tensors):
+#                          step_user_ids [num_steps], display_item_ids [num_steps, max_display_size] (-1 padded),
+#                          picked_item_ids [num_steps], clicked_items_index [num_steps]
+#
+# Item features are one hot (np.eye(num_items)) and not stored, unless dense features were set (set_item_features). The split
+# of a user is fixed by the log it first appears in; sessions that continue in a later log are appended to the same user.
+#======================================================================================================
+
+LOG_COLUMNS = ['SessionId', 'Time', 'ItemId', 'is_click', 'session_new_index', 'item_new_index', 'tr_val_tst']
+
+
+def build_time_steps(user_ids, times, item_ids, is_click):
+    """
+    Groups the (de-duplicated) log rows into display sets, one per (user, time step).
+    Input:
+        user_ids (np.ndarray): [rows], times (np.ndarray): [rows], item_ids (np.ndarray): [rows], is_click (np.ndarray): [rows] (bool)
+    Return:
+        step_user_ids (np.ndarray): [num_steps] user of every time step (sorted by user, then time).
+        display_item_ids (np.ndarray): [num_steps, max_display_size] (-1 padded), picked_item_ids (np.ndarray): [num_steps], clicked_items_index (np.ndarray): [num_steps]
+    """
+    # the stable sort keeps the row order inside a display set
+    order = np.lexsort((times, user_ids))
+    item_ids, user_ids, times, is_click = item_ids[order], user_ids[order], times[order], is_click[order]
+    new_step = np.ones(len(order), dtype=bool)
+    new_step[1:] = (user_ids[1:] != user_ids[:-1]) | (times[1:] != times[:-1])
+    step = np.cumsum(new_step) - 1 # --> [rows] time step of every row
+    step_starts = np.flatnonzero(new_step)
+    position = np.arange(len(order)) - step_starts[step] # --> [rows] index in the display set
+    num_steps = len(step_starts)
+
+    display_item_ids = np.full((num_steps, position.max() + 1), -1, dtype=np.int64)
+    display_item_ids[step, position] = item_ids
+    assert np.bincount(step[is_click], minlength=num_steps).min() >= 1, "every display set needs a clicked item"
+    picked_item_ids = np.empty(num_steps, dtype=np.int64)
+    clicked_items_index = np.empty(num_steps, dtype=np.int64)
+    picked_item_ids[step[is_click]] = item_ids[is_click]
+    clicked_items_index[step[is_click]] = position[is_click]
+    return user_ids[step_starts], display_item_ids, picked_item_ids, clicked_items_index
+
+
+def write_segment(folder, name, source, step_user_ids, display_item_ids, picked_item_ids, clicked_items_index, step_splits):
+    """
+    Writes the per time step arrays of a segment (atomically, the segment is not visible before SegmentStore.commit_segment lists it).
+    Input:
+        folder (str): folder of the store.
+        name (str): name of the segment (seg-XXXXX).
+        source (str): what the segment was built from (e.g. the raw log file).
+        step_user_ids, display_item_ids, picked_item_ids, clicked_items_index (np.ndarray): see build_time_steps.
+        step_splits (np.ndarray): [num_steps] split of the user of every time step.
+    Return:
+        segment (dict): index entry of the segment.
+    """
+    segment = {"name": name, "source": source, "num_steps": int(len(step_user_ids)),
+        "num_users": int(len(np.unique(step_user_ids))), "display_size": int(display_item_ids.shape[1]),
+        "split_steps": np.bincount(step_splits, minlength=3).tolist()}
+    os.makedirs(folder, exist_ok=True)
+    tmp_file = os.path.join(folder, name + ".tmp.npz")
+    np.savez(tmp_file, step_user_ids=step_user_ids, display_item_ids=display_item_ids, picked_item_ids=picked_item_ids, clicked_items_index=clicked_items_index)
+    os.replace(tmp_file, os.path.join(folder, name + ".npz"))
+    return segment
+
+
+class SegmentStore():
+    def __init__(self, folder):
+        """
+        folder (str): folder of the store (created if it does not exist).
+        """
+        self.folder = folder
+        self.index_file = os.path.join(folder, "index.json")
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {"num_items": 0, "num_users": 0, "features": "one_hot", "segments": []}
+
+    def _read_lines(self, filename, num_lines):
+        # only the first num_lines lines are committed (listed in index.json)
+        if num_lines == 0:
+            return []
+        with open(os.path.join(self.folder, filename)) as f:
+            return [next(f).rstrip('\n') for _ in range(num_lines)]
+
+    def item_ids(self):
+        """
+        Return:
+            item_ids (dict): raw ItemId --> item index.
+        """
+        return {item: i for i, item in enumerate(self._read_lines("items.txt", self.index["num_items"]))}
+
+    def users(self):
+        """
+        Return:
+            user_ids (dict): raw SessionId --> user index.
+            user_splits (np.ndarray): [num_users] split of every user.
+        """
+        lines = [line.split('\t') for line in self._read_lines("users.tsv", self.index["num_users"])]
+        return {session: u for u, (session, _) in enumerate(lines)}, np.array([int(split) for _, split in lines], dtype=np.int64)
+
+    @staticmethod
+    def _encode(values, order_by, id_map):
+        """
+        Maps the raw ids to indices, unseen ids get the next free indices (in the order of order_by, e.g. item_new_index of the log).
+        Return:
+            ids (np.ndarray): index of every value.
+            new_values (list): unseen raw ids in the order of their new indices.
+        """
+        uniques, first = np.unique(values, return_index=True)
+        unseen = [(order_by[i], value) for value, i in zip(uniques, first) if value not in id_map]
+        new_values = [value for _, value in sorted(unseen)]
+        for value in new_values:
+            id_map[value] = len(id_map)
+        return np.array([id_map[value] for value in uniques], dtype=np.int64)[np.searchsorted(uniques, values)], new_values
+
+    def append_log(self, filename):
+        """
+        Input:
+            filename (str): raw session log (.txt) to ingest as a new segment.
+        Return:
+            segment (dict): index entry of the written segment.
+        """
+        raw_data = pd.read_csv(filename, sep='\t', usecols=LOG_COLUMNS, dtype={'SessionId': str, 'ItemId': str})
+
+        # Same de-duplication as process_data.py (the clicked row of a duplicated display wins). The sort is stable so that the order of the
+        # items in a display set does not depend on how the logs are split into files (process_data.py may permute the unclicked items).
+        raw_data.drop_duplicates(subset=['SessionId','Time','ItemId','is_click'], inplace=True)
+        raw_data.sort_values(by='is_click', inplace=True, kind='stable')
+        raw_data.drop_duplicates(keep='last', subset=['SessionId','Time','ItemId'], inplace=True)
+
+        # id maps are updated in place (appended)
+        item_map = self.item_ids()
+        user_map, user_splits = self.users()
+        item_ids, new_items = self._encode(raw_data['ItemId'].to_numpy(), raw_data['item_new_index'].to_numpy(), item_map)
+        user_ids, new_users = self._encode(raw_data['SessionId'].to_numpy(), raw_data['session_new_index'].to_numpy(), user_map)
+        split_tags = dict(zip(raw_data['SessionId'], raw_data['tr_val_tst']))
+
+        step_user_ids, display_item_ids, picked_item_ids, clicked_items_index = build_time_steps(user_ids, raw_data['Time'].to_numpy(), \
+            item_ids, raw_data['is_click'].to_numpy() == 1)
+
+        user_splits = np.concatenate((user_splits, np.array([int(split_tags[user]) for user in new_users], dtype=np.int64)))
+
+        segment = write_segment(self.folder, f"seg-{len(self.index['segments']):05d}", os.path.basename(filename), step_user_ids, display_item_ids, \
+            picked_item_ids, clicked_items_index, user_splits[step_user_ids])
+        self.commit_segment(segment, new_items=new_items, new_users=[(user, int(split_tags[user])) for user in new_users], \
+            split_users=np.bincount(user_splits, minlength=3).tolist())
+        return segment
+
+    def set_item_features(self, item_features, item_names=None):
+        """
+        Stores dense item features (instead of one hot features) in an empty store, e.g. the features of a .pkl dataset.
+        Input:
+            item_features (np.ndarray): [num_items, feature_dim] features of the items, row i is item i.
+            item_names (list): raw ItemId of every item (defaults to the item index).
+        """
+        assert self.index["num_items"] == 0 and not self.index["segments"], "item features can only be set in an empty store"
+        os.makedirs(self.folder, exist_ok=True)
+        np.save(os.path.join(self.folder, "item_features.npy"), np.asarray(item_features, dtype=np.float32))
+        with open(os.path.join(self.folder, "items.txt"), 'w') as f:
+            f.writelines(f"{item}\n" for item in (item_names if item_names is not None else range(len(item_features))))
+        self.index["num_items"] = int(item_features.shape[0])
+        self.index["features"] = "item_features.npy"
+        self.index["feature_dim"] = int(item_features.shape[1])
+        self._write_index()
+
+    def item_features(self):
+        """
+        Return:
+            item_features (np.ndarray): [num_items, feature_dim] dense item features of the store, None if they are one hot (np.eye(num_items)).
+        """
+        if self.index.get("features", "one_hot") == "one_hot":
+            return None
+        return np.load(os.path.join(self.folder, self.index["features"]))
+
+    def commit_segment(self, segment, new_items=(), new_users=(), split_users=None):
+        """
+        Appends the ids of the new items/users and commits a written segment (see write_segment) by replacing index.json.
+        Input:
+            segment (dict): index entry of the segment.
+            new_items (list): raw ItemIds of the items that the segment adds (their indices continue index["num_items"]).
+            new_users (list): [(raw SessionId, split)] of the users that the segment adds (their indices continue index["num_users"]).
+            split_users (list): number of users of every split after the commit (counted from new_users if None).
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, "items.txt"), 'a') as f:
+            f.writelines(item + '\n' for item in new_items)
+        with open(os.path.join(self.folder, "users.tsv"), 'a') as f:
+            f.writelines(f"{user}\t{split}\n" for user, split in new_users)
+
+        # commit
+        if split_users is None:
+            new_splits = np.array([split for _, split in new_users], dtype=np.int64)
+            split_users = (np.array(self.index.get("split_users", [0, 0, 0])) + np.bincount(new_splits, minlength=3)).tolist()
+        self.index["num_items"] += len(new_items)
+        self.index["num_users"] += len(new_users)
+        self.index["split_users"] = split_users
+        self.index["segments"].append(segment)
+        self._write_index()
+
+    def _write_index(self):
+        # index.json is replaced atomically
+        with open(self.index_file + ".tmp", 'w') as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+    def read_split(self, split):
+        """
+        Input:
+            split (int): 0: train, 1: validation, 2: test.
+        Return:
+            lengths (np.ndarray): [num_users_of_split] number of time steps of every user (in user index order).
+            display_item_ids (np.ndarray): [num_steps, max_display_size] (-1 padded), the time steps of a user are consecutive.
+            picked_item_ids (np.ndarray): [num_steps]
+            clicked_items_index (np.ndarray): [num_steps]
+        """
+        _, user_splits = self.users()
+        segments = []
+        for segment in self.index["segments"]:
+            with np.load(os.path.join(self.folder, segment["name"] + ".npz")) as arrays:
+                selected = user_splits[arrays["step_user_ids"]] == split
+                segments.append({name: arrays[name][selected] for name in arrays.files})
+        max_display_size = max([s["display_item_ids"].shape[1] for s in segments if len(s["step_user_ids"])], default=1)
+
+        step_user_ids = np.concatenate([s["step_user_ids"] for s in segments])
+        display_item_ids = np.concatenate([np.pad(s["display_item_ids"], ((0, 0), (0, max_display_size - s["display_item_ids"].shape[1])), constant_values=-1) for s in segments])
+        # the time steps of a user can be in several segments, the stable sort keeps them in segment (time) order
+        order = np.argsort(step_user_ids, kind="stable")
+        lengths = np.bincount(step_user_ids, minlength=self.index["num_users"])[np.unique(step_user_ids)]
+        return lengths, display_item_ids[order], np.concatenate([s["picked_item_ids"] for s in segments])[order], \
+            np.concatenate([s["clicked_items_index"] for s in segments])[order]
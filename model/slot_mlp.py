@@ -0,0 +1,53 @@
+import torch
+from torch import nn
+from model.checkpointing import checkpoint_mlp
+from model.sparse_inputs import is_item_ids, sparse_first_layer
+from model.sampled_softmax import score_slots
+
+# Base class of the Generator_UserModel and the Discriminator_RewardModel. Both score the (num_displayed_items+1) slots of a display set
+# (the last slot is the "not clicking" action) with an MLP (self.model) over the concatenated slot feature vectors and the state.
+# The subclasses build self.model and set self.device, self.checkpoint_segments and self.item_table.
+
+
+class SlotMLP(nn.Module):
+    def mlp(self, state, displayed_items, slots=None):
+        """
+        Input:
+            state (torch.Tensor): [*, state_dim]
+            displayed_items (torch.Tensor): [*, num_displayed_items, feature_dims], or the item ids [*, num_displayed_items] (sparse inputs).
+            slots (torch.Tensor): [*, num_candidates] if given, only these slots are scored (sampled softmax, see model/sampled_softmax.py).
+        Return:
+            scores (torch.Tensor): [*, (num_displayed_items+1)] action scores of the generator, rewards of the discriminator
+                ([*, num_candidates] logits before the output activation if slots is given)
+        """
+        if is_item_ids(displayed_items):
+            # the first layer gathers the weight columns of the displayed items instead of multiplying their feature vectors
+            hidden = sparse_first_layer(self.item_table, self.model[0], displayed_items.to(self.device), state) # --> [*, hidden_dim]
+            return self.run_layers(1, hidden, slots) # --> [*, (num_displayed_items+1)]
+
+        # Prepare input
+        # concat zero vector to displayed items to represent user not clicking on any of the displayed items
+        not_clicking_feature_vec = torch.zeros((*displayed_items.shape[:-2], 1, displayed_items.shape[-1])) # --> [*, 1, feature_dim]
+        displayed_items = torch.cat((displayed_items.to(self.device), not_clicking_feature_vec.to(self.device)), -2) # --> [*, (num_displayed_items+1), feature_dims]
+        displayed_items_flat = displayed_items.flatten(-2) # --> [*, (num_displayed_items+1)*feature_dims]
+        input_features = torch.cat((displayed_items_flat, state), dim=-1) # --> [*, (num_displayed_items*feature_dims) + state_dim]
+
+        return self.run_layers(0, input_features, slots) # --> [*, (num_displayed_items+1)]
+
+    def run_layers(self, first_layer, x, slots=None):
+        """
+        Input:
+            first_layer (int): index of the first layer of the MLP to run.
+            x (torch.Tensor): [*, input_dim] input of that layer.
+            slots (torch.Tensor): [*, num_candidates] if given, only these rows of the output layer are computed (without the output activation).
+        Return:
+            scores (torch.Tensor): [*, (num_displayed_items+1)] ([*, num_candidates] logits if slots is given)
+        """
+        layers = self.model[first_layer:] if slots is None else self.model[first_layer:-2]
+        if self.checkpoint_segments > 0 and torch.is_grad_enabled():
+            x = checkpoint_mlp(layers, self.checkpoint_segments, x)
+        else:
+            x = layers(x)
+        if slots is None:
+            return x
+        return score_slots(self.model[-2], x.reshape(-1, x.shape[-1]), slots.reshape(-1, slots.shape[-1]).to(x.device)).view(slots.shape)
@@ -0,0 +1,253 @@
+import torch
+
+# Sparse input path of the models. Instead of the (mostly zero) feature vectors of the items, the batches hold item ids
+# (see Dataset(sparse_inputs=True)) and the input-to-hidden matmuls of the History_LSTM/History_GRU and of the first Linear of
+# the Generator_UserModel/Discriminator_RewardModel MLPs gather the weight columns of the nonzero features. For the one hot
+# item features of dropbox/process_data.py an input costs O(hidden_dim) instead of O(feature_dim*hidden_dim). The weights are
+# the ones of the dense models, so checkpoints are shared by both paths and the outputs are the same (up to float rounding).
+
+
+def is_item_ids(x):
+    """
+    Return:
+        is_ids (bool): True if x (torch.Tensor or rnn.PackedSequence) holds item ids instead of feature vectors.
+    """
+    data = x.data if isinstance(x, torch.nn.utils.rnn.PackedSequence) else x
+    return not torch.is_floating_point(data)
+
+
+class ItemTable():
+    def __init__(self, item_features, dense_row_nnz=None):
+        """
+        item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features (the last row is the all ones padding placeholder),
+            or data.OneHotItemFeatures.
+        dense_row_nnz (int): rows with more nonzeros than this (e.g. the padding placeholder) are multiplied densely once per
+            projection instead of being gathered (default: feature_dim // 2).
+
+        The ids index a zero row followed by the rows of item_features (see Dataset(sparse_inputs=True)):
+            not_clicking_id = 0 --> zero vector (the "not clicking" action, also the padding of pad_packed_sequence), 1 .. num_items --> items,
+            padding_id = num_items+1 --> padding placeholder of the display sets.
+        """
+        self.feature_dim = item_features.shape[-1]
+        self.not_clicking_id = 0
+        self.padding_id = item_features.shape[0]
+        num_rows = item_features.shape[0] + 1 # a zero row is prepended
+
+        # nonzeros of the rows (one hot data.OneHotItemFeatures are never densified)
+        features = item_features.float().to_sparse().coalesce() # --> [num_items+1, feature_dim] sorted by (row, column)
+        rows, columns = features.indices()
+        rows, values = rows + 1, features.values()
+        nnz = torch.bincount(rows, minlength=num_rows) # --> [num_items+2]
+        dense_rows = nnz > (self.feature_dim // 2 if dense_row_nnz is None else dense_row_nnz)
+        self.dense_index = torch.full((num_rows,), -1, dtype=torch.int64, device=values.device) # --> [num_items+2] row in dense_table (-1: sparse row)
+        self.dense_index[dense_rows] = torch.arange(int(dense_rows.sum()), device=values.device)
+        is_dense = dense_rows[rows]
+        self.dense_table = torch.zeros((int(dense_rows.sum()), self.feature_dim), device=values.device) # --> [num_dense_rows, feature_dim]
+        self.dense_table[self.dense_index[rows[is_dense]], columns[is_dense]] = values[is_dense]
+
+        # CSR layout of the sparse rows
+        self.columns, self.values = columns[~is_dense], values[~is_dense]
+        self.row_offsets = torch.zeros(num_rows + 1, dtype=torch.int64, device=values.device)
+        self.row_offsets[1:] = torch.cumsum(torch.bincount(rows[~is_dense], minlength=num_rows), 0)
+
+    def to(self, device):
+        for name in ["dense_table", "dense_index", "columns", "values", "row_offsets"]:
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    def lookup(self, item_ids):
+        """
+        Input:
+            item_ids (torch.Tensor): [num_inputs, num_slots] ids of the items of every input.
+        Return:
+            lookup (dict): nonzero features of the inputs:
+                columns, inputs, values (torch.Tensor): [nnz] weight column (slot*feature_dim + feature), input and value of every nonzero of the sparse rows.
+                dense_inputs, dense_slots, dense_rows (torch.Tensor): input, slot and row in dense_table of every item with a dense row.
+        """
+        num_inputs, num_slots = item_ids.shape
+        item_ids = item_ids.reshape(-1).to(self.row_offsets.device)
+        slot_inputs = torch.arange(item_ids.shape[0], device=item_ids.device) # --> [num_inputs*num_slots] (input, slot) pairs
+
+        starts, counts = self.row_offsets[item_ids], self.row_offsets[item_ids + 1] - self.row_offsets[item_ids]
+        entry_slot_inputs = torch.repeat_interleave(slot_inputs, counts) # --> [nnz] (input, slot) pair of every nonzero
+        entries = starts[entry_slot_inputs] + torch.arange(entry_slot_inputs.shape[0], device=item_ids.device) - (torch.cumsum(counts, 0) - counts)[entry_slot_inputs]
+
+        dense_rows = self.dense_index[item_ids]
+        is_dense = dense_rows >= 0
+        return {"num_inputs": num_inputs, "num_slots": num_slots, "columns": (entry_slot_inputs % num_slots) * self.feature_dim + self.columns[entries],
+            "inputs": entry_slot_inputs // num_slots, "values": self.values[entries],
+            "dense_inputs": slot_inputs[is_dense] // num_slots, "dense_slots": slot_inputs[is_dense] % num_slots, "dense_rows": dense_rows[is_dense]}
+
+
+class _SparseLinear(torch.autograd.Function):
+    """
+    linear(concatenated feature vectors of the item slots and the state) of a Linear layer whose input starts with num_slots
+    blocks of feature_dim item columns and ends with the state columns. The weight gradient is written into one dense
+    tensor (as for the dense layer) but only the columns of the nonzero features are touched.
+    """
+    @staticmethod
+    def forward(ctx, weight, bias, state, lookup, dense_table, feature_dim):
+        hidden_dim, num_slots, num_dense_rows = weight.shape[0], lookup["num_slots"], dense_table.shape[0]
+        if state is not None:
+            output = torch.nn.functional.linear(state, weight[:, weight.shape[1] - state.shape[-1]:], bias) # --> [num_inputs, hidden_dim]
+        else:
+            output = torch.zeros(lookup["num_inputs"], hidden_dim, dtype=weight.dtype, device=weight.device) + (0 if bias is None else bias)
+        output.index_add_(0, lookup["inputs"], weight.index_select(1, lookup["columns"]).t() * lookup["values"][:, None])
+        if lookup["dense_inputs"].numel() > 0:
+            # e.g. the all ones padding placeholder: multiplied once per slot
+            slot_weight = weight[:, :num_slots * feature_dim].view(hidden_dim, num_slots, feature_dim)
+            dense_projection = torch.einsum("hsf,nf->snh", slot_weight, dense_table) # --> [num_slots, num_dense_rows, hidden_dim]
+            output.index_add_(0, lookup["dense_inputs"], dense_projection[lookup["dense_slots"], lookup["dense_rows"]])
+        ctx.save_for_backward(weight, state)
+        ctx.lookup, ctx.dense_table, ctx.feature_dim, ctx.has_bias = lookup, dense_table, feature_dim, bias is not None
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight, state = ctx.saved_tensors
+        lookup, dense_table, feature_dim = ctx.lookup, ctx.dense_table, ctx.feature_dim
+        hidden_dim, num_slots, num_dense_rows = weight.shape[0], lookup["num_slots"], dense_table.shape[0]
+        grad_weight = grad_bias = grad_state = None
+        if ctx.needs_input_grad[0]:
+            grad_weight = torch.zeros_like(weight)
+            if state is not None:
+                grad_weight[:, weight.shape[1] - state.shape[-1]:] = grad_output.t() @ state
+            grad_weight.index_add_(1, lookup["columns"], (grad_output[lookup["inputs"]] * lookup["values"][:, None]).t())
+            if lookup["dense_inputs"].numel() > 0:
+                dense_grad = torch.zeros(num_slots * num_dense_rows, hidden_dim, dtype=grad_output.dtype, device=grad_output.device).index_add_(0, \
+                    lookup["dense_slots"] * num_dense_rows + lookup["dense_rows"], grad_output[lookup["dense_inputs"]]) # --> [num_slots*num_dense_rows, hidden_dim]
+                grad_weight[:, :num_slots * feature_dim].view(hidden_dim, num_slots, feature_dim).add_( \
+                    torch.einsum("snh,nf->hsf", dense_grad.view(num_slots, num_dense_rows, hidden_dim), dense_table))
+        if ctx.has_bias and ctx.needs_input_grad[1]:
+            grad_bias = grad_output.sum(0)
+        if state is not None and ctx.needs_input_grad[2]:
+            grad_state = grad_output @ weight[:, weight.shape[1] - state.shape[-1]:]
+        return grad_weight, grad_bias, grad_state, None, None, None
+
+
+def sparse_linear(item_table, item_ids, linear_weight, linear_bias=None, state=None):
+    """
+    Input:
+        item_table (ItemTable): item features of the ids.
+        item_ids (torch.Tensor): [*, num_slots] ids of the items of every input.
+        linear_weight (torch.Tensor): [out_dim, in_dim] weight of a Linear layer whose input is the concatenated feature vectors
+            of the num_slots item slots (its first num_slots*feature_dim columns) followed by the state (its last state_dim columns).
+            Columns in between (e.g. of the zero "not clicking" slot) are not used.
+        linear_bias (torch.Tensor): [out_dim]
+        state (torch.Tensor): [*, state_dim]
+    Return:
+        output (torch.Tensor): [*, out_dim] same as the Linear layer on the concatenated feature vectors (and state).
+    """
+    batch_shape = item_ids.shape[:-1]
+    lookup = item_table.lookup(item_ids.reshape(-1, item_ids.shape[-1]))
+    flat_state = None if state is None else state.reshape(-1, state.shape[-1]).to(linear_weight.device)
+    output = _SparseLinear.apply(linear_weight, linear_bias, flat_state, lookup, item_table.dense_table, item_table.feature_dim)
+    return output.view(*batch_shape, linear_weight.shape[0])
+
+
+def sparse_first_layer(item_table, linear, displayed_item_ids, state):
+    """
+    Input:
+        item_table (ItemTable): item features of the ids.
+        linear (torch.nn.Linear): first layer of the Generator_UserModel/Discriminator_RewardModel MLP, its input is
+            [(num_displayed_items+1)*feature_dims + state_dim] (the last item slot is the zero "not clicking" vector, its columns never contribute).
+        displayed_item_ids (torch.Tensor): [batch_size (#users), max(num_time_steps), num_displayed_items]
+        state (torch.Tensor): [batch_size (#users), max(num_time_steps), state_dim]
+    Return:
+        output (torch.Tensor): [batch_size (#users), max(num_time_steps), hidden_dim] same as linear(concatenated input features).
+    """
+    return sparse_linear(item_table, displayed_item_ids, linear.weight, linear.bias, state)
+
+
+def _as_packed(actions):
+    """
+    Return:
+        actions (rnn.PackedSequence): the item ids as a PackedSequence (a [batch_size, num_time_steps] tensor is packed
+            as sequences of equal length, which keeps their order).
+    """
+    if isinstance(actions, torch.nn.utils.rnn.PackedSequence):
+        return actions
+    return torch.nn.utils.rnn.PackedSequence(actions.transpose(0, 1).reshape(-1), torch.full((actions.shape[1],), actions.shape[0], dtype=torch.int64))
+
+
+def sparse_recurrent(item_table, rnn, actions, hidden=None):
+    """
+    Input:
+        item_table (ItemTable): item features of the ids.
+        rnn (torch.nn.LSTM/torch.nn.GRU): batch_first recurrent model whose first layer's input projection is replaced by gathers.
+        actions (rnn.PackedSequence or torch.Tensor): [batch_size (#users), num_time_steps] item ids.
+        hidden: initial states as for rnn.forward (zero states if None).
+    Return:
+        out, hidden: same as rnn.forward on the feature vectors of the actions.
+    The first layer runs as a loop over the time steps (its input projection is gathered for all time steps at once),
+    the remaining layers run as a torch rnn that shares the parameters of rnn.
+    """
+    is_lstm = isinstance(rnn, torch.nn.LSTM)
+    packed = _as_packed(actions)
+    batch_sizes = packed.batch_sizes.tolist()
+    input_gates = sparse_linear(item_table, packed.data.unsqueeze(-1), rnn.weight_ih_l0, rnn.bias_ih_l0) # --> [sum(num_time_steps), gates*state_dim]
+
+    # the first layer runs in the packed order of the sequences (sorted by decreasing length)
+    def first_layer_state(state):
+        if state is None:
+            return torch.zeros(batch_sizes[0], rnn.hidden_size, dtype=input_gates.dtype, device=input_gates.device)
+        return state[0] if packed.sorted_indices is None else state[0].index_select(0, packed.sorted_indices)
+    h = first_layer_state(None if hidden is None else (hidden[0] if is_lstm else hidden))
+    c = first_layer_state(None if hidden is None else hidden[1]) if is_lstm else None
+
+    outputs = []
+    start = 0
+    for size in batch_sizes:
+        if is_lstm:
+            gates = torch.addmm(input_gates[start:start + size] + rnn.bias_hh_l0, h[:size], rnn.weight_hh_l0.t())
+            i, f, g, o = gates.chunk(4, 1)
+            new_c = torch.sigmoid(f) * c[:size] + torch.sigmoid(i) * torch.tanh(g)
+            new_h = torch.sigmoid(o) * torch.tanh(new_c)
+            c = torch.cat((new_c, c[size:]))
+        else:
+            x_r, x_z, x_n = input_gates[start:start + size].chunk(3, 1)
+            h_r, h_z, h_n = torch.addmm(rnn.bias_hh_l0, h[:size], rnn.weight_hh_l0.t()).chunk(3, 1)
+            r, z = torch.sigmoid(x_r + h_r), torch.sigmoid(x_z + h_z)
+            new_h = (1 - z) * torch.tanh(x_n + r * h_n) + z * h[:size]
+        # the sequences that ended keep their last state
+        h = torch.cat((new_h, h[size:]))
+        outputs.append(new_h)
+        start += size
+    out = torch.nn.utils.rnn.PackedSequence(torch.cat(outputs), packed.batch_sizes, packed.sorted_indices, packed.unsorted_indices)
+
+    def final_state(state):
+        # packed order --> order of the sequences, [1, batch_size, state_dim]
+        return (state if packed.unsorted_indices is None else state.index_select(0, packed.unsorted_indices)).unsqueeze(0)
+    h_n = final_state(h)
+    c_n = final_state(c) if is_lstm else None
+
+    if rnn.num_layers > 1:
+        # nn.LSTM/nn.GRU take (and return) the states in the order of the sequences
+        if is_lstm:
+            out, (upper_h, upper_c) = _upper_layers(rnn)(out, None if hidden is None else (hidden[0][1:].contiguous(), hidden[1][1:].contiguous()))
+            h_n, c_n = torch.cat((h_n, upper_h)), torch.cat((c_n, upper_c))
+        else:
+            out, upper_h = _upper_layers(rnn)(out, None if hidden is None else hidden[1:].contiguous())
+            h_n = torch.cat((h_n, upper_h))
+
+    if not isinstance(actions, torch.nn.utils.rnn.PackedSequence):
+        out = out.data.view(actions.shape[1], actions.shape[0], rnn.hidden_size).transpose(0, 1) # --> [batch_size, num_time_steps, state_dim]
+    return out, ((h_n, c_n) if is_lstm else h_n)
+
+
+def _upper_layers(rnn):
+    """
+    Return:
+        upper (torch.nn.LSTM/torch.nn.GRU): layers 1.. of rnn as a separate rnn that shares their parameters
+            (not registered as a submodule, so the state_dict of rnn is unchanged).
+    """
+    parameter_ids = [id(p) for p in rnn.parameters()]
+    cached = rnn.__dict__.get("_sparse_upper_layers")
+    if cached is None or cached[1] != parameter_ids:
+        upper = type(rnn)(rnn.hidden_size, rnn.hidden_size, rnn.num_layers - 1, bias=rnn.bias, batch_first=rnn.batch_first)
+        for layer in range(1, rnn.num_layers):
+            for name in ["weight_ih", "weight_hh"] + (["bias_ih", "bias_hh"] if rnn.bias else []):
+                setattr(upper, f"{name}_l{layer-1}", getattr(rnn, f"{name}_l{layer}"))
+        # kept in a tuple, so that nn.Module does not register it as a submodule
+        cached = rnn.__dict__["_sparse_upper_layers"] = (upper, parameter_ids)
+    return cached[0]
@@ -0,0 +1,236 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import time
+from copy import deepcopy
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml, infer_model_dims, build_gan
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of the History_LSTM, Generator_UserModel and Discriminator_RewardModel for CPU serving.')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file. The fp32 models are loaded from the checkpoints given there.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset to use for calibration and evaluation.')
+    parser.add_argument('--mode', type=str, default="dynamic",
+                        help='either ["dynamic", "static"]. "dynamic": int8 weights, activations are quantized on the fly (Linear and LSTM). \
+                            "static": additionally calibrates the activation ranges of the MLPs on the validation split (the LSTM stays dynamic).')
+    parser.add_argument('--calibration_batches', type=int, default=32,
+                        help='Number of validation batches used for static calibration.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Path of the quantized inference bundle. Defaults to <ckpt_path>/quantized_<dataset>_<mode>.pth.tar')
+    parser.add_argument('--report', type=str, default="results/quantization_report.json",
+                        help='Path of the fp32 vs int8 comparison report (json).')
+
+    args = parser.parse_args()
+    return args
+
+
+def select_quantized_engine():
+    # fbgemm/x86 on x86 CPUs, qnnpack on ARM
+    for engine in ["x86", "fbgemm", "qnnpack"]:
+        if engine in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError(f"no supported quantized engine in {torch.backends.quantized.supported_engines}")
+
+
+def to_cpu(model):
+    # quantized kernels only run on the CPU. Note that the models move their inputs to model.device.
+    model = deepcopy(model).cpu().eval()
+    model.device = "cpu"
+    return model
+
+
+def quantize_dynamic(history_LSTM, generator_UserModel, discriminator_RewardModel):
+    """
+    Input:
+        fp32 History_LSTM, Generator_UserModel and Discriminator_RewardModel.
+    Return:
+        copies of the models with int8 nn.Linear/nn.LSTM/nn.GRU weights (activations are quantized dynamically).
+    """
+    history_LSTM = to_cpu(history_LSTM)
+    history_LSTM.set_checkpoint_segments(0)
+    history_LSTM = torch.quantization.quantize_dynamic(history_LSTM, {nn.LSTM, nn.GRU, nn.Linear}, dtype=torch.qint8)
+    generator_UserModel = torch.quantization.quantize_dynamic(to_cpu(generator_UserModel), {nn.Linear}, dtype=torch.qint8)
+    discriminator_RewardModel = torch.quantization.quantize_dynamic(to_cpu(discriminator_RewardModel), {nn.Linear}, dtype=torch.qint8)
+    return history_LSTM, generator_UserModel, discriminator_RewardModel
+
+
+def prepare_static_mlp(model, engine):
+    """
+    Input:
+        model (Generator_UserModel or Discriminator_RewardModel): fp32 (cpu) model, modified in place.
+        engine (str): quantized engine.
+    Fuses the Linear+ReLU pairs of model.model, wraps it in Quant/DeQuant stubs and inserts the calibration observers.
+    """
+    model.checkpoint_segments = 0
+    layers = list(model.model)
+    fuse_pairs = [[str(i), str(i+1)] for i in range(len(layers) - 1) if isinstance(layers[i], nn.Linear) and isinstance(layers[i+1], nn.ReLU)]
+    model.model.eval()
+    fused = torch.quantization.fuse_modules(model.model, fuse_pairs)
+    model.model = nn.Sequential(torch.quantization.QuantStub(), *fused, torch.quantization.DeQuantStub())
+    model.model.qconfig = torch.quantization.get_default_qconfig(engine)
+    torch.quantization.prepare(model.model, inplace=True)
+    return model
+
+
+def quantize_static(history_LSTM, generator_UserModel, discriminator_RewardModel, calibration_dataloader, calibration_batches, engine):
+    """
+    Input:
+        fp32 History_LSTM, Generator_UserModel and Discriminator_RewardModel.
+        calibration_dataloader (torch.utils.data.DataLoader): DataLoader of the calibration (validation) split.
+        calibration_batches (int): number of calibration batches.
+        engine (str): quantized engine.
+    Return:
+        copies of the models. The MLPs are statically quantized (int8 weights and activations, calibrated activation ranges),
+        the History_LSTM is dynamically quantized.
+    """
+    history_LSTM, _, _ = quantize_dynamic(history_LSTM, generator_UserModel, discriminator_RewardModel)
+    generator_UserModel = prepare_static_mlp(to_cpu(generator_UserModel), engine)
+    discriminator_RewardModel = prepare_static_mlp(to_cpu(discriminator_RewardModel), engine)
+
+    # Calibration: run the validation split through the models so the observers record the activation ranges
+    with torch.no_grad():
+        for i, (real_click_history, display_set, clicked_items) in enumerate(calibration_dataloader):
+            if i >= calibration_batches:
+                break
+            real_states = history_LSTM(real_click_history)
+            discriminator_RewardModel(real_states, display_set)
+            generator_UserModel(real_states, display_set)
+
+    torch.quantization.convert(generator_UserModel.model, inplace=True)
+    torch.quantization.convert(discriminator_RewardModel.model, inplace=True)
+    return history_LSTM, generator_UserModel, discriminator_RewardModel
+
+
+def serialized_nbytes(model):
+    # size of the serialized weights, i.e. the memory needed to hold the model
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def scoring_latency(history_LSTM, generator_UserModel, discriminator_RewardModel, dataloader, device):
+    """
+    Return:
+        latency (dict): median/mean seconds per batch of the scoring path (History_LSTM -> Discriminator_RewardModel, Generator_UserModel).
+    """
+    times = []
+    with torch.no_grad():
+        for real_click_history, display_set, clicked_items in dataloader:
+            real_click_history = real_click_history.to(device)
+            display_set = display_set.to(device)
+            start = time.perf_counter()
+            real_states = history_LSTM(real_click_history)
+            discriminator_RewardModel(real_states, display_set)
+            generator_UserModel.get_index(real_states, display_set)
+            times.append(time.perf_counter() - start)
+    return {"median_s_per_batch": statistics.median(times), "mean_s_per_batch": statistics.mean(times), "batches": len(times)}
+
+
+def evaluate(gan, test_dataloader):
+    """
+    Return:
+        metrics (dict): GAN.test losses and precision metrics.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        test_dreal_loss, test_dfake_loss, metrics = gan.test(test_dataloader, return_metrics=True)
+    metrics.update({"test_dreal_loss": float(test_dreal_loss), "test_dfake_loss": float(test_dfake_loss)})
+    return metrics
+
+
+def load_quantized_bundle(filename):
+    """
+    Input:
+        filename (str): path of a bundle written by quantize.py.
+    Return:
+        gan (GAN): GAN whose History_LSTM, Generator_UserModel and Discriminator_RewardModel are the quantized models (CPU, eval mode).
+    """
+    bundle = torch.load(filename, map_location="cpu", weights_only=False) if "weights_only" in torch.load.__code__.co_varnames \
+        else torch.load(filename, map_location="cpu")
+    config_dict = bundle["config"]
+    config_dict["load_pretrained"] = False
+    gan = build_gan(config_dict)
+    gan.device = "cpu"
+    gan.history_LSTM = bundle["history_LSTM"]
+    gan.generator_UserModel = bundle["generator_UserModel"]
+    gan.discriminator_RewardModel = bundle["discriminator_RewardModel"]
+    return gan
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+    assert args.mode in ["dynamic", "static"]
+    engine = select_quantized_engine()
+
+    val_dataloader = DataLoader(Dataset(args.data_folder, args.dataset, split="validation"), batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True)
+    test_dataloader = DataLoader(Dataset(args.data_folder, args.dataset, split="test"), batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True)
+
+    # fp32 models from the checkpoints
+    infer_model_dims(config_dict, test_dataloader)
+    gan = build_gan(config_dict)
+    gan.load_checkpoints(load_optimizers=False)
+    gan.config_dict["load_pretrained"] = False # models are already loaded, GAN.test must not reload them
+    for model in [gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel]:
+        model.eval()
+
+    # int8 models
+    if args.mode == "dynamic":
+        quantized_models = quantize_dynamic(gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel)
+    else:
+        quantized_models = quantize_static(gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel, \
+            val_dataloader, args.calibration_batches, engine)
+    quantized_gan = build_gan(deepcopy(gan.config_dict))
+    quantized_gan.device = "cpu"
+    quantized_gan.history_LSTM, quantized_gan.generator_UserModel, quantized_gan.discriminator_RewardModel = quantized_models
+
+    # ========== Report: latency, memory and Prec@k of fp32 vs int8
+    report = {"mode": args.mode, "engine": engine, "dataset": args.dataset}
+    for name, cur_gan in [("fp32", gan), ("int8", quantized_gan)]:
+        models = [cur_gan.history_LSTM, cur_gan.generator_UserModel, cur_gan.discriminator_RewardModel]
+        report[name] = {
+            "latency": scoring_latency(*models, test_dataloader, cur_gan.device),
+            "memory_bytes": {"history_lstm": serialized_nbytes(models[0]), "generator": serialized_nbytes(models[1]), "discriminator": serialized_nbytes(models[2])},
+            "metrics": evaluate(cur_gan, test_dataloader),
+        }
+        report[name]["memory_bytes"]["total"] = sum(report[name]["memory_bytes"].values())
+    report["speedup"] = report["fp32"]["latency"]["median_s_per_batch"] / report["int8"]["latency"]["median_s_per_batch"]
+    report["memory_reduction"] = report["fp32"]["memory_bytes"]["total"] / report["int8"]["memory_bytes"]["total"]
+    report["metric_deltas"] = {key: report["int8"]["metrics"][key] - report["fp32"]["metrics"][key] for key in report["fp32"]["metrics"]}
+
+    print("*" * 30)
+    print(f"int8 ({args.mode}) vs fp32: {report['speedup']:.2f}x faster, {report['memory_reduction']:.2f}x smaller")
+    for key, delta in report["metric_deltas"].items():
+        print(f"{key}: fp32 = {report['fp32']['metrics'][key]}, int8 = {report['int8']['metrics'][key]} (delta = {delta})")
+    print("*" * 30)
+
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
+
+    # ========== Quantized inference bundle
+    output = args.output or os.path.join(config_dict["ckpt_path"], f"quantized_{args.dataset}_{args.mode}.pth.tar")
+    torch.save({
+        "config": quantized_gan.config_dict,
+        "mode": args.mode,
+        "engine": engine,
+        "history_LSTM": quantized_gan.history_LSTM,
+        "generator_UserModel": quantized_gan.generator_UserModel,
+        "discriminator_RewardModel": quantized_gan.discriminator_RewardModel,
+        "report": report,
+    }, output)
+    print(f"Saved quantized inference bundle to {output}")
@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml, infer_model_dims, build_gan
+from model.retrieval import BruteForceIndex, IVFIndex, fit_query_projection, state_queries, to_display_set
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Full catalog candidate retrieval for the learned user states (brute force vs IVF index).')
+    parser.add_argument('--config_path', type=str, default="config.yaml",
+                        help='Path of the configurations yaml file. The models are loaded from the checkpoints given there.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset file.')
+    parser.add_argument('--dataset', type=str, default="yelp",
+                        help='either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"). Dataset to use.')
+    parser.add_argument('--k', type=int, default=None,
+                        help='Number of retrieved items per query. Defaults to the display set size of the models (so that they can be scored by the discriminator).')
+    parser.add_argument('--block_size', type=int, default=65536, help='Number of items scored at once by the brute force search.')
+    parser.add_argument('--ivf_lists', type=int, default=None, help='Number of inverted lists of the IVF index. Defaults to sqrt(#items).')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16],
+                        help='Number of probed lists of the IVF index (one report entry per value).')
+    parser.add_argument('--ridge', type=float, default=1.0, help='L2 regularization of the state --> query projection.')
+    parser.add_argument('--extra_items', type=int, default=0,
+                        help='Number of synthetic items (perturbed copies of the catalog items) appended to the catalog to measure the latency of larger catalogs.')
+    parser.add_argument('--report', type=str, default="results/retrieval_report.json",
+                        help='Path of the recall/latency report (json).')
+
+    args = parser.parse_args()
+    return args
+
+
+def collect_states(gan, dataset, batch_size):
+    """
+    Input:
+        gan (GAN): trained models.
+        dataset (Dataset): split to run the History_LSTM on.
+        batch_size (int): batch size.
+    Return:
+        states (torch.Tensor): [num_steps, state_dim] state after every (real) time step of every user (users in dataset order, the last incomplete batch is dropped).
+        next_item_ids (torch.Tensor): [num_steps] id of the item clicked at the next time step (-1 at the last time step of a user).
+        last_step (torch.Tensor): [num_steps] True at the last time step of every user.
+    """
+    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=custom_collate_fn, drop_last=True)
+    states, next_item_ids, last_step = [], [], []
+    with torch.no_grad():
+        for batch_index, (real_click_history, display_set, clicked_items) in enumerate(dataloader):
+            batch_states, lengths = torch.nn.utils.rnn.pad_packed_sequence(gan.history_LSTM(real_click_history.to(gan.device)), batch_first=True)
+            for b in range(batch_states.shape[0]):
+                user = batch_index * batch_size + b
+                picked = dataset.picked_item_ids[dataset.user_offsets[user]:dataset.user_offsets[user+1]] # --> [num_time_steps]
+                states.append(batch_states[b, :lengths[b]].cpu())
+                next_item_ids.append(torch.cat((picked[1:], torch.tensor([-1]))))
+                last_step.append(torch.arange(lengths[b]) == lengths[b] - 1)
+    return torch.cat(states), torch.cat(next_item_ids), torch.cat(last_step)
+
+
+def timed_search(index, queries, k, **kwargs):
+    """
+    Return:
+        top_scores, top_ids (torch.Tensor): [num_queries, k] search results.
+        latency (dict): total and per query search time in seconds.
+    """
+    start = time.perf_counter()
+    top_scores, top_ids = index.search(queries, k, **kwargs)
+    elapsed = time.perf_counter() - start
+    return top_scores, top_ids, {"total_s": elapsed, "per_query_ms": 1000 * elapsed / queries.shape[0]}
+
+
+def recall_at_k(approximate_ids, exact_ids):
+    """
+    Return:
+        recall (float): average fraction of the exact top-k items that are retrieved by the approximate search.
+    """
+    hits = (approximate_ids[:, :, None] == exact_ids[:, None, :]).any(-1).sum(-1) # --> [num_queries]
+    return (hits.float() / exact_ids.shape[1]).mean().item()
+
+
+def hit_rate(top_ids, next_item_ids):
+    """
+    Return:
+        hit_rate (float): fraction of the queries whose next clicked item is retrieved.
+    """
+    return (top_ids == next_item_ids[:, None]).any(-1).float().mean().item()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config_dict = parse_config_yaml(args.config_path)
+    assert dataset_exists(args.data_folder, args.dataset), f"no processed dataset {args.dataset} in {args.data_folder}"
+
+    train_dataset = Dataset(args.data_folder, args.dataset, split="train")
+    test_dataset = Dataset(args.data_folder, args.dataset, split="test")
+    infer_model_dims(config_dict, DataLoader(test_dataset, batch_size=config_dict['batch_size'], collate_fn=custom_collate_fn, drop_last=True))
+    gan = build_gan(config_dict)
+    gan.load_checkpoints(load_optimizers=False)
+    for model in [gan.history_LSTM, gan.generator_UserModel, gan.discriminator_RewardModel]:
+        model.eval()
+    k = args.k or config_dict["generator_output_size"] - 1
+
+    # ========== Query projection: state --> features of the next clicked item (fit on the train split)
+    train_states, train_next_item_ids, _ = collect_states(gan, train_dataset, config_dict['batch_size'])
+    has_next = train_next_item_ids >= 0
+    projection = fit_query_projection(train_states[has_next], train_dataset.item_features[train_next_item_ids[has_next]], args.ridge)
+
+    # ========== Item vectors (the last row of item_features is the padding placeholder)
+    item_vectors = test_dataset.item_features[:-1]
+    if args.extra_items > 0:
+        generator = torch.Generator().manual_seed(0)
+        copies = item_vectors[torch.randint(item_vectors.shape[0], (args.extra_items,), generator=generator)]
+        item_vectors = torch.cat((item_vectors, copies + 0.01 * torch.randn(copies.shape, generator=generator)))
+    item_vectors = item_vectors.to(gan.device)
+
+    # ========== Queries: every test state that has a next click
+    test_states, test_next_item_ids, test_last_step = collect_states(gan, test_dataset, config_dict['batch_size'])
+    has_next = test_next_item_ids >= 0
+    queries = state_queries(test_states[has_next].to(gan.device), projection.to(gan.device))
+    next_item_ids = test_next_item_ids[has_next].to(gan.device)
+
+    report = {"dataset": args.dataset, "num_items": item_vectors.shape[0], "num_queries": queries.shape[0], "k": k}
+    brute_force = BruteForceIndex(item_vectors, args.block_size)
+    _, exact_ids, latency = timed_search(brute_force, queries, k)
+    report["brute_force"] = {"latency": latency, "next_click_hit_rate": hit_rate(exact_ids, next_item_ids)}
+
+    start = time.perf_counter()
+    ivf = IVFIndex(item_vectors, num_lists=args.ivf_lists, block_size=args.block_size)
+    report["ivf"] = {"num_lists": ivf.centroids.shape[0], "build_s": time.perf_counter() - start, "nprobe": {}}
+    for nprobe in args.nprobe:
+        _, ivf_ids, latency = timed_search(ivf, queries, k, nprobe=nprobe)
+        report["ivf"]["nprobe"][nprobe] = {"latency": latency, "recall_vs_brute_force": recall_at_k(ivf_ids, exact_ids), \
+            "next_click_hit_rate": hit_rate(ivf_ids, next_item_ids), "speedup": report["brute_force"]["latency"]["total_s"] / latency["total_s"]}
+
+    # ========== Retrieved items as display sets of the discriminator (one per test user, from the last state)
+    if k == config_dict["discriminator_output_size"] - 1:
+        last_states = test_states[test_last_step].to(gan.device)
+        start = time.perf_counter()
+        _, retrieved_ids = brute_force.search(state_queries(last_states, projection.to(gan.device)), k)
+        retrieved_ids = torch.where(retrieved_ids < test_dataset.item_features.shape[0] - 1, retrieved_ids, torch.full_like(retrieved_ids, -1)) # synthetic extra items have no features
+        display_set = to_display_set(test_dataset.item_features.to(gan.device), retrieved_ids, test_dataset.item_features.shape[0] - 1) # --> [num_users, 1, k, feature_dim]
+        with torch.no_grad():
+            rewards = gan.discriminator_RewardModel(last_states.unsqueeze(1), display_set) # --> [num_users, 1, (k+1)]
+        recommended = torch.gather(retrieved_ids, 1, rewards[:, 0, :k].argmax(-1, keepdim=True)) # --> [num_users, 1] discriminator reranked top item
+        report["discriminator_rerank"] = {"latency_s": time.perf_counter() - start, "num_users": last_states.shape[0],
+            "mean_top_reward": rewards[:, 0, :k].max(-1).values.mean().item(),
+            "changed_top_item": (recommended[:, 0] != retrieved_ids[:, 0]).float().mean().item()}
+
+    print(json.dumps(report, indent=4))
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+import torch
+
+#======================================================================================================
+### Standalone runner of a user model exported with export_model.py. Only the exported artifact and its
+# metadata json are needed, none of the training code (model/, data.py, main.py) is imported.
+#======================================================================================================
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Runs a user model exported with export_model.py (TorchScript or ONNX).')
+    parser.add_argument('--metadata', type=str, default="exported/yelp-inference.json",
+                        help='Path of the metadata json written by export_model.py.')
+    parser.add_argument('--format', type=str, default="torchscript",
+                        help='either ["torchscript", "onnx"]. ONNX models are run with onnxruntime.')
+    parser.add_argument('--inputs', type=str, default=None,
+                        help='.npz file with "click_history" and "display_set" arrays. Random inputs of the exported shape are used if not given.')
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help='Batch size of the random inputs. Defaults to the batch size of the export.')
+    parser.add_argument('--repeats', type=int, default=20, help='Number of timed forward passes.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='.npz file to write the "action_scores", "rewards" and "clicked_indices" of the (last) forward pass into.')
+
+    args = parser.parse_args()
+    return args
+
+
+def load_runner(metadata_path, export_format):
+    """
+    Input:
+        metadata_path (str): path of the metadata json written by export_model.py.
+        export_format (str): "torchscript" or "onnx".
+    Return:
+        run (callable): run(click_history, display_set) --> (action_scores, rewards) on numpy arrays.
+    """
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    filename = os.path.join(os.path.dirname(metadata_path), metadata["files"][export_format])
+
+    if export_format == "torchscript":
+        model = torch.jit.load(filename, map_location="cpu").eval()
+        def run(click_history, display_set):
+            with torch.no_grad():
+                action_scores, rewards = model(torch.from_numpy(click_history), torch.from_numpy(display_set))
+            return action_scores.numpy(), rewards.numpy()
+    else:
+        import onnxruntime
+        session = onnxruntime.InferenceSession(filename, providers=["CPUExecutionProvider"])
+        def run(click_history, display_set):
+            action_scores, rewards = session.run(["action_scores", "rewards"], {"click_history": click_history, "display_set": display_set})
+            return action_scores, rewards
+    return run
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    assert args.format in ["torchscript", "onnx"]
+    with open(args.metadata) as f:
+        metadata = json.load(f)
+    run = load_runner(args.metadata, args.format)
+
+    if args.inputs is not None:
+        inputs = np.load(args.inputs)
+        click_history, display_set = inputs["click_history"].astype(np.float32), inputs["display_set"].astype(np.float32)
+    else:
+        rng = np.random.default_rng(0)
+        batch_size = args.batch_size or metadata["batch_size"]
+        click_history = rng.random((batch_size, metadata["time_steps"], metadata["feature_dim"]), dtype=np.float32)
+        display_set = rng.random((batch_size, metadata["time_steps"], metadata["num_displayed_items"], metadata["feature_dim"]), dtype=np.float32)
+
+    times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        action_scores, rewards = run(click_history, display_set)
+        times.append(time.perf_counter() - start)
+    median_s = statistics.median(times)
+    print(f"{args.format}: median {median_s:.6f}s per batch of {click_history.shape[0]} users ({click_history.shape[0] / median_s:.1f} users/s)")
+
+    if args.output is not None:
+        # the (num_displayed_items+1)^th index refers to the user not clicking on any of the displayed items
+        np.savez(args.output, action_scores=action_scores, rewards=rewards, clicked_indices=action_scores.argmax(-1))
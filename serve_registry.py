@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from data import Dataset, custom_collate_fn, dataset_exists
+from main import parse_config_yaml
+from model.registry import ModelRegistry
+
+#======================================================================================================
+### Local HTTP scoring endpoint of a ModelRegistry (model/registry.py) that serves the models of several datasets side by side
+# (one model per dataset, e.g. yelp, rsc and tb). A request holds the item ids (rows of Dataset.item_features of its dataset)
+# of a session prefix, the response the scores of its last time step:
+#   POST /score {"model": "yelp", "history": [item id per time step], "display": [[displayed item ids] per time step]}
+#       --> {"version": str, "action_scores": [(num_displayed_items+1) floats], "rewards": [(num_displayed_items+1) floats]}
+#   POST /load {"model": "yelp", "ckpt_path": str, "version": str (optional), "wait": bool (optional)}
+#       --> loads a new checkpoint version of the model in the background and activates it once it is loaded, the requests
+#       keep being served by the active version meanwhile (202, or 200 when it is active if "wait" is true)
+#   GET /models --> {model: active version},  GET /memory --> ModelRegistry.memory_report()
+#======================================================================================================
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Serves the user models of a ModelRegistry over HTTP (POST /score, POST /load).')
+    parser.add_argument('--models', type=str, nargs='+', default=["yelp=config.yaml"],
+                        help='Served models as <dataset>=<config yaml> pairs (e.g. yelp=config.yaml rsc=configs/rsc.yaml). Every dataset is '
+                        'either ["yelp", "rsc", "tb"] or an update dataset written by incremental.py ("<dataset>-<tag>"), its item features '
+                        'resolve the item ids of the requests. The models are loaded from the checkpoints given in the config.')
+    parser.add_argument('--data_folder', type=str, default="./dropbox",
+                        help='Path (str) that holds the dataset files.')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on.')
+
+    args = parser.parse_args()
+    return args
+
+
+def load_version(registry, dset, version, config_dict, item_features):
+    """
+    Input:
+        registry (ModelRegistry): registry that serves the models.
+        dset (str), version (str): key of the checkpoint version.
+        config_dict (dict): configuration whose ckpt_path points to the checkpoints of the version.
+        item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features of the dataset.
+    Return:
+        future (concurrent.futures.Future): resolves to the ModelBundle once the version is loaded and active (see ModelRegistry.load).
+            A version whose feature_dim does not match the item features of the dataset is not activated (the future raises).
+    """
+    def check(bundle):
+        if bundle.config_dict["history_input_size"] != item_features.shape[-1]:
+            raise ValueError(f"feature_dim of {config_dict['ckpt_path']} ({bundle.config_dict['history_input_size']}) does not match the {dset} dataset ({item_features.shape[-1]})")
+    sparse_inputs = config_dict.get("sparse_inputs", False)
+    return registry.load(dset, version, config_dict, item_features=item_features if sparse_inputs else None, check=check)
+
+
+def load_served_models(registry, data_folder, model_configs):
+    """
+    Input:
+        registry (ModelRegistry): registry that serves the models.
+        data_folder (str): folder of the datasets.
+        model_configs (dict): dataset --> config_dict whose checkpoints are served as the model of the dataset.
+    Return:
+        served (dict): dataset --> (config_dict, item_features) of every served model, used to resolve the item ids of its requests
+            and to load its new versions (POST /load).
+    The checkpoints of all datasets are loaded in the background threads of the registry and are active when the function returns.
+    """
+    served = {dset: (config_dict, Dataset(data_folder, dset, split="test").item_features) for dset, config_dict in model_configs.items()}
+    futures = [load_version(registry, dset, os.path.basename(os.path.normpath(config_dict["ckpt_path"])), config_dict, item_features) \
+        for dset, (config_dict, item_features) in served.items()]
+    for future in futures:
+        future.result()
+    return served
+
+
+def requests_to_batch(item_features, requests, sparse_inputs=False):
+    """
+    Input:
+        item_features (torch.Tensor): [num_items+1, feature_dim] Dataset.item_features.
+        requests (list): [(history item ids [num_time_steps], display item ids [num_time_steps, num_displayed_item])] session prefixes.
+        sparse_inputs (bool): if True, the batch holds the item ids (see Dataset(sparse_inputs=True)).
+    Return:
+        real_click_history (rnn.PackedSequence), display_set (rnn.PackedSequence): batch as returned by custom_collate_fn.
+    """
+    data = []
+    for history_ids, display_ids in requests:
+        history_ids, display_ids = torch.as_tensor(history_ids, dtype=torch.int64), torch.as_tensor(display_ids, dtype=torch.int64)
+        clicked_items = torch.zeros(len(history_ids))
+        if sparse_inputs:
+            data.append((clicked_items, history_ids + 1, len(history_ids), display_ids + 1))
+        else:
+            data.append((clicked_items, item_features[history_ids], len(history_ids), item_features[display_ids]))
+    real_click_history, display_set, _ = custom_collate_fn(data)
+    return real_click_history, display_set
+
+
+def score_last_step(registry, key, item_features, history_ids, display_ids, sparse_inputs=False):
+    """
+    Return:
+        version (str), action_scores (list), rewards (list): scores of the last time step of the session prefix by the active version of the model.
+    """
+    real_click_history, display_set = requests_to_batch(item_features, [(history_ids, display_ids)], sparse_inputs)
+    action_scores, rewards, version = registry.score(key, real_click_history, display_set)
+    return version, action_scores[0, -1].tolist(), rewards[0, -1].tolist()
+
+
+def make_handler(registry, served):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive connections
+        disable_nagle_algorithm = True # the headers and the body are written separately, Nagle + delayed ACKs would stall every response
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/models":
+                self.send_json(200, registry.active_versions())
+            elif self.path == "/memory":
+                self.send_json(200, registry.memory_report())
+            else:
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path not in ["/score", "/load"]:
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                config_dict, item_features = served[request["model"]]
+                if self.path == "/load":
+                    self.load(request, config_dict, item_features)
+                    return
+                version, action_scores, rewards = score_last_step(registry, request["model"], item_features, request["history"], request["display"], \
+                    config_dict.get("sparse_inputs", False))
+            except KeyError as error:
+                self.send_json(404, {"error": str(error)})
+                return
+            except (ValueError, IndexError, RuntimeError) as error:
+                self.send_json(400, {"error": str(error)})
+                return
+            self.send_json(200, {"version": version, "action_scores": action_scores, "rewards": rewards})
+
+        def load(self, request, config_dict, item_features):
+            # the new version uses the config of the served model with the checkpoints of request["ckpt_path"]
+            if not isinstance(request["ckpt_path"], str):
+                raise ValueError("ckpt_path has to be a string")
+            version = request.get("version", os.path.basename(os.path.normpath(request["ckpt_path"])))
+            future = load_version(registry, request["model"], version, dict(config_dict, ckpt_path=request["ckpt_path"]), item_features)
+            future.add_done_callback(lambda future: print(f"{request['model']}: " + \
+                (f"activated version {version}" if future.exception() is None else f"loading version {version} failed: {future.exception()!r}")))
+            if not request.get("wait", False):
+                self.send_json(202, {"model": request["model"], "version": version, "status": "loading"})
+                return
+            try:
+                future.result()
+            except Exception as error:
+                self.send_json(400, {"model": request["model"], "version": version, "error": repr(error)})
+                return
+            self.send_json(200, {"model": request["model"], "version": version, "status": "active"})
+
+        def log_message(self, format, *args):
+            pass # no per request logging
+
+    return ScoringHandler
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    model_configs = {}
+    for model in args.models:
+        dset, config_path = model.split("=", 1)
+        assert dataset_exists(args.data_folder, dset), f"no processed dataset {dset} in {args.data_folder}"
+        model_configs[dset] = parse_config_yaml(config_path)
+    registry = ModelRegistry(num_loader_threads=len(model_configs))
+    served = load_served_models(registry, args.data_folder, model_configs)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(registry, served))
+    print(f"Serving {registry.active_versions()} (model --> version) on http://{args.host}:{args.port}/score")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    registry.close()